@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+#
+# Benchmarks of the orchestration overhead of the fastsurfer ChRIS plugin.
+#
+# FastSurfer itself is replaced by stub_run_fastsurfer.py, so the benchmarks
+# run anywhere without FreeSurfer, PyTorch or a GPU. Results are saved as
+# JSON; pass a previous result file with --compare to print the relative
+# change of every metric.
+#
+#   python benchmarks/bench_fastsurfer.py --output bench.json
+#   python benchmarks/bench_fastsurfer.py --output new.json --compare bench.json
+#
+
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from fastsurfer import io_staging                     # noqa: E402
+from fastsurfer import result_cache                   # noqa: E402
+from fastsurfer import run_options                    # noqa: E402
+from fastsurfer.fastsurfer import CACHE_IGNORED_ARGS  # noqa: E402
+from fastsurfer.fastsurfer import Fastsurfer          # noqa: E402
+from fastsurfer.subject_batch import SubjectJob       # noqa: E402
+
+PLUGIN = os.path.join(REPO, 'fastsurfer', 'fastsurfer.py')
+STUB = os.path.join(REPO, 'benchmarks', 'stub_run_fastsurfer.py')
+
+
+def nifti1_bytes(edge):
+    """
+    Return a uint8 NIfTI-1 volume of edge^3 1mm voxels with noisy content.
+    """
+    header = bytearray(348)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, 3, edge, edge, edge, 1, 1, 1, 1)
+    struct.pack_into('<2h', header, 70, 2, 8)
+    struct.pack_into('<8f', header, 76, 1, 1, 1, 1, 1, 1, 1, 1)
+    struct.pack_into('<f', header, 108, 352)
+    struct.pack_into('<2h', header, 252, 0, 1)
+    for row, offset in enumerate((280, 296, 312)):
+        srow = [0.0] * 4
+        srow[row] = 1.0
+        struct.pack_into('<4f', header, offset, *srow)
+    header[344:348] = b'n+1\x00'
+    block = os.urandom(4096)
+    size = edge ** 3
+    data = (block * (size // len(block) + 1))[:size]
+    return bytes(header) + b'\x00' * 4 + data
+
+
+class Workspace(object):
+    """
+    Temporary plugin working directory with a stub FastSurfer installation,
+    an input directory of synthetic T1 volumes and an output directory.
+    """
+    def __init__(self, subjects, t1_edge):
+        self.root = tempfile.mkdtemp(prefix='fastsurfer-bench-')
+        self.fastsurfer_dir = os.path.join(self.root, 'FastSurfer')
+        os.makedirs(self.fastsurfer_dir)
+        stub = os.path.join(self.fastsurfer_dir, 'run_fastsurfer.sh')
+        shutil.copy(STUB, stub)
+        os.chmod(stub, os.stat(stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        self.inputdir = os.path.join(self.root, 'in')
+        os.makedirs(self.inputdir)
+        volume = nifti1_bytes(t1_edge)
+        for i in range(subjects):
+            with gzip.open(os.path.join(self.inputdir, 'sub-%03d.nii.gz' % i), 'wb',
+                           compresslevel=1) as f:
+                # make every subject distinct so that they hash differently
+                f.write(volume[:-8] + struct.pack('<q', i))
+        self.t1s = sorted(os.path.join(self.inputdir, name) for name in os.listdir(self.inputdir))
+
+    def outputdir(self, name):
+        path = os.path.join(self.root, name)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        return path
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+
+def timings(fn, repeat):
+    """
+    Call <fn> <repeat> times and return min/median/mean of the durations.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return {'min': durations[0], 'median': durations[len(durations) // 2],
+            'mean': sum(durations) / len(durations), 'repeat': repeat}
+
+
+def run_plugin(ws, args, env=None):
+    subprocess.check_call([sys.executable, PLUGIN] + args, cwd=ws.root, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bench_startup(ws, config):
+    """
+    Wall time of plugin invocations that only describe the plugin.
+    """
+    results = {}
+    for flag in ('--version', '--json', '--meta'):
+        results[flag.lstrip('-')] = timings(lambda: run_plugin(ws, [flag]), config.repeat)
+    return results
+
+
+def bench_command_construction(ws, config):
+    """
+    Time to derive the run_fastsurfer.sh command line of one subject.
+    """
+    app = Fastsurfer()
+    options = app.parse_args(['--multi_subject', '--parallel', '--threads', '4',
+                              ws.inputdir, ws.root])
+    app.tuned_options = {}
+    job = SubjectJob('sub-000', ws.t1s[0])
+    iterations = 2000
+
+    def build():
+        for _ in range(iterations):
+            app.build_fastsurfer_argv(app.get_fastsurfer_options(options, job, ws.root))
+
+    result = timings(build, config.repeat)
+    result['per_command'] = result['median'] / iterations
+    return result
+
+
+def bench_scheduling(ws, config):
+    """
+    Throughput of complete plugin runs over all simulated subjects, compared
+    with the ideal makespan of the stub stages on the chosen worker count.
+    """
+    env = dict(os.environ, STUB_SEG_SECONDS=str(config.seg_seconds),
+               STUB_SURF_SECONDS=str(config.surf_seconds), STUB_OUTPUT_SCALE=str(config.scale))
+    workers = str(config.workers)
+    modes = {
+        'batch': ['--max_workers', workers],
+        'batch_unmonitored': ['--max_workers', workers, '--monitor_interval', '0'],
+        'pipeline': ['--pipeline', '--surf_workers', workers],
+    }
+    subjects = len(ws.t1s)
+    results = {}
+    for mode, args in sorted(modes.items()):
+        outputdir = ws.outputdir('out-%s' % mode)
+        start = time.perf_counter()
+        run_plugin(ws, ['--multi_subject'] + args + [ws.inputdir, outputdir], env)
+        wall = time.perf_counter() - start
+        ideal = subjects * (config.seg_seconds + config.surf_seconds) / config.workers
+        results[mode] = {'wall': wall, 'subjects': subjects,
+                         'subjects_per_second': subjects / wall,
+                         'overhead_per_subject': max(0.0, wall - ideal) / subjects}
+    return results
+
+
+def make_subject(ws, config, name):
+    env = dict(os.environ, STUB_SEG_SECONDS='0', STUB_SURF_SECONDS='0',
+               STUB_OUTPUT_SCALE=str(config.scale))
+    sd = os.path.join(ws.root, 'subjects')
+    subprocess.check_call([sys.executable, STUB, '--sid', name, '--sd', sd, '--t1', ws.t1s[0]],
+                          env=env)
+    return os.path.join(sd, name)
+
+
+def bench_cache(ws, config):
+    """
+    Cost of computing a cache key, storing a subject and restoring a hit.
+    """
+    subject_dir = make_subject(ws, config, 'cached')
+    cache = result_cache.ResultCache(os.path.join(ws.root, 'cache'))
+    weights = ws.t1s[1:4]
+    restored = os.path.join(ws.root, 'restored')
+    # the typed options the plugin keys a --order 1 run with
+    values = {option.name: option.unset for option in run_options.RUN_OPTIONS}
+    values.update(sid='bench', t1=ws.t1s[0], order=1)
+    options = {name: value for name, value in run_options.select(values).items()
+               if name not in CACHE_IGNORED_ARGS}
+
+    def key():
+        cache.digests.digests.clear()
+        return cache.key('bench', ws.t1s[0], options, weights)
+
+    def store():
+        shutil.rmtree(cache.root)
+        cache.__init__(cache.root)
+        cache.store('bench', subject_dir)
+
+    results = {'key': timings(key, config.repeat), 'store': timings(store, config.repeat),
+               'bytes': result_cache.tree_size(subject_dir)}
+    for mode, hardlink in (('restore_copy', False), ('restore_hardlink', True)):
+        results[mode] = timings(lambda: cache.restore('bench', restored, hardlink), config.repeat)
+    return results
+
+
+def bench_staging(ws, config):
+    """
+    Cost of moving a T1 and a subject directory between storage locations.
+    """
+    subject_dir = make_subject(ws, config, 'staged')
+    scratch = os.path.join(ws.root, 'scratch')
+
+    def decompress():
+        with gzip.open(ws.t1s[0], 'rb') as src, open(os.path.join(ws.root, 't1.nii'), 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    def copy_tree():
+        if os.path.exists(scratch):
+            shutil.rmtree(scratch)
+        shutil.copytree(subject_dir, scratch)
+
+    return {'decompress_t1': timings(decompress, config.repeat),
+            'copy_subject': timings(copy_tree, config.repeat),
+            'stage_out': timings(lambda: io_staging.stage_out(subject_dir, scratch),
+                                 config.repeat),
+            'stage_out_compressed': timings(
+                lambda: io_staging.stage_out(subject_dir, scratch, compress=True), config.repeat),
+            'files': sum(len(files) for _, _, files in os.walk(subject_dir)),
+            'bytes': result_cache.tree_size(subject_dir)}
+
+
+BENCHMARKS = [
+    ('startup', bench_startup),
+    ('command_construction', bench_command_construction),
+    ('scheduling', bench_scheduling),
+    ('cache', bench_cache),
+    ('staging', bench_staging),
+]
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, '%s%s.' % (prefix, name)))
+        elif isinstance(value, float):
+            flat[prefix + name] = value
+    return flat
+
+
+def compare(current, previous):
+    """
+    Print the relative change of every timing between two result files.
+    """
+    new, old = flatten(current['results']), flatten(previous['results'])
+    for metric in sorted(set(new) & set(old)):
+        if old[metric]:
+            print('%-55s %12.6f %12.6f %+8.1f%%'
+                  % (metric, old[metric], new[metric], 100.0 * (new[metric] / old[metric] - 1)))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the fastsurfer plugin orchestration')
+    parser.add_argument('--output', default='bench_results.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('--compare', help='previous JSON result file to compare against')
+    parser.add_argument('--only', nargs='+', choices=[name for name, _ in BENCHMARKS],
+                        help='run only these benchmarks')
+    parser.add_argument('--subjects', type=int, default=8, help='number of simulated subjects')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent simulated subjects')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of each timing')
+    parser.add_argument('--seg_seconds', type=float, default=0.2,
+                        help='duration of the stub segmentation stage')
+    parser.add_argument('--surf_seconds', type=float, default=0.4,
+                        help='duration of the stub recon-surf stage')
+    parser.add_argument('--scale', type=float, default=0.05,
+                        help='scale of the stub output sizes relative to a real subject')
+    parser.add_argument('--t1_edge', type=int, default=128,
+                        help='edge length in voxels of the synthetic T1 volumes')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    config = parse_args(argv)
+    ws = Workspace(max(4, config.subjects), config.t1_edge)
+    results = {}
+    try:
+        for name, bench in BENCHMARKS:
+            if config.only and name not in config.only:
+                continue
+            print('running %s ...' % name)
+            results[name] = bench(ws, config)
+    finally:
+        ws.cleanup()
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'cpus': os.cpu_count(), 'config': vars(config), 'results': results}
+    with open(config.output, 'w') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+    print('results written to %s' % config.output)
+    if config.compare:
+        with open(config.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Stand-in for FastSurfer's run_fastsurfer.sh used by the plugin benchmarks.
+#
+# It accepts the run_fastsurfer.sh command line, spends a configurable time
+# per stage (sleeping or burning CPU) and writes a synthetic subject
+# directory with realistic file names, sizes and log markers. Configuration
+# is read from the environment:
+#
+#   STUB_SEG_SECONDS     duration of the segmentation stage     (default 0.1)
+#   STUB_SURF_SECONDS    duration of the recon-surf stage       (default 0.2)
+#   STUB_CPU_FRACTION    share of each stage spent burning CPU  (default 0.5)
+#   STUB_OUTPUT_SCALE    scale factor of the output file sizes  (default 0.01)
+#   STUB_EXIT_CODE       exit code to return                    (default 0)
+#
+
+
+import os
+import sys
+import time
+
+
+MIB = 1024 * 1024
+
+# subject directory content of a FastSurfer run with its approximate sizes
+SEG_OUTPUTS = [
+    ('mri/aparc.DKTatlas+aseg.deep.mgz', 1 * MIB),
+    ('mri/orig.mgz', 9 * MIB),
+]
+SURF_OUTPUTS = [
+    ('mri/aseg.auto.mgz', 1 * MIB),
+    ('mri/aparc.DKTatlas+aseg.deep.withCC.mgz', 1 * MIB),
+    ('mri/norm.mgz', 9 * MIB),
+    ('mri/brainmask.mgz', 6 * MIB),
+    ('stats/aseg.stats', 8 * 1024),
+    ('stats/lh.aparc.DKTatlas.mapped.stats', 6 * 1024),
+    ('stats/rh.aparc.DKTatlas.mapped.stats', 6 * 1024),
+]
+for hemi in ('lh', 'rh'):
+    for surf, size in (('white', 5), ('pial', 5), ('orig', 5), ('inflated', 5),
+                       ('sphere', 5), ('smoothwm', 5)):
+        SURF_OUTPUTS.append(('surf/%s.%s' % (hemi, surf), size * MIB))
+    for measure in ('thickness', 'curv', 'area', 'sulc'):
+        SURF_OUTPUTS.append(('surf/%s.%s' % (hemi, measure), MIB // 2))
+    SURF_OUTPUTS.append(('label/%s.aparc.DKTatlas.mapped.annot' % hemi, MIB // 2))
+
+FLAGS = {'--seg_only', '--surf_only', '--seg_with_cc_only', '--clean_seg', '--no_cuda',
+         '--vol_segstats', '--fstess', '--fsqsphere', '--fsaparc', '--surfreg', '--parallel',
+         '--help'}
+
+
+def parse_args(argv):
+    args = {}
+    i = 0
+    while i < len(argv):
+        flag = argv[i]
+        if flag in FLAGS or i + 1 == len(argv) or argv[i + 1].startswith('--'):
+            args[flag[2:]] = True
+            i += 1
+        else:
+            args[flag[2:]] = argv[i + 1]
+            i += 2
+    return args
+
+
+def spend(seconds, cpu_fraction):
+    deadline = time.time() + seconds * cpu_fraction
+    x = 0
+    while time.time() < deadline:
+        x += sum(range(1000))
+    time.sleep(seconds * (1 - cpu_fraction))
+
+
+def write_outputs(subject_dir, outputs, scale):
+    block = os.urandom(64 * 1024)
+    for relpath, size in outputs:
+        path = os.path.join(subject_dir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        remaining = max(1, int(size * scale))
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                f.write(block[:remaining])
+                remaining -= len(block)
+
+
+def log(path, line):
+    # run_fastsurfer.sh tees its logs to stdout
+    print(line, flush=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(line + '\n')
+
+
+def main(argv):
+    args = parse_args(argv)
+    if args.get('help'):
+        print('stub run_fastsurfer.sh')
+        return 0
+    seg_seconds = float(os.environ.get('STUB_SEG_SECONDS', '0.1'))
+    surf_seconds = float(os.environ.get('STUB_SURF_SECONDS', '0.2'))
+    cpu_fraction = float(os.environ.get('STUB_CPU_FRACTION', '0.5'))
+    scale = float(os.environ.get('STUB_OUTPUT_SCALE', '0.01'))
+
+    subject_dir = os.path.join(args['sd'], args['sid'])
+    seg_log = args.get('seg_log', os.path.join(subject_dir, 'scripts', 'deep-seg.log'))
+    surf_log = os.path.join(subject_dir, 'scripts', 'recon-surf.log')
+
+    if not args.get('surf_only'):
+        for view in ('Sagittal', 'Axial', 'Coronal'):
+            log(seg_log, 'Evaluating %s network' % view)
+            spend(seg_seconds / 3, cpu_fraction)
+        write_outputs(subject_dir, SEG_OUTPUTS, scale)
+    if not args.get('seg_only'):
+        for section in ('Creating orig and rawavg from input', 'Creating surfaces lh',
+                        'Creating surfaces rh', 'Computing stats'):
+            log(surf_log, '================= %s =================' % section)
+            spend(surf_seconds / 4, cpu_fraction)
+        write_outputs(subject_dir, SURF_OUTPUTS, scale)
+    return int(os.environ.get('STUB_EXIT_CODE', '0'))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,194 @@
+#
+# fastsurfer ds ChRIS plugin app -- core budgeting across concurrent subjects
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import os
+import re
+import threading
+from collections import OrderedDict
+
+
+# recon-surf --parallel runs every hemisphere from its own command file,
+# e.g. 'bash <sd>/<sid>/scripts/lh.processing.cmdf'
+HEMISPHERE_SCRIPT = re.compile(r'\b([lr]h)\.processing\.cmdf\b')
+
+
+def usable_cores(count=None):
+    """
+    Return the sorted ids of the cores this process may run on, limited to
+    the first <count> (e.g. the cgroup CPU quota) if given.
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    return cores[:count] if count else cores
+
+
+def read_cmdline(pid):
+    """
+    Return the command line of process <pid>, '' if it is gone.
+    """
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return f.read().replace(b'\0', b' ').decode(errors='replace')
+    except (IOError, OSError):
+        return ''
+
+
+def thread_env(threads):
+    """
+    Return the environment variables limiting the threads of OpenMP (PyTorch,
+    FreeSurfer) and ITK to <threads>.
+    """
+    return {'OMP_NUM_THREADS': str(threads),
+            'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(threads)}
+
+
+def partition(cores, demands):
+    """
+    Split the list <cores> into contiguous blocks proportional to the demands
+    of the ordered list of (name, demand) <demands>, at least one core each.
+    With more demands than cores, cores are shared round-robin. Return a dict
+    mapping every name to its list of cores.
+    """
+    if not demands:
+        return {}
+    if len(demands) >= len(cores):
+        return {name: [cores[i % len(cores)]] for i, (name, _) in enumerate(demands)}
+    total = float(sum(max(1, demand) for _, demand in demands))
+    exact = [len(cores) * max(1, demand) / total for _, demand in demands]
+    shares = [max(1, int(share)) for share in exact]
+    while sum(shares) > len(cores):
+        shares[shares.index(max(shares))] -= 1
+    while sum(shares) < len(cores):
+        remainders = [share - given for share, given in zip(exact, shares)]
+        shares[remainders.index(max(remainders))] += 1
+    blocks = {}
+    start = 0
+    for (name, _), share in zip(demands, shares):
+        blocks[name] = cores[start:start + share]
+        start += share
+    return blocks
+
+
+class Tenant(object):
+    """
+    A running FastSurfer process tree whose processes run <threads> threads
+    each, on one lane or one per hemisphere.
+    """
+    def __init__(self, pid, threads):
+        self.pid = pid
+        self.threads = threads
+        self.lanes = {}
+        self.cores = []
+
+    @property
+    def demand(self):
+        return self.threads * max(1, len(self.lanes))
+
+
+class CoreScheduler(object):
+    """
+    Budget <cores> across all concurrently running FastSurfer process trees.
+
+    Every registered tree gets a block of cores proportional to its demand
+    (threads per process times running hemispheres) as CPU affinity of all
+    its processes, and every running hemisphere its own part of that block.
+    The trees are rescanned every <interval> seconds, so that the cores of a
+    finished hemisphere or subject go to the trees still running.
+    """
+    def __init__(self, cores, process_tree, interval=2.0, set_affinity=os.sched_setaffinity,
+                 read_cmdline=read_cmdline):
+        self.cores = list(cores)
+        self.process_tree = process_tree
+        self.interval = interval
+        self.set_affinity = set_affinity
+        self.read_cmdline = read_cmdline
+        self.tenants = OrderedDict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def threads_per_process(self, workers, parallel=False):
+        """
+        Return the threads of a process when <workers> subjects (with two
+        hemispheres each if <parallel>) share the cores.
+        """
+        return max(1, len(self.cores) // max(1, workers) // (2 if parallel else 1))
+
+    def register(self, tag, pid, threads):
+        """
+        Start budgeting the process tree of <pid>, running <threads> threads
+        per process, under <tag>.
+        """
+        with self.lock:
+            self.tenants[tag] = Tenant(pid, threads)
+            self.update()
+
+    def unregister(self, tag):
+        """
+        Hand the cores of <tag> to the remaining process trees.
+        """
+        with self.lock:
+            self.tenants.pop(tag, None)
+            self.update()
+
+    def allocation(self):
+        """
+        Return a dict mapping every tag to its cores.
+        """
+        with self.lock:
+            return {tag: list(tenant.cores) for tag, tenant in self.tenants.items()}
+
+    def scan(self, tenant):
+        """
+        Return the pids of the tree of <tenant> and a dict mapping each running
+        hemisphere to the pids of its lane.
+        """
+        pids = self.process_tree(tenant.pid)
+        lanes = {}
+        for pid in pids:
+            match = HEMISPHERE_SCRIPT.search(self.read_cmdline(pid))
+            if match and match.group(1) not in lanes:
+                lanes[match.group(1)] = self.process_tree(pid)
+        return pids, lanes
+
+    def update(self):
+        """
+        Rescan all trees and apply the resulting core blocks. Must be called
+        with the lock held.
+        """
+        trees = {}
+        for tag, tenant in self.tenants.items():
+            trees[tag], tenant.lanes = self.scan(tenant)
+        blocks = partition(self.cores, [(tag, tenant.demand)
+                                        for tag, tenant in self.tenants.items()])
+        for tag, tenant in self.tenants.items():
+            tenant.cores = blocks[tag]
+            affinity = {pid: tenant.cores for pid in trees[tag]}
+            if len(tenant.lanes) > 1:
+                lane_blocks = partition(tenant.cores, sorted((hemi, tenant.threads)
+                                                             for hemi in tenant.lanes))
+                for hemi, pids in tenant.lanes.items():
+                    affinity.update((pid, lane_blocks[hemi]) for pid in pids)
+            for pid, cores in affinity.items():
+                try:
+                    self.set_affinity(pid, cores)
+                except (OSError, ValueError):
+                    # the process is gone
+                    pass
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                self.update()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
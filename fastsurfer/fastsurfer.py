@@ -12,11 +12,80 @@
 
 import os
 import sys
-sys.path.append(os.path.dirname(__file__))
+SELFDIR = os.path.dirname(os.path.abspath(__file__))
+if __name__ == "__main__" and sys.path and os.path.abspath(sys.path[0]) == SELFDIR:
+    # this script would shadow the fastsurfer package under its own name:
+    # import the package from the parent directory in the source tree, else
+    # from where it is installed (the script being in bin/)
+    if os.path.isfile(os.path.join(SELFDIR, '__init__.py')):
+        sys.path[0] = os.path.dirname(SELFDIR)
+    else:
+        del sys.path[0]
+
+if __name__ == "__main__":
+    # serve --json/--savejson/--meta/--man/--version from the descriptor
+    # generated at build time, before importing the ChRIS app framework
+    try:
+        from fastsurfer import plugin_descriptor
+    except ImportError:
+        plugin_descriptor = None
+    if plugin_descriptor is not None and plugin_descriptor.serve(sys.argv[1:]):
+        sys.exit(0)
+
+import json
+import shutil
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # import the Chris app superclass
 from chrisapp.base import ChrisApp
 
+from fastsurfer import core_pinning
+from fastsurfer import file_util
+from fastsurfer import incremental_run
+from fastsurfer import input_preflight
+from fastsurfer import io_staging
+from fastsurfer import log_stream
+from fastsurfer import memory_admission
+from fastsurfer import output_package
+from fastsurfer import progress_metrics
+from fastsurfer import resource_monitor
+from fastsurfer import resource_tuning
+from fastsurfer import result_cache
+from fastsurfer import run_options
+from fastsurfer import seg_worker
+from fastsurfer import stage_checkpoint
+from fastsurfer import stage_pipeline
+from fastsurfer import stats_table
+from fastsurfer import subject_batch
+from fastsurfer import volume_header
+
+
+# checkpoints used by run_fastsurfer.sh when no --weights_* option is given,
+# relative to the FastSurfer directory
+DEFAULT_WEIGHTS = {
+    'weights_sag': 'checkpoints/Sagittal_Weights_FastSurferCNN/ckpts/Epoch_30_training_state.pkl',
+    'weights_ax':  'checkpoints/Axial_Weights_FastSurferCNN/ckpts/Epoch_30_training_state.pkl',
+    'weights_cor': 'checkpoints/Coronal_Weights_FastSurferCNN/ckpts/Epoch_30_training_state.pkl',
+}
+
+# FastSurferCNN/eval.py options corresponding to run_fastsurfer.sh options
+EVAL_ARGS = {
+    't1':          '--in_name',
+    'seg':         '--out_name',
+    'order':       '--order',
+    'weights_sag': '--network_sagittal_path',
+    'weights_ax':  '--network_axial_path',
+    'weights_cor': '--network_coronal_path',
+    'batch':       '--batch_size',
+    'clean_seg':   '--clean',
+    'no_cuda':     '--no_cuda',
+}
+
+# run_fastsurfer.sh options that do not change the content of the results
+CACHE_IGNORED_ARGS = {'sid', 'sd', 't1', 'seg_log', 'fs_license', 'py', 'threads', 'parallel', 'batch'}
+
 
 Gstr_title = """
 
@@ -56,22 +125,49 @@ where necessary.)
             [--weights_sag <weights_sag>]                  \\
             [--weights_ax <weights_ax>]                    \\
             [--weights_cor <weights_cor>]                  \\
-            [--clean_seg <clean_seg>]                      \\
-            [--no_cuda <no_cuda>]                          \\
+            [--clean_seg]                                  \\
+            [--no_cuda]                                    \\
             [--batch <batch>]                              \\
             [--order <order>]                              \\
-            [--seg_only <seg_only>]                        \\
-            [--seg_with_cc_only <seg_with_cc_only>]        \\
-            [--surf_only <surf_only>]                      \\
-            [--vol_segstats <vol_segstats>]                \\
-            [--fstess <fstess>]                            \\
-            [--fsqsphere <fsqsphere>]                      \\
-            [--fsaparc <fsaparc>]                          \\
-            [--surfreg <surfreg>]                          \\
-            [--parallel <parallel>]                        \\
+            [--seg_only]                                   \\
+            [--seg_with_cc_only]                           \\
+            [--surf_only]                                  \\
+            [--vol_segstats]                               \\
+            [--fstess]                                     \\
+            [--fsqsphere]                                  \\
+            [--fsaparc]                                    \\
+            [--surfreg]                                    \\
+            [--parallel]                                   \\
             [--threads <threads>]                          \\
             [--py <py>]                                    \\
-            [--fs_help <fs_help>]                          \\
+            [--fs_help]                                    \\
+            [--multi_subject]                              \\
+            [--max_workers <max_workers>]                  \\
+            [--pipeline]                                   \\
+            [--seg_workers <seg_workers>]                  \\
+            [--surf_workers <surf_workers>]                \\
+            [--cache_dir <cache_dir>]                      \\
+            [--cache_max_gb <cache_max_gb>]                \\
+            [--cache_hardlink]                             \\
+            [--resume]                                     \\
+            [--monitor_interval <monitor_interval>]        \\
+            [--auto_tune]                                  \\
+            [--progress_only]                              \\
+            [--scratch_dir <scratch_dir>]                  \\
+            [--stage_compress]                             \\
+            [--warm_seg]                                   \\
+            [--mmap_weights]                               \\
+            [--pin_cores]                                  \\
+            [--admission]                                  \\
+            [--memory_db <memory_db>]                      \\
+            [--preflight]                                  \\
+            [--incremental]                                \\
+            [--package <profiles>]                         \\
+            [--package_prune]                              \\
+            [--stats_table]                                \\
+            [--metrics_file <metrics_file>]                \\
+            [--metrics_port <metrics_port>]                \\
+            [--metrics_address <metrics_address>]          \\
             <inputDir>                                     \\
             <outputDir> 
 
@@ -143,11 +239,11 @@ where necessary.)
         [--no_cuda]
         Flag to disable CUDA usage in FastSurferCNN (no GPU usage, inference on CPU).
 
-        [--batch]
-        Batch size for inference. Default: 8.
+        [--batch <batch>]
+        Batch size for inference. Default: 0, the run_fastsurfer.sh default of 8.
 
-        [--order]
-        Order of interpolation for mri_convert T1 before segmentation (0=nearest,1=linear(default),2=quadratic,3=cubic)
+        [--order <order>]
+        Order of interpolation for mri_convert T1 before segmentation (0=nearest,1=linear,2=quadratic,3=cubic). Default: -1, the run_fastsurfer.sh default (linear).
 
         [--seg_only]
         Run only FastSurferCNN (generate segmentation, do not run surface pipeline)
@@ -156,7 +252,7 @@ where necessary.)
         Run FastSurferCNN (generate segmentation) and recon_surf until corpus callosum (CC) is added in (no surface models will be created in this case!)
 
         [--surf_only]
-        Run surface pipeline only. The segmentation input has to exist already in this case.
+        Run surface pipeline only. The segmentation input has to exist already in this case. Cannot be combined with --seg_only or --seg_with_cc_only.
 
         [--vol_segstats]
         Additionally return volume-based aparc.DKTatlas+aseg statistics for DL-based segmentation (does not require surfaces). Can be used in combination with --seg_only in which case recon-surf only runs till CC is added (akin to --seg_with_cc_only).
@@ -176,8 +272,8 @@ where necessary.)
         [--parallel]
         Run both hemispheres in parallel
 
-        [--threads]
-        Set openMP and ITK threads to <int>Name of sample weights tensor for loss
+        [--threads <threads>]
+        Set openMP and ITK threads to <int>. Default: 0, the run_fastsurfer.sh default of 1.
 
         [--py]
         Command for python, default python3.6
@@ -185,6 +281,208 @@ where necessary.)
         [--fs_help]
         Print FastSurfer help
 
+        [--multi_subject]
+        Process every T1 volume (*.nii.gz, *.nii, *.mgz) found below <inputDir>
+        as a separate subject. The subject ID is derived from the path of the
+        volume relative to <inputDir>; --t1 and --sid are ignored. Per-subject
+        exit codes are written to <outputDir>/fastsurfer_batch.json.
+
+        [--max_workers <max_workers>]
+        Maximum number of subjects processed concurrently in --multi_subject
+        mode. Default 0: derive the pool size from the available cores and memory.
+
+        [--pipeline]
+        Run each subject as two separate stages, FastSurferCNN segmentation
+        (run_fastsurfer.sh --seg_only) followed by recon-surf
+        (run_fastsurfer.sh --surf_only), and overlap the stages across
+        subjects: while one subject is in recon-surf the next one is already
+        segmenting. Cannot be combined with --seg_only, --surf_only or
+        --seg_with_cc_only.
+
+        [--seg_workers <seg_workers>]
+        Number of concurrent segmentations in --pipeline mode, and of
+        FastSurferCNN worker processes with --warm_seg. Default: 1, as
+        FastSurferCNN already uses all cores.
+
+        [--surf_workers <surf_workers>]
+        Number of concurrent recon-surf runs in --pipeline mode. Default 0:
+        derive from the available cores and memory (capped by --max_workers).
+
+        [--cache_dir <cache_dir>]
+        Directory of an on-disk cache of finished subject directories. A subject
+        is looked up by the hash of its T1 contents, the result-relevant options
+        and the checkpoint files; a hit is restored into --sd without running
+        FastSurfer, a successful run is added to the cache. Cache statistics are
+        written to <outputDir>/fastsurfer_cache.json. Default: no cache.
+
+        [--cache_max_gb <cache_max_gb>]
+        Size cap of the cache in GB; least recently used entries are evicted
+        beyond it. Default 0: unlimited.
+
+        [--cache_hardlink]
+        Restore cache hits by hardlinking instead of copying. Faster, but the
+        restored files share storage with the cache and must not be modified in
+        place.
+
+        [--resume]
+        Record the completed pipeline stages (segmentation, CC, each
+        hemisphere's surfaces, stats) with the checksums of their outputs in
+        $SUBJECTS_DIR/$sid/scripts/plugin_stages.json. When the plugin is run
+        again on the same subject, completed stages are detected from that
+        manifest: a subject with all stages complete is skipped, and a subject
+        whose segmentation is complete resumes with recon-surf (--surf_only).
+
+        [--monitor_interval <monitor_interval>]
+        Interval in seconds at which the wall time, CPU time, resident memory
+        and I/O bytes of every FastSurfer process tree are sampled. The run is
+        split into stages announced in the FastSurferCNN log (--seg_log) and
+        the recon-surf log. The report is written to
+        <outputDir>/fastsurfer_resources.json. Default: 1.0, 0 disables.
+
+        [--auto_tune]
+        Choose --threads, --parallel and --batch (unless given explicitly) for
+        every subject from the cores and memory available to the container
+        (cgroup CPU quota and memory limit included), the number of concurrent
+        subjects and the dimensions of the input volume. The decisions are
+        logged and recorded in <outputDir>/fastsurfer_batch.json.
+
+        [--progress_only]
+        Only print progress events (stage started/finished, hemisphere
+        progress, exit codes) to the console. The complete output of every
+        subject is always written to rotating log files
+        <outputDir>/logs/<sid>.log, and its progress events to
+        <outputDir>/logs/<sid>.events.jsonl.
+
+        [--scratch_dir <scratch_dir>]
+        Node-local directory in which subjects are processed instead of --sd
+        (or <outputDir>), e.g. /tmp. Every T1 is copied there once, gzip
+        compressed .nii.gz and .mgz volumes are decompressed on the way, and
+        each finished (or failed) subject directory is transferred back in
+        one bulk pass, verified against sha256 checksums recorded in
+        <sid>/scripts/plugin_checksums.sha256. Default: process in place.
+
+        [--stage_compress]
+        With --scratch_dir, transfer every subject back as a single
+        <sid>.tar.gz archive instead of a directory. Cannot be combined with
+        --resume.
+
+        [--warm_seg]
+        Segment all subjects in one persistent FastSurferCNN process started
+        with the --py interpreter, which imports PyTorch and loads the three
+        view checkpoints only once, instead of a new process per subject.
+        Segmentations are written to the usual --seg location and the
+        surface stage is run by run_fastsurfer.sh --surf_only as usual. The
+        worker's own output goes to <outputDir>/logs/seg_worker.log. Cannot
+        be combined with --surf_only, --seg_with_cc_only or with --seg_only
+        --vol_segstats.
+
+        [--mmap_weights]
+        With --warm_seg, convert the --weights_* checkpoints once into
+        memory-mapped weight stores (network weights only, cached in a
+        .weight_store directory next to each checkpoint and keyed by its
+        sha256) and point the networks of every worker at them, so that all
+        --seg_workers share a single physical copy of the weights.
+
+        [--pin_cores]
+        Budget the cores of the container across all concurrently running
+        subjects and hemispheres: every FastSurfer process tree is pinned
+        (CPU affinity) to its own block of cores, sized by its threads and
+        running hemispheres, and started with OMP_NUM_THREADS and
+        ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS set to its threads. Subjects
+        not given --threads get their share of the cores. The blocks are
+        recomputed every few seconds, so the cores of a finished hemisphere
+        or subject go to those still running.
+
+        [--admission]
+        Start a subject (or a --pipeline stage of it) only once its predicted
+        peak memory fits, next to the predicted peaks of the runs already
+        going, under the memory available to the container (cgroup memory
+        limit included); runs that do not fit are queued in order. The peak
+        of every stage is predicted from the input volume size by a model
+        fitted to the peaks measured in previous runs (--monitor_interval
+        must not be 0 for the model to learn), and estimated from the input
+        size, --batch and --parallel until a stage has been measured. A run
+        is always started when nothing else is running.
+
+        [--memory_db <memory_db>]
+        SQLite database in which --admission keeps the measured peak memory
+        of every stage across plugin runs. Default:
+        <cache_dir>/fastsurfer_memory.sqlite with --cache_dir, else
+        <outputDir>/fastsurfer_memory.sqlite.
+
+        [--preflight]
+        Before launching anything, read the headers of all T1 volumes in
+        parallel (without decompressing their voxel data) and reject the
+        subjects whose volume is not a single 3D frame of 1 mm isotropic
+        voxels with a known orientation, or is truncated (plain files by
+        their size, gzipped files by the size recorded in their gzip
+        trailer). Unless --seg_only is given, --fs_license must be a
+        readable, non-empty file. Headers, sizes and sha256 checksums are
+        kept in <cache_dir>/fastsurfer_inputs.json with --cache_dir (else
+        <outputDir>/fastsurfer_inputs.json) and only re-read for changed
+        files. The subjects that pass are started largest input first, and
+        the findings are recorded in <outputDir>/fastsurfer_batch.json.
+
+        [--incremental]
+        Record the options (those that change the results) and the sha256 of
+        the T1 and the checkpoints of every successful run in
+        $SUBJECTS_DIR/$sid/scripts/plugin_options.json, and the completed
+        stages as with --resume. When the plugin is run again on the same
+        subject, only what the requested options change is run: nothing if
+        the outputs are complete and up to date, recon-surf up to the CC to
+        add --vol_segstats, recon-surf on the existing segmentation
+        (--surf_only) to add --fsaparc or --surfreg or after changing
+        --fstess or --fsqsphere, and the whole pipeline after a change of
+        the inputs or of the segmentation options. The decision and its
+        reasons are recorded in <outputDir>/fastsurfer_batch.json. Cannot
+        be combined with --stage_compress.
+
+        [--package <profiles>]
+        After the batch, pack the outputs of the successful subjects selected
+        by the comma-separated <profiles> into a few uncompressed tar archives
+        <outputDir>/fastsurfer_outputs.NNN.tar of about 1 GiB each. The
+        profiles are 'seg' (the conformed T1, mask and segmentations), 'stats'
+        (stats/*.stats), 'surfaces' (surf/ and the label/ annotations) and
+        'full' (every file). Every file is a member <sid>/<path>, gzip
+        compressed into <sid>/<path>.gz unless it already is. The index
+        <outputDir>/fastsurfer_outputs.index.json lists the archive, data
+        offset, length, size and sha256 of every file, so that a single one
+        can be read without extracting the archive. Cannot be combined with
+        --stage_compress.
+
+        [--package_prune]
+        Remove the subject directories once they are packed by --package.
+
+        [--stats_table]
+        Collect the measures and the per-structure volumes, areas and
+        thicknesses of the stats/*.stats files of every subject into the
+        cohort table <outputDir>/fastsurfer_stats.csv, one row per subject,
+        and the same table as one numpy array per column in
+        <outputDir>/fastsurfer_stats.npz. The table is updated as every
+        subject finishes and, after the batch, with the other subjects found
+        in the subjects directory, parsed in parallel processes. The parsed
+        values are kept in <outputDir>/fastsurfer_stats.json so that only
+        new or changed subjects are parsed again.
+
+        [--metrics_file <metrics_file>]
+        Rewrite the progress metrics of the batch every 10 seconds to
+        <metrics_file> (relative to <outputDir>) in the Prometheus text
+        format, e.g. for the textfile collector of the node exporter. The
+        metrics are the subjects queued, running, done and failed, the
+        current stage of every running subject, the mean duration of the
+        recent runs of every stage and subject, the cores and memory used by
+        the plugin and its FastSurfer processes against those available, the
+        time of the last progress (to detect stalls) and the projected
+        completion time.
+
+        [--metrics_port <metrics_port>]
+        Serve the same metrics on http://<metrics_address>:<metrics_port>/metrics
+        while the batch runs. 0 (the default) serves none.
+
+        [--metrics_address <metrics_address>]
+        The address the metrics are served on, 127.0.0.1 by default. Use
+        0.0.0.0 to scrape them from outside the container.
+
 """
 
 
@@ -226,6 +524,9 @@ class Fastsurfer(ChrisApp):
     # output directory.
     OUTPUT_META_DICT = {}
 
+    # exit code of the plugin, set by run()
+    returncode = 0
+
     def define_parameters(self):
         """
         Define the CLI arguments accepted by this plugin app.
@@ -236,175 +537,364 @@ class Fastsurfer(ChrisApp):
                           type      = str,
                           optional  = True, 
                           help      = 'Path to FreeSurfer license key file. Register (for free) at https://surfer.nmr.mgh.harvard.edu/registration.html to obtain it if you do not have FreeSurfer installed so far.',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--sid',
                           dest      = 'sid',
                           type      = str,
-                          optional  = False,
+                          optional  = True,
                           help      = 'Subject ID for directory inside \$SUBJECTS_DIR to be created.',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--sd',
                           dest      = 'sd',
                           type      = str,
-                          optional  = False,
+                          optional  = True,
                           help      = 'Output directory \$SUBJECTS_DIR (pass via environment or here).',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--t1',
                           dest      = 't1',
                           type      = str,
-                          optional  = False,
+                          optional  = True,
                           help      = 'T1 full head input (not bias corrected).',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--seg',
                           dest      = 'seg',
                           type      = str,
                           optional  = True,
                           help      = 'Name of intermediate DL-based segmentation file (similar to aparc+aseg). Requires an ABSOLUTE Path! Default location: \$SUBJECTS_DIR/\$sid/mri/aparc.DKTatlas+aseg.deep.mgz.',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--seg_log',
                           dest      = 'seg_log',
                           type      = str,
                           optional  = True,
                           help      = 'Log-file for the segmentation (FastSurferCNN). Default: \$SUBJECTS_DIR/\$sid/scripts/deep-seg.log',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--weights_sag',
                           dest      = 'weights_sag',
                           type      = str,
                           optional  = True,
                           help      = 'Pretrained weights of sagittal network. Default: ../checkpoints/Sagittal_Weights_FastSurferCNN/ckpts/Epoch_30_training_state.pkl',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--weights_ax',
                           dest      = 'weights_ax',
                           type      = str,
                           optional  = True,
                           help      = 'Pretrained weights of axial network. Default: ../checkpoints/Axial_Weights_FastSurferCNN/ckpts/Epoch_30_training_state.pkl',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--weights_cor',
                           dest      = 'weights_cor',
                           type      = str,
                           optional  = True,
                           help      = 'Pretrained weights of coronal network. Default: ../checkpoints/Coronal_Weights_FastSurferCNN/ckpts/Epoch_30_training_state.pkl',
-                          default   = 'none')
+                          default   = '')
 
         self.add_argument('--clean_seg',
                           dest      = 'clean_seg',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Flag to clean up FastSurferCNN segmentation.',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--no_cuda',
                           dest      = 'no_cuda',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Flag to disable CUDA usage in FastSurferCNN (no GPU usage, inference on CPU).',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--batch',
                           dest      = 'batch',
-                          type      = str,
+                          type      = int,
                           optional  = True,
-                          help      = 'Batch size for inference. Default: 8.',
-                          default   = 'none')
+                          help      = 'Batch size for inference (0: the default of 8).',
+                          default   = 0)
 
         self.add_argument('--order',
                           dest      = 'order',
-                          type      = str,
+                          type      = int,
                           optional  = True,
-                          help      = 'Order of interpolation for mri_convert T1 before segmentation (0=nearest,1=linear(default),2=quadratic,3=cubic)',
-                          default   = 'none')
+                          help      = 'Order of interpolation for mri_convert T1 before segmentation (0=nearest,1=linear,2=quadratic,3=cubic, -1: the default, linear)',
+                          default   = -1)
 
         self.add_argument('--seg_only',
                           dest      = 'seg_only',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Run only FastSurferCNN (generate segmentation, do not run surface pipeline)',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--seg_with_cc_only',
                           dest      = 'seg_with_cc_only',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Run FastSurferCNN (generate segmentation) and recon_surf until corpus callosum (CC) is added in (no surface models will be created in this case!)',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--surf_only',
                           dest      = 'surf_only',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Run surface pipeline only. The segmentation input has to exist already in this case.',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--vol_segstats',
                           dest      = 'vol_segstats',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Additionally return volume-based aparc.DKTatlas+aseg statistics for DL-based segmentation (does not require surfaces). Can be used in combination with --seg_only in which case recon-surf only runs till CC is added (akin to --seg_with_cc_only).',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--fstess',
                           dest      = 'fstess',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Switch on mri_tesselate for surface creation (default: mri_mc)',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--fsqsphere',
                           dest      = 'fsqsphere',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Use FreeSurfer iterative inflation for qsphere (default: spectral spherical projection)',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--fsaparc',
                           dest      = 'fsaparc',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Additionally create FS aparc segmentations and ribbon. Skipped by default (--> DL prediction is used which is faster, and usually these mapped ones are fine)',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--surfreg',
                           dest      = 'surfreg',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Run Surface registration with FreeSurfer (for cross-subject correspondence)',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--parallel',
                           dest      = 'parallel',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Run both hemispheres in parallel',
-                          default   = 'none')
+                          default   = False)
 
         self.add_argument('--threads',
                           dest      = 'threads',
-                          type      = str,
+                          type      = int,
                           optional  = True,
-                          help      = 'Set openMP and ITK threads to <int>Name of sample weights tensor for loss',
-                          default   = 'none')
+                          help      = 'Set openMP and ITK threads to <int> (0: the default of 1)',
+                          default   = 0)
 
         self.add_argument('--py',
                           dest      = 'py',
                           type      = str,
                           optional  = True,
                           help      = 'Command for python, default python3.6',
-                          default   = 'none')
+                          default   = '')
         
         self.add_argument('--fs_help',
                           dest      = 'fs_help',
-                          type      = str,
+                          type      = bool,
                           optional  = True,
                           help      = 'Print FastSurfer help',
-                          default   = 'none')
+                          default   = False)
+
+        self.add_argument('--multi_subject',
+                          dest      = 'multi_subject',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Process every T1 volume found in inputdir as a separate subject',
+                          default   = False)
+
+        self.add_argument('--max_workers',
+                          dest      = 'max_workers',
+                          type      = int,
+                          optional  = True,
+                          help      = 'Maximum number of concurrent subjects in --multi_subject mode (0: derive from cores and memory)',
+                          default   = 0)
+
+        self.add_argument('--pipeline',
+                          dest      = 'pipeline',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Run segmentation and recon-surf as separate stages overlapped across subjects',
+                          default   = False)
+
+        self.add_argument('--seg_workers',
+                          dest      = 'seg_workers',
+                          type      = int,
+                          optional  = True,
+                          help      = 'Number of concurrent segmentations in --pipeline mode and of --warm_seg workers',
+                          default   = 1)
+
+        self.add_argument('--surf_workers',
+                          dest      = 'surf_workers',
+                          type      = int,
+                          optional  = True,
+                          help      = 'Number of concurrent recon-surf runs in --pipeline mode (0: derive from cores and memory)',
+                          default   = 0)
+
+        self.add_argument('--cache_dir',
+                          dest      = 'cache_dir',
+                          type      = str,
+                          optional  = True,
+                          help      = 'Directory of the on-disk cache of finished subject directories',
+                          default   = '')
+
+        self.add_argument('--cache_max_gb',
+                          dest      = 'cache_max_gb',
+                          type      = float,
+                          optional  = True,
+                          help      = 'Size cap of the result cache in GB (0: unlimited)',
+                          default   = 0.0)
+
+        self.add_argument('--cache_hardlink',
+                          dest      = 'cache_hardlink',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Restore cache hits by hardlinking instead of copying',
+                          default   = False)
+
+        self.add_argument('--resume',
+                          dest      = 'resume',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Record completed stages and resume interrupted subjects from the first incomplete one',
+                          default   = False)
+
+        self.add_argument('--monitor_interval',
+                          dest      = 'monitor_interval',
+                          type      = float,
+                          optional  = True,
+                          help      = 'Sampling interval in seconds of the per-stage resource report (0: disabled)',
+                          default   = 1.0)
+
+        self.add_argument('--auto_tune',
+                          dest      = 'auto_tune',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Choose --threads, --parallel and --batch from the available cores, memory and input size',
+                          default   = False)
+
+        self.add_argument('--progress_only',
+                          dest      = 'progress_only',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Only print progress events to the console, the full output goes to outputdir/logs',
+                          default   = False)
+
+        self.add_argument('--scratch_dir',
+                          dest      = 'scratch_dir',
+                          type      = str,
+                          optional  = True,
+                          help      = 'Node-local directory to process subjects in before transferring them to --sd',
+                          default   = '')
+
+        self.add_argument('--stage_compress',
+                          dest      = 'stage_compress',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Transfer subjects processed in --scratch_dir back as <sid>.tar.gz archives',
+                          default   = False)
+
+        self.add_argument('--warm_seg',
+                          dest      = 'warm_seg',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Segment all subjects in one FastSurferCNN process that keeps the networks loaded',
+                          default   = False)
+
+        self.add_argument('--mmap_weights',
+                          dest      = 'mmap_weights',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Share the checkpoints between --warm_seg workers as memory-mapped weight stores',
+                          default   = False)
+
+        self.add_argument('--pin_cores',
+                          dest      = 'pin_cores',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Pin every subject and hemisphere to its own share of the cores',
+                          default   = False)
+
+        self.add_argument('--admission',
+                          dest      = 'admission',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Queue subjects and stages until their predicted peak memory fits the memory limit',
+                          default   = False)
+
+        self.add_argument('--memory_db',
+                          dest      = 'memory_db',
+                          type      = str,
+                          optional  = True,
+                          help      = 'SQLite database of the measured peak memory per stage used by --admission',
+                          default   = '')
+
+        self.add_argument('--preflight',
+                          dest      = 'preflight',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Validate the T1 headers and the license before launching, largest input first',
+                          default   = False)
+
+        self.add_argument('--incremental',
+                          dest      = 'incremental',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Only run the stages of processed subjects that the requested options change',
+                          default   = False)
+
+        self.add_argument('--package',
+                          dest      = 'package',
+                          type      = str,
+                          optional  = True,
+                          help      = 'Pack the outputs selected by the comma-separated profiles seg, stats, surfaces, full into indexed archives',
+                          default   = '')
+
+        self.add_argument('--package_prune',
+                          dest      = 'package_prune',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Remove the subject directories packed by --package',
+                          default   = False)
+
+        self.add_argument('--stats_table',
+                          dest      = 'stats_table',
+                          type      = bool,
+                          optional  = True,
+                          help      = 'Collect the stats of all subjects into a cohort table in outputdir',
+                          default   = False)
+
+        self.add_argument('--metrics_file',
+                          dest      = 'metrics_file',
+                          type      = str,
+                          optional  = True,
+                          help      = 'Periodically rewrite the progress metrics to this file in the Prometheus format',
+                          default   = '')
+
+        self.add_argument('--metrics_port',
+                          dest      = 'metrics_port',
+                          type      = int,
+                          optional  = True,
+                          help      = 'Serve the progress metrics over HTTP on this port (0: disabled)',
+                          default   = 0)
+
+        self.add_argument('--metrics_address',
+                          dest      = 'metrics_address',
+                          type      = str,
+                          optional  = True,
+                          help      = 'Address the progress metrics are served on',
+                          default   = '127.0.0.1')
 
     def run(self, options):
         """
@@ -417,25 +907,1012 @@ class Fastsurfer(ChrisApp):
         # fastsurfer_dir: /usr/src/fastsurfer/FastSurfer
         fastsurfer_dir = os.path.join(os.getcwd(), 'FastSurfer')
 
+        if options.fs_help:
+            os.chdir(fastsurfer_dir)
+            self.returncode = subprocess.call(['./run_fastsurfer.sh', '--help'])
+            return
+
+        errors = run_options.check(vars(options))
+        if errors:
+            self.error('; '.join(errors))
+
+        # all paths must survive the chdir into fastsurfer_dir below, so
+        # relative ones are resolved against the directory the plugin runs in
+        for option in run_options.RUN_OPTIONS:
+            if option.kind == run_options.PATH and options.__dict__[option.name]:
+                options.__dict__[option.name] = os.path.abspath(options.__dict__[option.name])
+        options.inputdir = os.path.abspath(options.inputdir)
+        options.outputdir = os.path.abspath(options.outputdir)
+        if options.cache_dir:
+            options.cache_dir = os.path.abspath(options.cache_dir)
+        if options.memory_db:
+            options.memory_db = os.path.abspath(options.memory_db)
+        if options.metrics_file:
+            options.metrics_file = os.path.join(options.outputdir, options.metrics_file)
+            metrics_dir = os.path.dirname(options.metrics_file)
+            try:
+                os.makedirs(metrics_dir, exist_ok=True)
+            except OSError as e:
+                self.error('cannot create the directory of --metrics_file: %s' % e)
+            if not os.access(metrics_dir, os.W_OK):
+                self.error('cannot write --metrics_file to %s' % metrics_dir)
+        if not 0 <= options.metrics_port <= 65535:
+            self.error('--metrics_port must be between 0 and 65535')
+        if options.scratch_dir:
+            options.scratch_dir = os.path.abspath(options.scratch_dir)
+        elif options.stage_compress:
+            self.error('--stage_compress requires --scratch_dir')
+        if options.stage_compress and (options.resume or options.incremental or options.package):
+            self.error('--stage_compress cannot be combined with --resume, --incremental '
+                       'or --package')
+        package_profiles = []
+        if options.package:
+            try:
+                package_profiles = output_package.parse_profiles(options.package)
+            except ValueError as e:
+                self.error(str(e))
+        elif options.package_prune:
+            self.error('--package_prune requires --package')
+        if options.warm_seg and (options.surf_only or options.seg_with_cc_only or
+                                 options.seg_only and options.vol_segstats):
+            self.error('--warm_seg cannot be combined with --surf_only, --seg_with_cc_only '
+                       'or --seg_only --vol_segstats')
+        if options.mmap_weights and not options.warm_seg:
+            self.error('--mmap_weights requires --warm_seg')
+        if options.pipeline:
+            for option in ('seg_only', 'surf_only', 'seg_with_cc_only'):
+                if options.__dict__[option]:
+                    self.error('--pipeline cannot be combined with --%s' % option)
+        jobs = self.get_subject_jobs(options)
+        subjects_dir = self.get_subjects_dir(options)
+
         #print("os.chdir")
         os.chdir(fastsurfer_dir)
-        
-        fastsurfer_args = {'fs_license', 'sid', 'sd', 't1', 'seg', 'seg_log', 'weights_sag', 'weights_ax', 'weights_cor',
-                'clean_seg', 'no_cuda', 'batch', 'order', 'seg_only', 'seg_with_cc_only', 'surf_only', 'vol_segstats',
-                'fstess', 'fsqsphere', 'fsaparc', 'surfreg', 'parallel', 'threads', 'py', 'fs_help'}
-        
-        #print("options:")
-        run_fastsurfer_cmd = './run_fastsurfer.sh '
-        for option in fastsurfer_args:
-            if options.__dict__['fs_help'] is not 'none':
-                run_fastsurfer_cmd = run_fastsurfer_cmd + '--help'
-                break
-            elif options.__dict__[option] is not 'none':
-                run_fastsurfer_cmd = run_fastsurfer_cmd + '--' + str(option) + ' ' + str(options.__dict__[option]) + ' '
-
-        #print('final command: ')
-        #print(run_fastsurfer_cmd)
-        os.system(run_fastsurfer_cmd)
+
+        self.result_cache = None
+        self.cache_keys = {}
+        self.resource_reports = {}
+        self.tuned_options = {}
+        self.console = log_stream.ConsoleWriter(progress_only=options.progress_only)
+        self.progress_listeners = []
+        self.staging = None
+        self.staging_reports = {}
+        self.seg_worker = None
+        self.core_scheduler = None
+        self.memory_model = None
+        self.memory_gate = None
+        self.admission_reports = {}
+        self.input_voxels = {}
+        self.preflight_reports = {}
+        self.incremental_plans = {}
+        self.file_digests = file_util.FileDigests()
+        self.stats_table = None
+        self.metrics = None
+        if options.stats_table:
+            self.stats_table = stats_table.StatsTable(
+                os.path.join(options.outputdir, 'fastsurfer_stats.json'))
+        cached = []
+        rejected = []
+        if options.cache_dir:
+            self.result_cache = result_cache.ResultCache(
+                options.cache_dir, int(options.cache_max_gb * 1024 ** 3), self.file_digests)
+            jobs, cached, rejected = self.restore_cached_subjects(options, jobs, subjects_dir)
+        if jobs and options.preflight:
+            jobs, failed = self.preflight_subjects(options, jobs)
+            rejected += failed
+
+        cpus = resource_tuning.effective_cpus(subject_batch.available_cpus())
+        memory = resource_tuning.effective_memory(subject_batch.available_memory())
+        workers = subject_batch.worker_count(len(jobs),
+                                             cpus_per_subject=self.get_cpus_per_subject(options),
+                                             max_workers=options.max_workers,
+                                             cpus=cpus, memory=memory)
+        if options.auto_tune:
+            self.tune_subjects(options, jobs, cpus, memory, workers)
+
+        publisher = None
+        if options.metrics_file or options.metrics_port:
+            publisher = self.start_metrics(options, jobs, cached + rejected, workers, cpus, memory)
+        if jobs and options.scratch_dir:
+            self.staging = io_staging.StagingArea(options.scratch_dir)
+            print('Staging subjects in %s' % self.staging.root)
+        try:
+            if jobs and options.admission:
+                self.start_admission(options, memory)
+            if jobs and options.pin_cores:
+                self.core_scheduler = self.start_core_scheduler(options, jobs, cpus, workers)
+            if jobs and options.warm_seg:
+                self.seg_worker = self.start_seg_worker(options)
+            if not jobs:
+                results, stage_outcomes = [], {}
+            elif options.pipeline:
+                results, stage_outcomes = self.run_pipelined(options, jobs, subjects_dir, workers)
+            else:
+                print('Processing %d subject(s) with %d worker(s)' % (len(jobs), workers))
+                results = subject_batch.run_batch(
+                    jobs, lambda job: self.track_subject(options, job, subjects_dir), workers)
+                stage_outcomes = None
+        finally:
+            if publisher is not None:
+                publisher.stop()
+            if self.core_scheduler is not None:
+                self.core_scheduler.stop()
+            if self.seg_worker is not None:
+                self.seg_worker.close()
+            if self.memory_model is not None:
+                self.memory_model.close()
+            if self.staging is not None and self.staging.inputs:
+                print('Keeping %s for the subjects that could not be transferred: %s'
+                      % (self.staging.root, ', '.join(sorted(self.staging.inputs))))
+            elif self.staging is not None:
+                self.staging.cleanup()
+        # outputdir is left to run_fastsurfer.sh, which may not have run at all
+        os.makedirs(options.outputdir, exist_ok=True)
+        if self.stats_table is not None:
+            self.aggregate_stats(options, subjects_dir)
+        if package_profiles:
+            self.package_subjects(options, package_profiles, cached + results, subjects_dir)
+        self.save_batch_report(options, cached + rejected + results, stage_outcomes, cached)
+        if self.result_cache is not None:
+            self.save_cache_report(options)
+        if self.resource_reports:
+            self.save_resource_report(options)
+        self.returncode = self.get_returncode(cached + rejected + results)
+
+    def get_returncode(self, results):
+        """
+        Return the exit code of the plugin: that of a single subject, else 1 if
+        any subject failed.
+        """
+        failed = [result.returncode for result in results if result.returncode != 0]
+        if not failed:
+            return 0
+        if len(results) == 1 and 0 < failed[0] < 256:
+            return failed[0]
+        return 1
+
+    def restore_cached_subjects(self, options, jobs, subjects_dir):
+        """
+        Restore every subject found in the result cache into <subjects_dir>.
+        Return the jobs still to be run, the SubjectResult of the restored ones
+        and those of the subjects whose inputs cannot be read.
+        """
+        remaining = []
+        cached = []
+        failed = []
+        for job in jobs:
+            start = time.time()
+            cache_options = {option: value for option, value
+                             in self.get_fastsurfer_options(options, job, subjects_dir).items()
+                             if option not in CACHE_IGNORED_ARGS}
+            try:
+                key = self.result_cache.key(job.sid, job.t1, cache_options,
+                                            self.get_weights(options))
+            except OSError as e:
+                print('[%s] cannot compute the cache key: %s' % (job.sid, e))
+                failed.append(subject_batch.SubjectResult(job.sid, job.t1, 1, time.time() - start))
+                continue
+            self.cache_keys[job.sid] = key
+            if self.result_cache.restore(key, os.path.join(subjects_dir, job.sid),
+                                         options.cache_hardlink):
+                print('[%s] restored from cache entry %s' % (job.sid, key))
+                cached.append(subject_batch.SubjectResult(job.sid, job.t1, 0, time.time() - start))
+            else:
+                remaining.append(job)
+        return remaining, cached, failed
+
+    def preflight_subjects(self, options, jobs):
+        """
+        Check the license and the T1 headers of <jobs> against the input
+        requirements. Return the jobs that pass, largest input first, and the
+        SubjectResult of those that do not.
+        """
+        # only recon-surf needs the license
+        if not options.seg_only and options.fs_license:
+            problem = input_preflight.check_license(options.fs_license)
+            if problem is not None:
+                self.error('--fs_license: %s' % problem)
+        elif not options.seg_only and input_preflight.find_license(os.environ) is None:
+            print('No FreeSurfer license in $FS_LICENSE or $FREESURFER_HOME, '
+                  'recon-surf will fail without --fs_license')
+
+        start = time.time()
+        index_dir = options.cache_dir or options.outputdir
+        os.makedirs(index_dir, exist_ok=True)
+        index = input_preflight.InputIndex(os.path.join(index_dir, 'fastsurfer_inputs.json'),
+                                           self.describe_input)
+        entries = index.scan([job.t1 for job in jobs])
+        passed = []
+        rejected = []
+        for job in jobs:
+            entry = entries[job.t1]
+            self.preflight_reports[job.sid] = entry
+            if entry['problems']:
+                print('[%s] preflight failed: %s'
+                      % (job.sid, '; '.join(entry['problems'])))
+                rejected.append(subject_batch.SubjectResult(job.sid, job.t1, 1, 0.0))
+            else:
+                self.input_voxels[job.sid] = entry['voxels']
+                passed.append(job)
+        print('Preflight: %d of %d T1 volume(s) passed in %.1fs'
+              % (len(passed), len(jobs), time.time() - start))
+        return input_preflight.longest_first(passed, lambda job: entries[job.t1]['voxels']), rejected
+
+    def describe_input(self, path):
+        """
+        Return the header fields of the T1 volume <path> and the list of its
+        problems as an input index entry.
+        """
+        try:
+            header = volume_header.read_header(path)
+            problems = input_preflight.check_header(header)
+            incomplete = volume_header.check_complete(path, header)
+        except (IOError, OSError, ValueError) as e:
+            return {'problems': [str(e)]}
+        if incomplete is not None:
+            problems.append(incomplete)
+        return {'format': header.format, 'shape': list(header.shape),
+                'voxel_size': [round(size, 4) for size in header.voxel_size],
+                'dtype': header.dtype, 'voxels': volume_header.voxel_count(header),
+                'problems': problems}
+
+    def get_weights(self, options):
+        """
+        Return the sagittal, axial and coronal checkpoint paths in effect.
+        """
+        return [options.__dict__[option] or path
+                for option, path in sorted(DEFAULT_WEIGHTS.items())]
+
+    def start_core_scheduler(self, options, jobs, cpus, workers):
+        """
+        Start budgeting <cpus> cores across the subjects run concurrently and
+        give every subject not given --threads its share of them.
+        """
+        concurrent = workers
+        if options.pipeline:
+            concurrent = options.seg_workers + (options.surf_workers if options.surf_workers > 0
+                                                else workers)
+        scheduler = core_pinning.CoreScheduler(core_pinning.usable_cores(cpus),
+                                               resource_monitor.process_tree)
+        for job in jobs:
+            tuned = self.tuned_options.setdefault(job.sid, {})
+            if not options.threads and 'threads' not in tuned:
+                parallel = options.parallel or tuned.get('parallel', False)
+                tuned['threads'] = scheduler.threads_per_process(concurrent, parallel)
+        print('Pinning up to %d concurrent subject(s) to %d core(s)'
+              % (concurrent, len(scheduler.cores)))
+        return scheduler
+
+    def start_seg_worker(self, options):
+        """
+        Start --seg_workers persistent FastSurferCNN workers in the FastSurfer
+        directory. Return None if they cannot be started.
+        """
+        logdir = os.path.join(options.outputdir, 'logs')
+        os.makedirs(logdir, exist_ok=True)
+        python = options.py or sys.executable
+        count = max(1, options.seg_workers)
+        print('Starting %d FastSurferCNN worker(s) with %s' % (count, python))
+        start = time.time()
+
+        def start_worker(i):
+            log_name = 'seg_worker.log' if i == 0 else 'seg_worker.%d.log' % i
+            return seg_worker.SegWorker(python, 'FastSurferCNN/eval.py', self.get_weights(options),
+                                        options.no_cuda, options.mmap_weights,
+                                        os.path.join(logdir, log_name), os.getcwd())
+
+        workers = []
+        try:
+            # the first worker converts the weight stores the others map
+            workers.append(start_worker(0))
+            with ThreadPoolExecutor(max_workers=count) as executor:
+                futures = [executor.submit(start_worker, i) for i in range(1, count)]
+                for future in futures:
+                    try:
+                        workers.append(future.result())
+                    except (RuntimeError, OSError) as e:
+                        print('%s, continuing with fewer workers' % e)
+        except (RuntimeError, OSError) as e:
+            print('%s, segmenting every subject in its own process' % e)
+            return None
+        print('%d FastSurferCNN worker(s) ready after %.1fs' % (len(workers), time.time() - start))
+        return seg_worker.SegWorkerPool(workers)
+
+    def run_pipelined(self, options, jobs, subjects_dir, workers):
+        """
+        Run segmentation and recon-surf as separate stages overlapped across
+        subjects. Return the list of SubjectResult and a dict mapping each
+        subject ID to its list of StageOutcome.
+        """
+        surf_workers = options.surf_workers if options.surf_workers > 0 else workers
+        print('Processing %d subject(s) with %d segmentation and %d recon-surf worker(s)'
+              % (len(jobs), options.seg_workers, surf_workers))
+
+        stages = [
+            stage_pipeline.Stage(
+                'seg', lambda job: self.track_subject(options, job, subjects_dir, 'seg'),
+                options.seg_workers),
+            stage_pipeline.Stage(
+                'surf', lambda job: self.track_subject(options, job, subjects_dir, 'surf'),
+                surf_workers),
+        ]
+        outcomes = stage_pipeline.run_pipeline(jobs, stages)
+
+        results = []
+        for job, job_outcomes in zip(jobs, outcomes):
+            returncode = job_outcomes[-1].returncode if job_outcomes else -1
+            elapsed = sum(outcome.elapsed for outcome in job_outcomes)
+            results.append(subject_batch.SubjectResult(job.sid, job.t1, returncode, elapsed))
+        return results, {job.sid: job_outcomes for job, job_outcomes in zip(jobs, outcomes)}
+
+    def get_subject_jobs(self, options):
+        """
+        Return the list of subjects to process: every T1 volume in inputdir in
+        --multi_subject mode, else the single --t1/--sid pair.
+        """
+        if options.multi_subject:
+            try:
+                jobs = subject_batch.discover_subjects(options.inputdir)
+            except ValueError as e:
+                self.error(str(e))
+            if not jobs:
+                self.error('no T1 volumes (%s) found in %s'
+                           % (', '.join(subject_batch.T1_EXTENSIONS), options.inputdir))
+            return jobs
+        if not options.t1 or not options.sid:
+            self.error('--t1 and --sid are required unless --multi_subject is given')
+        return [subject_batch.SubjectJob(options.sid, options.t1)]
+
+    def get_subjects_dir(self, options):
+        """
+        Return the absolute $SUBJECTS_DIR, defaulting to outputdir.
+        """
+        return options.sd or options.outputdir
+
+    def get_cpus_per_subject(self, options):
+        """
+        Return the number of cores a single subject run is expected to occupy.
+        """
+        if options.auto_tune and not options.threads:
+            # at least a core per hemisphere, the rest is handed out by tune_subjects()
+            return 2
+        threads = options.threads or 1
+        if options.parallel:
+            threads *= 2
+        return threads
+
+    def tune_subjects(self, options, jobs, cpus, memory, workers):
+        """
+        Choose --threads, --parallel and --batch for every subject not given
+        them explicitly, sharing <cpus> cores and <memory> bytes between
+        <workers> concurrent subjects.
+        """
+        subject_cpus = max(1, cpus // workers)
+        subject_memory = memory // workers if memory is not None else None
+        for job in jobs:
+            voxels = self.get_input_voxels(job.sid, job.t1)
+            tuning = resource_tuning.tune(subject_cpus, subject_memory, voxels)
+            tuned = {}
+            if not options.threads:
+                tuned['threads'] = tuning.threads
+            if not options.parallel and tuning.parallel:
+                tuned['parallel'] = True
+            if not options.batch:
+                tuned['batch'] = tuning.batch
+            self.tuned_options[job.sid] = tuned
+            print('[%s] auto-tune: %d core(s), %s memory, %d voxels -> %s'
+                  % (job.sid, subject_cpus,
+                     '%.1f GiB' % (subject_memory / 1024.0 ** 3) if subject_memory else 'unknown',
+                     voxels,
+                     ' '.join(run_options.build_argv('', tuned)[1:]) or 'nothing to tune'))
+
+    def get_input_voxels(self, sid, t1):
+        """
+        Return the number of voxels of the <t1> volume of subject <sid>, that of
+        a conformed volume if its header cannot be read.
+        """
+        if sid not in self.input_voxels:
+            try:
+                self.input_voxels[sid] = volume_header.voxel_count(volume_header.read_header(t1))
+            except (IOError, OSError, ValueError) as e:
+                print('[%s] cannot read the T1 header (%s), assuming a conformed volume' % (sid, e))
+                self.input_voxels[sid] = resource_tuning.CONFORMED_VOXELS
+        return self.input_voxels[sid]
+
+    def start_admission(self, options, memory):
+        """
+        Open the peak memory model and start admitting runs under <memory>
+        bytes, unless the memory limit is unknown.
+        """
+        if memory is None:
+            print('Memory limit unknown, admitting every subject')
+            return
+        path = options.memory_db
+        if not path:
+            db_dir = options.cache_dir or options.outputdir
+            os.makedirs(db_dir, exist_ok=True)
+            path = os.path.join(db_dir, 'fastsurfer_memory.sqlite')
+        self.memory_model = memory_admission.PeakMemoryModel(path)
+        self.memory_gate = memory_admission.MemoryGate(memory)
+        samples = self.memory_model.stats()
+        print('Admitting subjects under %.1f GiB of memory, peak memory model %s: %s'
+              % (memory / 1024.0 ** 3, path,
+                 ', '.join('%s (%d runs)' % item for item in sorted(samples.items()))
+                 or 'no runs measured yet'))
+
+    def get_memory_stage(self, fastsurfer_options):
+        """
+        Return the name under which the peak memory of a run_fastsurfer.sh run
+        with <fastsurfer_options> is modelled, and the stages it consists of.
+        """
+        surf = 'surf_parallel' if 'parallel' in fastsurfer_options else 'surf'
+        if 'surf_only' in fastsurfer_options:
+            return surf, ()
+        if 'seg_with_cc_only' in fastsurfer_options or ('seg_only' in fastsurfer_options and
+                                                        'vol_segstats' in fastsurfer_options):
+            # recon-surf runs up to the CC
+            return 'seg_cc', ()
+        if 'seg_only' in fastsurfer_options:
+            return 'seg', ()
+        return 'full_' + surf, ('seg', surf)
+
+    def estimate_peak_memory(self, stage, fastsurfer_options, voxels):
+        """
+        Return the peak memory in bytes of <stage> estimated from the input
+        size, --batch and --parallel, for stages not measured yet.
+        """
+        seg = resource_tuning.segmentation_memory(voxels, fastsurfer_options.get('batch', 8))
+        surf = resource_tuning.SURF_BYTES_PER_HEMISPHERE
+        if stage == 'seg':
+            return seg
+        if stage == 'seg_cc':
+            return max(seg, surf)
+        if stage.endswith('parallel'):
+            surf *= 2
+        return surf if stage.startswith('surf') else max(seg, surf)
+
+    def admit_run(self, tag, fastsurfer_options):
+        """
+        Wait until the predicted peak memory of a run_fastsurfer.sh run with
+        <fastsurfer_options> fits under the memory limit and reserve it.
+        Return the stage name and input size it is modelled by.
+        """
+        sid = fastsurfer_options['sid']
+        voxels = self.get_input_voxels(sid, fastsurfer_options['t1'])
+        stage, parts = self.get_memory_stage(fastsurfer_options)
+        predicted = self.memory_model.predict(stage, voxels, parts)
+        source = 'model'
+        if predicted is None:
+            predicted = self.estimate_peak_memory(stage, fastsurfer_options, voxels)
+            source = 'estimate'
+        gate = self.memory_gate
+        on_wait = lambda: self.console.line(
+            tag, 'queued: needs %.1f GiB of memory, %.1f of %.1f GiB reserved'
+            % (predicted / 1024.0 ** 3, gate.in_use() / 1024.0 ** 3, gate.limit / 1024.0 ** 3))
+        waited = gate.admit(tag, predicted, on_wait)
+        self.admission_reports.setdefault(sid, []).append(
+            {'tag': tag, 'stage': stage, 'predicted': predicted, 'source': source,
+             'waited': waited})
+        return stage, voxels
+
+    def get_fastsurfer_options(self, options, job, subjects_dir, stage=None):
+        """
+        Return a dict of the run_fastsurfer.sh options set for a single
+        subject (without the leading '--', flags mapped to True), restricted to
+        the segmentation ('seg') or recon-surf ('surf') part if <stage> is given.
+        """
+        values = dict(vars(options), **self.tuned_options.get(job.sid, {}))
+        values.update(sid=job.sid, t1=job.t1, sd=subjects_dir)
+        if stage == 'seg':
+            # --vol_segstats would make --seg_only run recon-surf up to the CC
+            values.update(seg_only=True, vol_segstats=False)
+        elif stage == 'surf':
+            values.update(surf_only=True)
+        return run_options.select(values)
+
+    def build_fastsurfer_argv(self, fastsurfer_options):
+        """
+        Return the run_fastsurfer.sh argv for a dict of options.
+        """
+        return run_options.build_argv('./run_fastsurfer.sh', fastsurfer_options)
+
+    def get_stage_manifest(self, options, job, subjects_dir):
+        """
+        Return the StageManifest of a subject.
+        """
+        seg = options.seg or None
+        return stage_checkpoint.StageManifest(os.path.join(subjects_dir, job.sid),
+                                              stage_checkpoint.subject_stages(seg))
+
+    def resume_fastsurfer_options(self, manifest, fastsurfer_options):
+        """
+        Adapt <fastsurfer_options> to skip the stages already completed according
+        to <manifest>. Return None if there is nothing left to run.
+
+        run_fastsurfer.sh can only skip the segmentation, so any incomplete
+        recon-surf stage reruns recon-surf from its start.
+        """
+        resume_from = manifest.first_incomplete(self.get_target_stages(fastsurfer_options))
+        if resume_from is None:
+            return None
+        fastsurfer_options = dict(fastsurfer_options)
+        if resume_from != 'seg':
+            if 'seg_only' in fastsurfer_options:
+                # only reachable with --vol_segstats, which runs recon-surf up to the CC
+                del fastsurfer_options['seg_only']
+                fastsurfer_options['seg_with_cc_only'] = True
+            fastsurfer_options['surf_only'] = True
+        return fastsurfer_options
+
+    def get_target_stages(self, fastsurfer_options):
+        """
+        Return the names of the stages a run with <fastsurfer_options> produces.
+        """
+        return stage_checkpoint.target_stages('seg_only' in fastsurfer_options,
+                                              'seg_with_cc_only' in fastsurfer_options,
+                                              'vol_segstats' in fastsurfer_options)
+
+    def get_input_digests(self, options, t1):
+        """
+        Return a dict mapping the T1 volume <t1> and the checkpoints to their
+        sha256 digests, shared with the result cache keys.
+        """
+        inputs = {}
+        for name, path in zip(['t1'] + sorted(DEFAULT_WEIGHTS), [t1] + self.get_weights(options)):
+            if not os.path.isfile(path):
+                inputs[name] = path
+                continue
+            inputs[name] = self.file_digests.digest(path)
+        return inputs
+
+    def plan_incremental(self, options, job, t1, manifest, subjects_dir):
+        """
+        Return the incremental_run.Plan of a subject with the original T1 volume
+        <t1>, decided once from the record of its last run and its completed
+        stages in <manifest>.
+        """
+        if job.sid not in self.incremental_plans:
+            requested = self.get_fastsurfer_options(options, job, subjects_dir)
+            plan = incremental_run.plan(incremental_run.load_record(manifest.subject_dir),
+                                        requested, self.get_input_digests(options, t1),
+                                        self.get_target_stages(requested), manifest.completed())
+            print('[%s] incremental run: %s%s' % (job.sid, {'none': 'nothing to run',
+                                                           'cc': 'recon-surf up to the CC',
+                                                           'surf': 'recon-surf only',
+                                                           'full': 'whole pipeline'}[plan.level],
+                                                 ' (%s)' % ', '.join(plan.reasons)
+                                                 if plan.reasons else ''))
+            self.incremental_plans[job.sid] = plan
+        return self.incremental_plans[job.sid]
+
+    def incremental_fastsurfer_options(self, plan, fastsurfer_options, stage=None):
+        """
+        Adapt <fastsurfer_options> (of <stage>, if given) to run only what
+        <plan> requires. Return None if there is nothing left to run.
+        """
+        if plan.level == 'none' or (stage == 'seg' and plan.level != 'full'):
+            return None
+        fastsurfer_options = dict(fastsurfer_options)
+        if plan.level != 'full':
+            fastsurfer_options.pop('seg_only', None)
+            fastsurfer_options['surf_only'] = True
+        if plan.level == 'cc':
+            fastsurfer_options['seg_with_cc_only'] = True
+        return fastsurfer_options
+
+    def save_incremental_record(self, options, job, t1, plan, subject_dir):
+        """
+        Record the options and inputs of a successful run of <plan> in <subject_dir>.
+        """
+        requested = self.get_fastsurfer_options(options, job, os.path.dirname(subject_dir))
+        record = incremental_run.make_record(requested, self.get_input_digests(options, t1))
+        incremental_run.save_record(subject_dir, incremental_run.merge_record(
+            incremental_run.load_record(subject_dir), record, plan.level))
+
+    def start_metrics(self, options, jobs, finished, workers, cpus, memory):
+        """
+        Start following the progress of <jobs> (<finished> being the results
+        of the subjects not run) and publishing it. Return the MetricsPublisher.
+        """
+        self.metrics = progress_metrics.ProgressMetrics([job.sid for job in jobs], workers, cpus,
+                                                        memory, self.sample_process_tree)
+        for result in finished:
+            self.metrics.subject_finished(result.sid, result.returncode)
+        self.progress_listeners.append(self.metrics.on_event)
+        try:
+            publisher = progress_metrics.MetricsPublisher(
+                self.metrics, options.metrics_file, options.metrics_address,
+                options.metrics_port or None).start()
+        except (IOError, OSError) as e:
+            self.error('cannot serve the metrics on %s:%d: %s'
+                       % (options.metrics_address, options.metrics_port, e))
+        if publisher.port is not None:
+            print('Serving the progress metrics on http://%s:%d/metrics'
+                  % (options.metrics_address, publisher.port))
+        if options.metrics_file:
+            self.OUTPUT_META_DICT = dict(self.OUTPUT_META_DICT,
+                                         metricsFile=os.path.relpath(options.metrics_file,
+                                                                     options.outputdir))
+        return publisher
+
+    def sample_process_tree(self):
+        """
+        Return the CPU seconds and resident memory of the plugin process tree.
+        """
+        cpu = rss = 0
+        for pid in resource_monitor.process_tree(os.getpid()):
+            try:
+                cpu += resource_monitor.read_proc_stat(pid)[1]
+                rss += resource_monitor.read_proc_rss(pid)
+            except (IOError, OSError, ValueError, IndexError):
+                # exited in between
+                pass
+        return cpu, rss
+
+    def track_subject(self, options, job, subjects_dir, stage=None):
+        """
+        Run run_subject, counting the subject in the progress metrics as running
+        from its first stage on and as done after its last or a failed one.
+        """
+        if self.metrics is None:
+            return self.run_subject(options, job, subjects_dir, stage)
+        self.metrics.subject_started(job.sid)
+        returncode = -1
+        try:
+            returncode = self.run_subject(options, job, subjects_dir, stage)
+        finally:
+            if stage != 'seg' or returncode != 0:
+                self.metrics.subject_finished(job.sid, returncode)
+        return returncode
+
+    def run_subject(self, options, job, subjects_dir, stage=None):
+        """
+        Run the FastSurfer pipeline (or one <stage> of it) for one subject and
+        return its exit code.
+        """
+        if stage is None and self.seg_worker is not None:
+            # segment in the warm worker, then run recon-surf on its output
+            returncode = self.run_subject(options, job, subjects_dir, 'seg')
+            if returncode != 0 or options.seg_only:
+                return returncode
+            return self.run_subject(options, job, subjects_dir, 'surf')
+
+        tag = job.sid if stage is None else '%s:%s' % (job.sid, stage)
+        launch = self.launch_fastsurfer
+        if stage == 'seg' and self.seg_worker is not None:
+            launch = self.launch_seg_worker
+        run_dir = subjects_dir
+        source_t1 = job.t1
+        if self.staging is not None:
+            t1 = self.staging.stage_in(job.sid, job.t1, os.path.join(subjects_dir, job.sid))
+            job = job._replace(t1=t1)
+            run_dir = self.staging.subjects_dir
+        fastsurfer_options = self.get_fastsurfer_options(options, job, run_dir, stage)
+        manifest = None
+        plan = None
+        if options.resume or options.incremental:
+            manifest = self.get_stage_manifest(options, job, run_dir)
+        if options.incremental:
+            plan = self.plan_incremental(options, job, source_t1, manifest, run_dir)
+            fastsurfer_options = self.incremental_fastsurfer_options(plan, fastsurfer_options, stage)
+        elif options.resume:
+            fastsurfer_options = self.resume_fastsurfer_options(manifest, fastsurfer_options)
+
+        subject_dir = os.path.join(run_dir, job.sid)
+        if fastsurfer_options is None:
+            print('[%s] %s' % (tag, 'all stages already complete' if plan is None
+                               else 'reusing the existing outputs'))
+            returncode = 0
+        elif manifest is None:
+            returncode = launch(options, tag, fastsurfer_options, subject_dir)
+        else:
+            completed = manifest.completed()
+            if completed:
+                print('[%s] completed stages: %s' % (tag, ', '.join(completed)))
+            on_record = lambda name: print('[%s] stage %s complete' % (tag, name))
+            with stage_checkpoint.StageWatcher(manifest, on_record=on_record) as watcher:
+                returncode = launch(options, tag, fastsurfer_options, subject_dir)
+                watcher.stop(returncode == 0)
+
+        final = stage != 'seg' or options.seg_only
+        if plan is not None and fastsurfer_options is not None and final and returncode == 0:
+            self.save_incremental_record(options, job, source_t1, plan, subject_dir)
+        if self.stats_table is not None and final and returncode == 0:
+            if self.stats_table.update(job.sid, subject_dir):
+                self.save_stats_table(options)
+        if self.staging is not None and (final or returncode != 0):
+            try:
+                self.stage_out_subject(options, tag, subject_dir, subjects_dir, returncode == 0)
+            except (IOError, OSError) as e:
+                print('[%s] transfer to %s failed: %s' % (tag, subjects_dir, e))
+                return returncode or 1
+        elif returncode == 0 and final and self.result_cache is not None:
+            self.result_cache.store(self.cache_keys[job.sid], subject_dir)
+        return returncode
+
+    def stage_out_subject(self, options, tag, subject_dir, subjects_dir, succeeded):
+        """
+        Transfer the staged <subject_dir> to <subjects_dir>, store it in the
+        result cache if it <succeeded> and drop it from the scratch directory.
+        """
+        sid = os.path.basename(subject_dir)
+        if os.path.isdir(subject_dir):
+            report = io_staging.stage_out(subject_dir, subjects_dir, options.stage_compress)
+            self.staging_reports[sid] = report._asdict()
+            print('[%s] transferred %d files (%.1f MiB) to %s in %.1fs'
+                  % (tag, report.files, report.bytes / 1024.0 ** 2, report.destination,
+                     report.seconds))
+            if succeeded and self.result_cache is not None:
+                self.result_cache.store(self.cache_keys[sid], subject_dir)
+        self.staging.discard(sid)
+
+    def open_subject_output(self, options, tag, command):
+        """
+        Open the log of a run of <command> for <tag>. Return the SubjectLog, the
+        ProgressParser and a handle_line(stream, line) callback that logs,
+        prints and parses an output line.
+        """
+        self.console.line(tag, command)
+        subject_log = log_stream.SubjectLog(os.path.join(options.outputdir, 'logs'), tag)
+        subject_log.write_line('plugin', command)
+
+        def emit(event):
+            subject_log.write_event(event)
+            self.console.event(event)
+            for listener in self.progress_listeners:
+                listener(event)
+
+        def classify(line):
+            return (resource_monitor.stage_from_line(line, 'surf')
+                    or resource_monitor.stage_from_line(line, 'seg'))
+
+        def handle_line(stream, line):
+            subject_log.write_line(stream, line)
+            self.console.line(tag, line)
+            progress.feed(line)
+
+        progress = log_stream.ProgressParser(tag, classify, emit)
+        return subject_log, progress, handle_line
+
+    def launch_fastsurfer(self, options, tag, fastsurfer_options, subject_dir):
+        """
+        Run run_fastsurfer.sh with <fastsurfer_options> and return its exit code.
+
+        Its output is streamed line by line to outputdir/logs and the console
+        and parsed into progress events. The process tree is sampled into
+        self.resource_reports[<tag>] unless --monitor_interval is 0.
+        """
+        argv = self.build_fastsurfer_argv(fastsurfer_options)
+        subject_log, progress, handle_line = self.open_subject_output(
+            options, tag, run_options.format_argv(argv))
+        memory_stage = voxels = None
+        if self.memory_gate is not None:
+            memory_stage, voxels = self.admit_run(tag, fastsurfer_options)
+        monitor = None
+        try:
+            env = None
+            if self.core_scheduler is not None:
+                threads = self.get_process_threads(fastsurfer_options)
+                env = dict(os.environ, **core_pinning.thread_env(threads))
+            try:
+                process = subprocess.Popen(argv, env=env,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except OSError as e:
+                handle_line('plugin', 'cannot start %s: %s' % (argv[0], e))
+                progress.finish(1)
+                subject_log.close()
+                return 1
+            if self.core_scheduler is not None:
+                self.core_scheduler.register(tag, process.pid, threads)
+            if options.monitor_interval > 0:
+                seg_log = fastsurfer_options.get(
+                    'seg_log', os.path.join(subject_dir, 'scripts', 'deep-seg.log'))
+                logs = [(seg_log, 'seg'),
+                        (os.path.join(subject_dir, 'scripts', 'recon-surf.log'), 'surf')]
+                monitor = resource_monitor.ProcessTreeMonitor(process.pid, logs,
+                                                              options.monitor_interval)
+            try:
+                log_stream.stream_process(process, handle_line)
+            finally:
+                returncode, rusage = resource_monitor.wait_process(process)
+        finally:
+            # also when the launch failed, so that queued subjects are admitted
+            if self.core_scheduler is not None:
+                self.core_scheduler.unregister(tag)
+            if self.memory_gate is not None:
+                self.memory_gate.release(tag)
+        if monitor is not None:
+            self.record_resources(tag, monitor.stop(rusage), returncode, memory_stage, voxels)
+        progress.finish(returncode)
+        subject_log.close()
+        return returncode
+
+    def record_resources(self, tag, report, returncode, memory_stage, voxels):
+        """
+        Keep the resource <report> of the run <tag> and learn its peak memory
+        as that of <memory_stage> for <voxels> if it succeeded.
+        """
+        report['returncode'] = returncode
+        self.resource_reports[tag] = report
+        if self.memory_model is not None and returncode == 0 and report['peak_rss'] > 0:
+            self.memory_model.record(memory_stage, voxels, report['peak_rss'])
+        self.console.line(tag, 'wall %.1fs, cpu %.1fs, peak rss %.1f MiB'
+                          % (report['wall'], report['cpu'], report['peak_rss'] / 1024.0 ** 2))
+
+    def get_process_threads(self, fastsurfer_options):
+        """
+        Return the threads per process of a run_fastsurfer.sh run: --threads
+        per hemisphere, all of them for a segmentation-only run.
+        """
+        threads = fastsurfer_options.get('threads', 1)
+        if 'seg_only' in fastsurfer_options and 'parallel' in fastsurfer_options:
+            threads *= 2
+        return threads
+
+    def get_eval_argv(self, fastsurfer_options, subject_dir):
+        """
+        Return the FastSurferCNN/eval.py command line that run_fastsurfer.sh
+        runs for the segmentation part of <fastsurfer_options>.
+        """
+        values = dict(DEFAULT_WEIGHTS, seg=os.path.join(subject_dir, 'mri',
+                                                        'aparc.DKTatlas+aseg.deep.mgz'))
+        values.update(fastsurfer_options)
+        argv = []
+        for option, flag in sorted(EVAL_ARGS.items()):
+            if option in values:
+                argv += [flag] if values[option] is True else [flag, str(values[option])]
+        return argv + ['--simple_run']
+
+    def launch_seg_worker(self, options, tag, fastsurfer_options, subject_dir):
+        """
+        Run the segmentation part of <fastsurfer_options> in the warm
+        FastSurferCNN worker and return its exit code. Its output is handled as
+        that of run_fastsurfer.sh, and appended to the --seg_log as well.
+
+        The job is admitted under the memory limit, and the worker running it
+        is pinned and monitored for its duration like a run_fastsurfer.sh run.
+        """
+        argv = self.get_eval_argv(fastsurfer_options, subject_dir)
+        seg_log = os.path.abspath(fastsurfer_options.get(
+            'seg_log', os.path.join(subject_dir, 'scripts', 'deep-seg.log')))
+        for path in (argv[argv.index('--out_name') + 1], seg_log):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        subject_log, progress, handle_line = self.open_subject_output(
+            options, tag, 'seg worker: FastSurferCNN/eval.py ' + ' '.join(argv))
+        memory_stage = voxels = None
+        if self.memory_gate is not None:
+            memory_stage, voxels = self.admit_run(tag, fastsurfer_options)
+        monitors = []
+
+        def on_start(pid):
+            if self.core_scheduler is not None:
+                self.core_scheduler.register(tag, pid,
+                                             self.get_process_threads(fastsurfer_options))
+            if options.monitor_interval > 0:
+                monitors.append(resource_monitor.ProcessTreeMonitor(
+                    pid, [(seg_log, 'seg')], options.monitor_interval))
+
+        start = time.time()
+        try:
+            returncode = self.seg_worker.segment(argv, seg_log,
+                                                 lambda line: handle_line('stdout', line),
+                                                 on_start)
+        except (IOError, OSError) as e:
+            handle_line('plugin', 'seg worker failed: %s' % e)
+            returncode = 1
+        finally:
+            if self.core_scheduler is not None:
+                self.core_scheduler.unregister(tag)
+            if self.memory_gate is not None:
+                self.memory_gate.release(tag)
+        self.console.line(tag, 'segmented by the seg worker in %.1fs' % (time.time() - start))
+        if monitors:
+            # the worker outlives the job, so there is no rusage of its own
+            self.record_resources(tag, monitors[0].stop(), returncode, memory_stage, voxels)
+        progress.finish(returncode)
+        subject_log.close()
+        return returncode
+
+    def aggregate_stats(self, options, subjects_dir):
+        """
+        Add the stats of every subject directory in <subjects_dir> not in the
+        cohort table yet, or changed since, and save the table to outputdir.
+        """
+        subject_dirs = {}
+        if os.path.isdir(subjects_dir):
+            subject_dirs = {name: os.path.join(subjects_dir, name)
+                            for name in sorted(os.listdir(subjects_dir))
+                            if os.path.isdir(os.path.join(subjects_dir, name, 'stats'))}
+        parsed = self.stats_table.scan(subject_dirs)
+        subjects, columns = self.save_stats_table(options)
+        print('Stats table: %d subject(s), %d column(s), %d subject(s) parsed after the batch'
+              % (subjects, columns, parsed))
+
+    def save_stats_table(self, options):
+        """
+        Save the cohort stats table to outputdir and return the number of
+        subjects and of value columns.
+        """
+        table_name = 'fastsurfer_stats.csv'
+        columns_name = 'fastsurfer_stats.npz'
+        counts = self.stats_table.save(os.path.join(options.outputdir, table_name),
+                                       os.path.join(options.outputdir, columns_name))
+        self.OUTPUT_META_DICT = dict(self.OUTPUT_META_DICT, statsTable=table_name,
+                                     statsColumns=columns_name)
+        return counts
+
+    def package_subjects(self, options, profiles, results, subjects_dir):
+        """
+        Pack the outputs of the successful subjects among <results> selected by
+        <profiles> into indexed archives in outputdir.
+        """
+        subject_dirs = {result.sid: os.path.join(subjects_dir, result.sid) for result in results
+                        if result.returncode == 0
+                        and os.path.isdir(os.path.join(subjects_dir, result.sid))}
+        if not subject_dirs:
+            print('No subject outputs to package')
+            return
+        report = output_package.pack(subject_dirs, profiles, options.outputdir, 'fastsurfer_outputs')
+        print('Packed %d files (%.1f MiB) of %d subject(s) into %d archive(s) of %.1f MiB, '
+              'indexed in %s' % (report.files, report.bytes / 1024.0 ** 2, len(subject_dirs),
+                                 report.chunks, report.stored / 1024.0 ** 2, report.index))
+        if options.package_prune:
+            for subject_dir in subject_dirs.values():
+                shutil.rmtree(subject_dir)
+        self.OUTPUT_META_DICT = dict(self.OUTPUT_META_DICT, packageProfile=','.join(profiles),
+                                     packageIndex=report.index)
+
+    def save_batch_report(self, options, results, stage_outcomes=None, cached=()):
+        """
+        Save the per-subject exit codes and wall times (and per-stage ones, if
+        any) to outputdir.
+        """
+        subjects = []
+        for result in results:
+            subject = result._asdict()
+            if result.sid in self.tuned_options:
+                subject['tuning'] = self.tuned_options[result.sid]
+            if result.sid in self.staging_reports:
+                subject['staging'] = self.staging_reports[result.sid]
+            if result.sid in self.preflight_reports:
+                subject['preflight'] = self.preflight_reports[result.sid]
+            if result.sid in self.incremental_plans:
+                subject['incremental'] = self.incremental_plans[result.sid]._asdict()
+            if result.sid in self.admission_reports:
+                subject['admission'] = self.admission_reports[result.sid]
+            if stage_outcomes is not None and result.sid in stage_outcomes:
+                subject['stages'] = [outcome._asdict() for outcome in stage_outcomes[result.sid]]
+            subjects.append(subject)
+        report = {'subjects': subjects,
+                  'cached': [result.sid for result in cached],
+                  'failed': [result.sid for result in results if result.returncode != 0]}
+        report_name = 'fastsurfer_batch.json'
+        with open(os.path.join(options.outputdir, report_name), 'w') as f:
+            json.dump(report, f, indent=4)
+        self.OUTPUT_META_DICT = dict(self.OUTPUT_META_DICT, batchReport=report_name)
+
+    def save_resource_report(self, options):
+        """
+        Save the per-subject (and per-stage) timing and resource report to
+        outputdir.
+        """
+        report_name = 'fastsurfer_resources.json'
+        with open(os.path.join(options.outputdir, report_name), 'w') as f:
+            json.dump({'version': self.get_version(), 'runs': self.resource_reports}, f,
+                      indent=4, sort_keys=True)
+        self.OUTPUT_META_DICT = dict(self.OUTPUT_META_DICT, resourceReport=report_name)
+
+    def save_cache_report(self, options):
+        """
+        Save the result cache statistics to outputdir.
+        """
+        stats = self.result_cache.stats()
+        print('Result cache: %(entries)d entries, %(bytes)d bytes, %(hits)d hits, '
+              '%(misses)d misses, %(evictions)d evictions' % stats)
+        report_name = 'fastsurfer_cache.json'
+        with open(os.path.join(options.outputdir, report_name), 'w') as f:
+            json.dump(stats, f, indent=4)
+        self.OUTPUT_META_DICT = dict(self.OUTPUT_META_DICT, cacheReport=report_name)
 
     def show_man_page(self):
         """
@@ -448,3 +1925,4 @@ class Fastsurfer(ChrisApp):
 if __name__ == "__main__":
     chris_app = Fastsurfer()
     chris_app.launch()
+    sys.exit(chris_app.returncode)
@@ -0,0 +1,77 @@
+#
+# fastsurfer ds ChRIS plugin app -- file helpers shared by the plugin modules
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def stream_sha256(f):
+    """
+    Return the sha256 hex digest of the remaining content of the binary file
+    object <f>, read in chunks.
+    """
+    hasher = hashlib.sha256()
+    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+        hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def file_sha256(path):
+    """
+    Return the sha256 hex digest of the content of <path>.
+    """
+    with open(path, 'rb') as f:
+        return stream_sha256(f)
+
+
+class FileDigests(object):
+    """
+    sha256 digests of files memoized on path, size and mtime, so that large
+    files such as the network weights are read once per process however many
+    subjects and features need them.
+    """
+    def __init__(self):
+        self.digests = {}
+
+    def digest(self, path):
+        """
+        Return the sha256 hex digest of <path>.
+        """
+        st = os.stat(path)
+        memo_key = (os.path.abspath(path), st.st_size, st.st_mtime)
+        if memo_key not in self.digests:
+            self.digests[memo_key] = file_sha256(path)
+        return self.digests[memo_key]
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """
+    Yield a temporary file next to <path> opened with <mode>, which replaces
+    <path> when the block completes and is removed if it raises, so that
+    readers only ever see a complete file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
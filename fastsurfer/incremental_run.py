@@ -0,0 +1,129 @@
+#
+# fastsurfer ds ChRIS plugin app -- incremental re-runs of processed subjects
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import json
+import os
+import time
+from collections import namedtuple
+
+from fastsurfer import file_util
+
+
+RECORD_NAME = 'scripts/plugin_options.json'
+
+# what has to run again, in increasing order: nothing, recon-surf up to the
+# CC, recon-surf, the whole pipeline
+LEVELS = ['none', 'cc', 'surf', 'full']
+
+# options whose change invalidates the deep segmentation and all that follows
+SEG_OPTIONS = ('seg', 'order', 'clean_seg', 'no_cuda')
+# options whose change invalidates the surfaces
+SURF_OPTIONS = ('fstess', 'fsqsphere')
+# additional outputs of recon-surf, and of its part up to the CC
+SURF_ADDONS = ('fsaparc', 'surfreg')
+CC_ADDONS = ('vol_segstats',)
+RECORDED_OPTIONS = SEG_OPTIONS + SURF_OPTIONS + SURF_ADDONS + CC_ADDONS
+
+Plan = namedtuple('Plan', ['level', 'reasons'])
+
+
+def make_record(options, inputs):
+    """
+    Return the record of a run with the dict of run_fastsurfer.sh options
+    <options> on the input files whose sha256 digests are mapped by <inputs>.
+    """
+    return {'options': {name: options[name] for name in RECORDED_OPTIONS if name in options},
+            'inputs': inputs, 'finished': time.time()}
+
+
+def load_record(subject_dir):
+    """
+    Return the record of the last run in <subject_dir>, or None.
+    """
+    try:
+        with open(os.path.join(subject_dir, RECORD_NAME)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_record(subject_dir, record):
+    """
+    Atomically save <record> in <subject_dir>.
+    """
+    path = os.path.join(subject_dir, RECORD_NAME)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with file_util.atomic_open(path) as f:
+        json.dump(record, f, indent=4, sort_keys=True)
+
+
+def merge_record(record, new_record, level):
+    """
+    Return the record of a subject with <record> after a run at <level>
+    recorded as <new_record>: a run up to the CC keeps the surfaces and their
+    additional outputs.
+    """
+    if level != 'cc' or record is None:
+        return new_record
+    options = dict(record['options'])
+    options.update((name, value) for name, value in new_record['options'].items()
+                   if name in CC_ADDONS)
+    return dict(new_record, options=options)
+
+
+def plan(record, options, inputs, targets, completed):
+    """
+    Return the Plan (level from LEVELS and the reasons for it) of a run with
+    the dict of run_fastsurfer.sh options <options> on the input digests
+    <inputs>, producing the stages <targets> of a subject with <record> whose
+    stages <completed> have intact outputs.
+    """
+    reasons = []
+
+    def need(level, reason):
+        reasons.append((level, reason))
+
+    if record is None:
+        need('full', 'no record of a previous run')
+    else:
+        recorded = record['options']
+        for name in sorted(inputs):
+            if record['inputs'].get(name) != inputs[name]:
+                need('full', '%s changed' % name)
+        for name in SEG_OPTIONS:
+            if options.get(name) != recorded.get(name):
+                need('full', '--%s changed' % name)
+        surfaces = 'lh' in targets
+        if surfaces:
+            for name in SURF_OPTIONS:
+                if options.get(name) != recorded.get(name):
+                    need('surf', '--%s changed' % name)
+            for name in SURF_ADDONS:
+                if options.get(name) and not recorded.get(name):
+                    need('surf', '--%s added' % name)
+        for name in CC_ADDONS:
+            if options.get(name) and not recorded.get(name):
+                need('cc', '--%s added' % name)
+    for stage in targets:
+        if stage in completed:
+            continue
+        if stage == 'seg':
+            need('full', 'seg outputs missing')
+        elif stage == 'cc' and 'lh' not in targets:
+            need('cc', 'cc outputs missing')
+        else:
+            # recon-surf can only be rerun from its start
+            need('surf', '%s outputs missing' % stage)
+
+    if not reasons:
+        return Plan('none', [])
+    level = max((level for level, _ in reasons), key=LEVELS.index)
+    return Plan(level, [reason for _, reason in reasons])
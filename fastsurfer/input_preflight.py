@@ -0,0 +1,152 @@
+#
+# fastsurfer ds ChRIS plugin app -- preflight validation of the input volumes
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from fastsurfer import file_util
+
+
+# largest deviation in mm of a voxel edge from 1 mm
+VOXEL_SIZE_TOLERANCE = 0.05
+MAX_SCAN_WORKERS = 16
+
+
+def determinant(axes):
+    (a, b, c), (d, e, f), (g, h, i) = axes
+    return a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+
+
+def check_header(header, tolerance=VOXEL_SIZE_TOLERANCE):
+    """
+    Return the list of reasons why the volume of <header> (a VolumeHeader)
+    does not meet the input requirements of FastSurfer: a single 3D frame of
+    1 mm isotropic voxels with a known, non-degenerate orientation.
+    """
+    problems = []
+    if len(header.shape) < 3 or min(header.shape[:3]) < 2:
+        problems.append('not a 3D volume: shape %s' % 'x'.join(map(str, header.shape)))
+    elif any(size > 1 for size in header.shape[3:]):
+        problems.append('%s frames, a single volume is required'
+                        % 'x'.join(map(str, header.shape[3:])))
+    if header.dtype.startswith('unknown'):
+        problems.append('unsupported data type %s' % header.dtype)
+    sizes = header.voxel_size
+    if max(sizes) - min(sizes) > tolerance:
+        problems.append('anisotropic voxels of %s mm' % 'x'.join('%.2f' % size for size in sizes))
+    elif any(abs(size - 1.0) > tolerance for size in sizes):
+        problems.append('%.2f mm voxels, 1 mm is required' % sizes[0])
+    if header.orientation is None:
+        problems.append('unknown orientation (no sform, qform or RAS axes)')
+    elif abs(determinant(header.orientation)) < 1e-6:
+        problems.append('degenerate orientation')
+    return problems
+
+
+def find_license(environ):
+    """
+    Return the FreeSurfer license run_fastsurfer.sh falls back to without
+    --fs_license ($FS_LICENSE, then $FREESURFER_HOME/license.txt or .license),
+    or None if there is none.
+    """
+    candidates = [environ.get('FS_LICENSE')]
+    if environ.get('FREESURFER_HOME'):
+        candidates += [os.path.join(environ['FREESURFER_HOME'], name)
+                       for name in ('license.txt', '.license')]
+    for path in candidates:
+        if path and os.path.isfile(path):
+            return path
+    return None
+
+
+def check_license(path):
+    """
+    Return why <path> is not a usable FreeSurfer license file, or None.
+    """
+    if not os.path.isfile(path):
+        return '%s does not exist' % path
+    try:
+        with open(path) as f:
+            content = f.read().strip()
+    except (IOError, OSError) as e:
+        return 'cannot read %s: %s' % (path, e)
+    if not content:
+        return '%s is empty' % path
+    return None
+
+
+class InputIndex(object):
+    """
+    Index of input volumes: the dict returned by <describe>(path) (header
+    fields and a 'problems' list) plus the size, mtime and sha256 of every
+    file. The index is kept in the JSON file <path> (None: in memory only)
+    and an entry is reused as long as the size and mtime of its file match.
+    """
+    def __init__(self, path, describe):
+        self.path = path
+        self.describe = describe
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+
+    def entry(self, path):
+        """
+        Return the index entry of <path>, inspecting it unless cached.
+        """
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            return {'problems': ['cannot read %s: %s' % (path, e.strerror)]}
+        key = os.path.realpath(path)
+        with self.lock:
+            cached = self.entries.get(key)
+        if cached is not None and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime:
+            return cached
+        entry = dict(self.describe(path), size=st.st_size, mtime=st.st_mtime,
+                     sha256=file_util.file_sha256(path))
+        with self.lock:
+            self.entries[key] = entry
+        return entry
+
+    def scan(self, paths, workers=MAX_SCAN_WORKERS):
+        """
+        Return a dict mapping each of <paths> to its entry, inspecting the
+        files not cached yet in parallel, and save the index.
+        """
+        paths = sorted(set(paths))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+            entries = dict(zip(paths, executor.map(self.entry, paths)))
+        self.save()
+        return entries
+
+    def save(self):
+        """
+        Atomically persist the index.
+        """
+        if self.path is None:
+            return
+        with file_util.atomic_open(self.path) as f:
+            json.dump(self.entries, f, indent=4, sort_keys=True)
+
+
+def longest_first(jobs, cost):
+    """
+    Return <jobs> ordered by decreasing <cost>(job), equal costs in their
+    original order, so that the longest runs do not start last.
+    """
+    return sorted(jobs, key=cost, reverse=True)
@@ -0,0 +1,244 @@
+#
+# fastsurfer ds ChRIS plugin app -- node-local staging of inputs and outputs
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import gzip
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from collections import namedtuple
+
+from fastsurfer import file_util
+
+
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+# compressed T1 extensions and the extension of their decompressed copy
+DECOMPRESSED_EXTENSIONS = [('.nii.gz', '.nii'), ('.mgz', '.mgh')]
+
+# written into every staged-out subject directory, in `sha256sum -c` format
+CHECKSUMS_NAME = os.path.join('scripts', 'plugin_checksums.sha256')
+
+TransferReport = namedtuple('TransferReport', ['destination', 'files', 'bytes', 'seconds'])
+
+
+def is_gzip(path):
+    """
+    Return whether <path> starts with the gzip magic number.
+    """
+    with open(path, 'rb') as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def staged_name(path):
+    """
+    Return the file name of the staged copy of the T1 volume <path>, which is
+    decompressed if <path> is gzip compressed.
+    """
+    name = os.path.basename(path)
+    if is_gzip(path):
+        for compressed, decompressed in DECOMPRESSED_EXTENSIONS:
+            if name.endswith(compressed):
+                return name[:-len(compressed)] + decompressed
+    return name
+
+
+def copy_file(src, dst, decompress=False):
+    """
+    Copy (or gunzip) <src> to <dst> in large chunks and return the sha256 hex
+    digest of the written content.
+    """
+    hasher = hashlib.sha256()
+    opener = gzip.open if decompress else open
+    with opener(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(COPY_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+            fdst.write(chunk)
+    shutil.copystat(src, dst)
+    return hasher.hexdigest()
+
+
+def write_checksums(path, checksums):
+    """
+    Write the dict <checksums> (relative path -> sha256) to <path>.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        for relpath in sorted(checksums):
+            f.write('%s  %s\n' % (checksums[relpath], relpath))
+
+
+def read_checksums(path):
+    """
+    Return the dict (relative path -> sha256) written by write_checksums().
+    """
+    checksums = {}
+    with open(path) as f:
+        for line in f:
+            digest, relpath = line.rstrip('\n').split('  ', 1)
+            checksums[relpath] = digest
+    return checksums
+
+
+def copy_tree(src, dst):
+    """
+    Copy the tree <src> to the new directory <dst>, preserving symlinks.
+    Return the dict (relative path -> sha256) of the copied regular files.
+    """
+    checksums = {}
+    for dirpath, dirnames, filenames in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, reldir))
+        os.makedirs(target_dir, exist_ok=True)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target_dir, name))
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                relpath = os.path.normpath(os.path.join(reldir, name))
+                checksums[relpath] = copy_file(path, os.path.join(target_dir, name))
+    return checksums
+
+
+def verify_tree(root, checksums):
+    """
+    Raise IOError unless the files below <root> have the given checksums.
+    """
+    for relpath, digest in sorted(checksums.items()):
+        if file_util.file_sha256(os.path.join(root, relpath)) != digest:
+            raise IOError('checksum mismatch of %s' % os.path.join(root, relpath))
+
+
+def verify_archive(archive, checksums):
+    """
+    Raise IOError unless the regular members of the tar <archive> are exactly
+    the files of <checksums>, with their checksums.
+    """
+    found = set()
+    with tarfile.open(archive) as tar:
+        for member in tar:
+            relpath = os.path.normpath(member.name).split(os.sep, 1)[-1]
+            if not member.isfile() or relpath == CHECKSUMS_NAME:
+                continue
+            if checksums.get(relpath) != file_util.stream_sha256(tar.extractfile(member)):
+                raise IOError('checksum mismatch of %s in %s' % (member.name, archive))
+            found.add(relpath)
+    missing = set(checksums) - found
+    if missing:
+        raise IOError('%d file(s) missing from %s, e.g. %s' % (len(missing), archive, min(missing)))
+
+
+def replace_path(tmp_path, path):
+    """
+    Move <tmp_path> to <path>, replacing whatever is there.
+    """
+    old_path = None
+    if os.path.lexists(path):
+        old_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.replaced-')
+        os.rename(path, os.path.join(old_path, 'old'))
+    os.rename(tmp_path, path)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+
+def stage_out(subject_dir, dest_dir, compress=False):
+    """
+    Transfer the subject directory <subject_dir> to <dest_dir>/<sid> (or, with
+    <compress>, to the archive <dest_dir>/<sid>.tar.gz) in one bulk pass and
+    verify the transferred files against their checksums before replacing any
+    previous result. Return a TransferReport.
+    """
+    start = time.time()
+    sid = os.path.basename(subject_dir)
+    os.makedirs(dest_dir, exist_ok=True)
+    checksums_path = os.path.join(subject_dir, CHECKSUMS_NAME)
+    if os.path.exists(checksums_path):
+        os.remove(checksums_path)
+    tmp_dir = tempfile.mkdtemp(dir=dest_dir, prefix='.%s-' % sid)
+    try:
+        if compress:
+            destination = os.path.join(dest_dir, sid + '.tar.gz')
+            checksums = {}
+            for dirpath, dirnames, filenames in os.walk(subject_dir):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if not os.path.islink(path):
+                        checksums[os.path.relpath(path, subject_dir)] = file_util.file_sha256(path)
+            write_checksums(checksums_path, checksums)
+            tmp_path = os.path.join(tmp_dir, sid + '.tar.gz')
+            with tarfile.open(tmp_path, 'w:gz', compresslevel=1) as tar:
+                tar.add(subject_dir, arcname=sid)
+            verify_archive(tmp_path, checksums)
+        else:
+            destination = os.path.join(dest_dir, sid)
+            tmp_path = os.path.join(tmp_dir, sid)
+            checksums = copy_tree(subject_dir, tmp_path)
+            write_checksums(os.path.join(tmp_path, CHECKSUMS_NAME), checksums)
+            verify_tree(tmp_path, checksums)
+        replace_path(tmp_path, destination)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    size = sum(os.path.getsize(os.path.join(subject_dir, relpath)) for relpath in checksums)
+    return TransferReport(destination, len(checksums), size, time.time() - start)
+
+
+class StagingArea(object):
+    """
+    Node-local scratch directory in which subjects are processed: every T1 is
+    copied (and decompressed) there once, FastSurfer writes its subject
+    directories to <root>/subjects and finished subjects are transferred back
+    with stage_out().
+    """
+    def __init__(self, scratch_dir):
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.root = tempfile.mkdtemp(dir=scratch_dir, prefix='fastsurfer-')
+        self.subjects_dir = os.path.join(self.root, 'subjects')
+        self.inputs_dir = os.path.join(self.root, 'inputs')
+        os.makedirs(self.subjects_dir)
+        os.makedirs(self.inputs_dir)
+        self.inputs = {}
+
+    def stage_in(self, sid, t1, subject_dir=None):
+        """
+        Stage the T1 volume <t1> of subject <sid>, together with its existing
+        (partial) <subject_dir>, if any, on first use. Return the local T1 path.
+        """
+        if sid in self.inputs:
+            return self.inputs[sid]
+        input_dir = os.path.join(self.inputs_dir, sid)
+        os.makedirs(input_dir, exist_ok=True)
+        local_t1 = os.path.join(input_dir, staged_name(t1))
+        copy_file(t1, local_t1, decompress=os.path.basename(local_t1) != os.path.basename(t1))
+        local_subject_dir = os.path.join(self.subjects_dir, sid)
+        if subject_dir is not None and os.path.isdir(subject_dir) \
+                and not os.path.exists(local_subject_dir):
+            copy_tree(subject_dir, local_subject_dir)
+        self.inputs[sid] = local_t1
+        return local_t1
+
+    def discard(self, sid):
+        """
+        Remove the staged files of subject <sid>.
+        """
+        self.inputs.pop(sid, None)
+        shutil.rmtree(os.path.join(self.inputs_dir, sid), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.subjects_dir, sid), ignore_errors=True)
+
+    def cleanup(self):
+        """
+        Remove the scratch directory.
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
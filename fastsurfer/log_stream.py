@@ -0,0 +1,172 @@
+#
+# fastsurfer ds ChRIS plugin app -- streaming capture of FastSurfer output
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+
+
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 5
+LINE_LIMIT = 1024 * 1024
+
+HEMISPHERE = re.compile(r'\b(lh|rh)\b')
+
+# <event> is one of 'started', 'stage_started', 'stage_finished', 'hemisphere'
+# and 'finished'
+ProgressEvent = namedtuple('ProgressEvent', ['time', 'tag', 'event', 'stage', 'detail'])
+
+
+def log_name(tag):
+    """
+    Return the file name stem of the logs of <tag> (e.g. 'bert:seg' -> 'bert.seg').
+    """
+    return re.sub(r'[^A-Za-z0-9._-]+', '.', tag)
+
+
+class ConsoleWriter(object):
+    """
+    Line-atomic console output shared by all concurrently running subjects.
+    Every line is prefixed with its subject tag; with <progress_only> only
+    progress events are printed.
+    """
+    def __init__(self, stream=None, progress_only=False):
+        self.stream = stream or sys.stdout
+        self.progress_only = progress_only
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        with self.lock:
+            self.stream.write(text)
+            self.stream.flush()
+
+    def line(self, tag, text):
+        if not self.progress_only:
+            self.write('[%s] %s\n' % (tag, text))
+
+    def event(self, event):
+        detail = ' (%s)' % event.detail if event.detail not in (None, '') else ''
+        stage = ' %s' % event.stage if event.stage else ''
+        self.write('[%s] >> %s%s%s\n' % (event.tag, event.event, stage, detail))
+
+
+class SubjectLog(object):
+    """
+    Rotating log file of the output of one subject, <logdir>/<tag>.log, and
+    its structured progress events, <logdir>/<tag>.events.jsonl.
+    """
+    def __init__(self, logdir, tag, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        os.makedirs(logdir, exist_ok=True)
+        name = log_name(tag)
+        self.path = os.path.join(logdir, name + '.log')
+        self.handler = logging.handlers.RotatingFileHandler(self.path, maxBytes=max_bytes,
+                                                            backupCount=backups)
+        self.handler.setFormatter(logging.Formatter('%(asctime)s %(stream)s %(message)s'))
+        self.logger = logging.Logger('fastsurfer.' + name)
+        self.logger.addHandler(self.handler)
+        self.events_path = os.path.join(logdir, name + '.events.jsonl')
+        self.events = open(self.events_path, 'a')
+
+    def write_line(self, stream, text):
+        self.logger.info(text, extra={'stream': stream})
+
+    def write_event(self, event):
+        self.events.write(json.dumps(event._asdict()) + '\n')
+        self.events.flush()
+
+    def close(self):
+        self.handler.close()
+        self.events.close()
+
+
+class ProgressParser(object):
+    """
+    Turn the output lines of a FastSurfer run into ProgressEvents passed to
+    <emit>. <classify>(line) returns the name of the stage a line starts, or
+    None; every stage is reported once.
+    """
+    def __init__(self, tag, classify, emit):
+        self.tag = tag
+        self.classify = classify
+        self.emit = emit
+        self.stage = None
+        self.seen = set()
+        self.lock = threading.Lock()
+        self.event('started')
+
+    def event(self, event, stage=None, detail=None):
+        self.emit(ProgressEvent(time.time(), self.tag, event, stage, detail))
+
+    def feed(self, line):
+        stage = self.classify(line)
+        if stage is None:
+            return
+        with self.lock:
+            if stage in self.seen:
+                return
+            self.seen.add(stage)
+            if self.stage is not None:
+                self.event('stage_finished', self.stage)
+            self.stage = stage
+            self.event('stage_started', stage)
+            hemisphere = HEMISPHERE.search(stage)
+            if hemisphere:
+                self.event('hemisphere', stage, hemisphere.group(1))
+
+    def finish(self, returncode):
+        with self.lock:
+            if self.stage is not None and returncode == 0:
+                self.event('stage_finished', self.stage)
+            self.event('finished', self.stage, returncode)
+
+
+async def pump(pipe, name, handle_line):
+    """
+    Read <pipe> line by line until EOF, calling <handle_line>(name, line).
+    """
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=LINE_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except asyncio.IncompleteReadError as e:
+            # last line without a newline, empty at EOF
+            line = e.partial
+        except asyncio.LimitOverrunError as e:
+            # line longer than LINE_LIMIT, still buffered: pass it on in pieces
+            line = await reader.read(max(1, e.consumed))
+        if not line:
+            return
+        handle_line(name, line.decode(errors='replace').rstrip('\r\n'))
+
+
+def stream_process(process, handle_line):
+    """
+    Stream the stdout and stderr pipes of the subprocess.Popen <process> to
+    <handle_line>(stream_name, line) until both are closed. Runs its own event
+    loop, so it can be called from any thread.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(asyncio.gather(pump(process.stdout, 'stdout', handle_line),
+                                               pump(process.stderr, 'stderr', handle_line)))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,151 @@
+#
+# fastsurfer ds ChRIS plugin app -- memory-bounded admission of FastSurfer runs
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+# samples per stage the model is fitted on
+MAX_SAMPLES = 50
+# predicted peaks are inflated by this factor
+SAFETY_FACTOR = 1.1
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS peaks (
+    stage     TEXT    NOT NULL,
+    voxels    INTEGER NOT NULL,
+    peak_rss  INTEGER NOT NULL,
+    recorded  REAL    NOT NULL
+)
+'''
+
+
+def fit_peak(samples, voxels):
+    """
+    Return the peak memory predicted for an input of <voxels> voxels by the
+    list of (voxels, peak) <samples>: a least-squares line through the
+    samples raised by their largest residual, or the largest peak scaled by
+    the input size if the samples do not determine a line.
+    """
+    xs = [float(x) for x, _ in samples]
+    ys = [float(y) for _, y in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if variance > 0:
+        slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+        if slope >= 0:
+            intercept = mean_y - slope * mean_x
+            residual = max(y - (intercept + slope * x) for x, y in zip(xs, ys))
+            return intercept + slope * voxels + max(0.0, residual)
+    return max(ys) * max(1.0, voxels / mean_x if mean_x else 1.0)
+
+
+class PeakMemoryModel(object):
+    """
+    Peak resident memory of FastSurfer stages as a function of the input
+    volume size, learned from measured runs and persisted in the SQLite
+    database <path>.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(SCHEMA)
+        self.samples = {}
+        rows = self.connection.execute('SELECT stage, voxels, peak_rss FROM peaks ORDER BY recorded')
+        for stage, voxels, peak in rows:
+            self.samples.setdefault(stage, deque(maxlen=MAX_SAMPLES)).append((voxels, peak))
+
+    def record(self, stage, voxels, peak_rss):
+        """
+        Add a measured peak of <stage> for an input of <voxels> voxels.
+        """
+        with self.lock:
+            self.samples.setdefault(stage, deque(maxlen=MAX_SAMPLES)).append((voxels, peak_rss))
+            with self.connection:
+                self.connection.execute('INSERT INTO peaks VALUES (?, ?, ?, ?)',
+                                        (stage, int(voxels), int(peak_rss), time.time()))
+
+    def predict(self, stage, voxels, parts=()):
+        """
+        Return the predicted peak of <stage> in bytes. Without samples of
+        <stage>, return the largest prediction of the stages <parts> it runs
+        one after the other, or None if any of them has no samples either.
+        """
+        with self.lock:
+            samples = list(self.samples.get(stage, ()))
+        if samples:
+            return int(fit_peak(samples, voxels) * SAFETY_FACTOR)
+        predictions = [self.predict(part, voxels) for part in parts]
+        if not predictions or None in predictions:
+            return None
+        return max(predictions)
+
+    def stats(self):
+        """
+        Return a dict mapping every stage to its number of samples.
+        """
+        with self.lock:
+            return {stage: len(samples) for stage, samples in self.samples.items()}
+
+    def close(self):
+        self.connection.close()
+
+
+class MemoryGate(object):
+    """
+    Admit work in arrival order while the sum of the predicted peaks of the
+    admitted work fits in <limit> bytes. Work is always admitted when nothing
+    else runs, so that a prediction above the limit cannot block forever.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.reserved = {}
+        self.waiting = deque()
+        self.condition = threading.Condition()
+
+    def fits(self, predicted):
+        return not self.reserved or sum(self.reserved.values()) + predicted <= self.limit
+
+    def admit(self, tag, predicted, on_wait=None):
+        """
+        Block until <predicted> bytes can be reserved for <tag>. <on_wait>() is
+        called once if it has to wait. Return the seconds waited.
+        """
+        start = time.time()
+        with self.condition:
+            self.waiting.append(tag)
+            waited = False
+            while self.waiting[0] != tag or not self.fits(predicted):
+                if not waited and on_wait is not None:
+                    on_wait()
+                waited = True
+                self.condition.wait()
+            self.waiting.popleft()
+            self.reserved[tag] = predicted
+            self.condition.notify_all()
+        return time.time() - start
+
+    def release(self, tag):
+        """
+        Return the reservation of <tag>.
+        """
+        with self.condition:
+            self.reserved.pop(tag, None)
+            self.condition.notify_all()
+
+    def in_use(self):
+        with self.condition:
+            return sum(self.reserved.values())
@@ -0,0 +1,222 @@
+#
+# fastsurfer ds ChRIS plugin app -- chunked archives of selected subject outputs
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import fnmatch
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from fastsurfer import file_util
+
+
+# the subject files (patterns relative to the subject directory) of each profile
+PROFILES = {
+    'seg': ['mri/orig.mgz', 'mri/mask.mgz', 'mri/aparc.DKTatlas+aseg.deep.mgz',
+            'mri/aparc.DKTatlas+aseg.deep.withCC.mgz', 'mri/aseg.auto_noCCseg.mgz',
+            'mri/aseg.auto.mgz', 'mri/aparc.DKTatlas+aseg.mapped.mgz'],
+    'stats': ['stats/*.stats'],
+    'surfaces': ['surf/?h.*', 'label/?h.*.annot'],
+    'full': ['*'],
+}
+
+CHUNK_SIZE = 1024 ** 3
+COMPRESS_LEVEL = 6
+MAX_PACK_WORKERS = 8
+GZIP_MAGIC = b'\x1f\x8b'
+INDEX_VERSION = 1
+
+# <files> and <bytes> are the packed files and their uncompressed size,
+# <stored> the size of the archives
+PackageReport = namedtuple('PackageReport', ['index', 'chunks', 'files', 'bytes', 'stored'])
+
+
+def parse_profiles(value):
+    """
+    Return the list of profile names in the comma-separated <value>, raising
+    ValueError on unknown ones.
+    """
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in names if name not in PROFILES]
+    if unknown or not names:
+        raise ValueError('unknown package profile %s, expected one or more of %s'
+                         % (', '.join(unknown) or repr(value), ', '.join(sorted(PROFILES))))
+    return names
+
+
+def select_files(subject_dir, profiles):
+    """
+    Return the sorted paths relative to <subject_dir> of its files selected by
+    any of the <profiles>. Symbolic links are packed as the files they point
+    to, dangling ones are left out.
+    """
+    patterns = [pattern for name in profiles for pattern in PROFILES[name]]
+    selected = []
+    for root, _, files in os.walk(subject_dir):
+        for name in files:
+            path = os.path.join(root, name)
+            if not os.path.exists(path):
+                continue
+            relpath = os.path.relpath(path, subject_dir).replace(os.sep, '/')
+            if any(fnmatch.fnmatch(relpath, pattern) for pattern in patterns):
+                selected.append(relpath)
+    return sorted(selected)
+
+
+def encode_file(path, level=COMPRESS_LEVEL):
+    """
+    Return the stored content of <path>, its encoding ('gzip', or 'identity'
+    for files that are gzip compressed already), size and sha256 hex digest.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if data[:2] == GZIP_MAGIC:
+        return data, 'identity', len(data), digest
+    return gzip.compress(data, compresslevel=level), 'gzip', len(data), digest
+
+
+def bounded_map(executor, fn, items, window):
+    """
+    Yield <fn>(item) for <items> in order, computing at most <window> of
+    them ahead so that the results do not pile up in memory.
+    """
+    pending = []
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+class ChunkWriter(object):
+    """
+    Uncompressed tar archive <path>, written member by member to a temporary
+    file that atomically replaces <path> when closed (see file_util.atomic_open).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.opened = file_util.atomic_open(path, 'wb')
+        self.tar = tarfile.open(fileobj=self.opened.__enter__(), mode='w',
+                                format=tarfile.PAX_FORMAT)
+        self.stored = 0
+
+    def add(self, name, data):
+        """
+        Append the member <name> of content <data> and return the offset of
+        its data, which the member ends with up to the block padding.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        self.stored += len(data)
+        blocks = (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE
+        return self.tar.offset - blocks * tarfile.BLOCKSIZE
+
+    def close(self):
+        self.tar.close()
+        self.opened.__exit__(None, None, None)
+
+
+def pack(subject_dirs, profiles, dest_dir, prefix, chunk_size=CHUNK_SIZE,
+         workers=MAX_PACK_WORKERS):
+    """
+    Pack the files selected by <profiles> of every subject in <subject_dirs>
+    (a dict mapping subject ids to directories) into <dest_dir> as
+    <prefix>.NNN.tar archives of about <chunk_size> stored bytes each.
+
+    Every file is a tar member named <sid>/<relpath>, gzip compressed into
+    <sid>/<relpath>.gz unless it already is, so the archives extract with
+    standard tools. The JSON index <prefix>.index.json lists for every file
+    its archive and member, the offset and length of its data in the
+    archive, its encoding, size and sha256, so that a single file can be
+    read without extracting the rest (see read_file). Archives of an earlier
+    package with the same prefix are removed. Return a PackageReport.
+    """
+    index_path = os.path.join(dest_dir, prefix + '.index.json')
+    previous = load_index(index_path)
+    sources = [('%s/%s' % (sid, relpath), os.path.join(subject_dirs[sid], relpath))
+               for sid in sorted(subject_dirs)
+               for relpath in select_files(subject_dirs[sid], profiles)]
+
+    files = {}
+    chunks = []
+    writer = None
+
+    def close_chunk(writer):
+        writer.close()
+        chunks.append({'name': os.path.basename(writer.path),
+                       'size': os.path.getsize(writer.path), 'sha256': file_util.file_sha256(writer.path)})
+
+    # every member goes straight into the open archive, so only the encoded
+    # files of the bounded_map window are held in memory
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        encoded = bounded_map(executor, lambda source: encode_file(source[1]), sources,
+                              2 * max(1, workers))
+        for (member, _), (data, encoding, size, digest) in zip(sources, encoded):
+            if writer is not None and writer.stored + len(data) > chunk_size:
+                close_chunk(writer)
+                writer = None
+            if writer is None:
+                writer = ChunkWriter(os.path.join(dest_dir, '%s.%03d.tar' % (prefix, len(chunks))))
+            name = member + ('.gz' if encoding == 'gzip' else '')
+            files[member] = {'member': name, 'encoding': encoding, 'size': size, 'sha256': digest,
+                             'chunk': os.path.basename(writer.path),
+                             'offset': writer.add(name, data), 'length': len(data)}
+    if writer is not None:
+        close_chunk(writer)
+
+    index = {'version': INDEX_VERSION, 'profiles': profiles, 'chunks': chunks, 'files': files}
+    with file_util.atomic_open(index_path) as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    if previous is not None:
+        current = set(chunk['name'] for chunk in chunks)
+        for chunk in previous['chunks']:
+            path = os.path.join(dest_dir, chunk['name'])
+            if chunk['name'] not in current and os.path.isfile(path):
+                os.remove(path)
+    return PackageReport(os.path.basename(index_path), len(chunks), len(files),
+                         sum(entry['size'] for entry in files.values()),
+                         sum(chunk['size'] for chunk in chunks))
+
+
+def load_index(path):
+    """
+    Return the package index <path>, or None.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def read_file(index_path, name):
+    """
+    Return the original content of the file <name> (<sid>/<relpath>) of the
+    package indexed by <index_path>, raising KeyError if it is not packed and
+    ValueError if its checksum does not match.
+    """
+    with open(index_path) as f:
+        entry = json.load(f)['files'][name]
+    with open(os.path.join(os.path.dirname(index_path), entry['chunk']), 'rb') as f:
+        f.seek(entry['offset'])
+        data = f.read(entry['length'])
+    if entry['encoding'] == 'gzip':
+        data = gzip.decompress(data)
+    if hashlib.sha256(data).hexdigest() != entry['sha256']:
+        raise ValueError('checksum mismatch for %s' % name)
+    return data
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# fastsurfer ds ChRIS plugin app -- precomputed plugin descriptor
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+# The ChRIS store and CUBE call the plugin with --json, --savejson, --meta,
+# --man or --version to register it. These only describe the plugin, so
+# their output is generated once at image build time with
+#
+#   python -m fastsurfer.plugin_descriptor
+#
+# and served from the resulting JSON file without importing the ChRIS app
+# framework or defining the plugin's parameters.
+#
+
+
+import io
+import json
+import os
+from contextlib import redirect_stdout
+
+from fastsurfer import file_util
+
+
+SELFPATH = os.path.dirname(os.path.abspath(__file__))
+DESCRIPTOR_PATH = os.path.join(SELFPATH, 'fastsurfer_descriptor.json')
+SOURCE_PATH = os.path.join(SELFPATH, 'fastsurfer.py')
+
+
+def source_digest(source_path=SOURCE_PATH):
+    """
+    Return the sha256 hex digest of the plugin source the descriptor is
+    generated from, used to detect a stale descriptor.
+    """
+    return file_util.file_sha256(source_path)
+
+
+def captured_output(fn):
+    """
+    Return what <fn>() prints.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        fn()
+    return output.getvalue()
+
+
+def generate(app, descriptor_path=DESCRIPTOR_PATH, source_path=SOURCE_PATH):
+    """
+    Write the descriptor of the ChrisApp instance <app> to <descriptor_path>.
+    """
+    descriptor = {'source_sha256': source_digest(source_path),
+                  'class_name': app.__class__.__name__,
+                  'version': app.get_version(),
+                  'representation': app.get_json_representation(),
+                  'meta': captured_output(app.print_app_meta_data).splitlines(),
+                  'man': captured_output(app.show_man_page)}
+    with open(descriptor_path, 'w') as f:
+        json.dump(descriptor, f)
+
+
+def load(descriptor_path=DESCRIPTOR_PATH, source_path=SOURCE_PATH):
+    """
+    Return the descriptor, or None if it is missing or stale.
+    """
+    try:
+        with open(descriptor_path) as f:
+            descriptor = json.load(f)
+        if descriptor.get('source_sha256') != source_digest(source_path):
+            return None
+    except (IOError, OSError, ValueError):
+        return None
+    # the plugin may have been moved since the descriptor was generated
+    descriptor['representation']['selfpath'] = SELFPATH
+    descriptor['meta'] = ['%20s: %s' % ('SELFPATH', SELFPATH)
+                          if line.strip().startswith('SELFPATH:') else line
+                          for line in descriptor['meta']]
+    return descriptor
+
+
+def serve(argv, descriptor_path=DESCRIPTOR_PATH, source_path=SOURCE_PATH):
+    """
+    Handle a descriptor-only invocation (exactly one of --json, --meta, --man,
+    --version or --savejson <DIR>) from the descriptor. Return False if
+    <argv> is anything else or the descriptor is unusable, so that the caller
+    falls back to the ChRIS app framework.
+    """
+    if not (len(argv) == 1 and argv[0] in ('--json', '--meta', '--man', '--version')
+            or len(argv) == 2 and argv[0] == '--savejson' and os.path.isdir(argv[1])):
+        return False
+    descriptor = load(descriptor_path, source_path)
+    if descriptor is None:
+        return False
+    flag = argv[0]
+    if flag == '--json':
+        print(json.dumps(descriptor['representation']))
+    elif flag == '--savejson':
+        with open(os.path.join(argv[1], descriptor['class_name'] + '.json'), 'w') as f:
+            json.dump(descriptor['representation'], f)
+    elif flag == '--meta':
+        print('\n'.join(descriptor['meta']))
+    elif flag == '--man':
+        print(descriptor['man'], end='')
+    else:
+        print(descriptor['version'])
+    return True
+
+
+if __name__ == '__main__':
+    from fastsurfer.fastsurfer import Fastsurfer
+    generate(Fastsurfer())
+    print('descriptor written to %s' % DESCRIPTOR_PATH)
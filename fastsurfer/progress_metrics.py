@@ -0,0 +1,301 @@
+#
+# fastsurfer ds ChRIS plugin app -- progress and throughput metrics of a batch
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from fastsurfer import file_util
+
+
+METRICS_INTERVAL = 10.0
+# stage and subject durations the averages are taken over
+RECENT_DURATIONS = 20
+# the stages a subject is run in separately, appended to its tag as <sid>:<stage>
+RUN_STAGES = ('seg', 'surf')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def subject_of(tag):
+    """
+    Return the subject id of the run tagged <tag>.
+    """
+    sid, _, stage = tag.rpartition(':')
+    return sid if sid and stage in RUN_STAGES else tag
+
+
+def escape_label(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_sample(name, value, labels=None):
+    """
+    Return a line of the Prometheus text format.
+    """
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, escape_label(labels[key]))
+                                  for key in sorted(labels))
+    return '%s %s' % (name, repr(float(value)))
+
+
+class ProgressMetrics(object):
+    """
+    Progress of a batch of the subjects <sids>, run by <workers> workers on
+    <cpus> cores with <memory> bytes: the subjects queued, running and done,
+    the current stage of every running one, recent stage and subject
+    durations, the CPU and memory use returned by <sample>() as
+    (cpu_seconds, rss_bytes) of the plugin process tree and the projected
+    completion time.
+    """
+    def __init__(self, sids, workers, cpus, memory, sample=None, clock=time.time):
+        self.workers = max(1, workers)
+        self.cpus = cpus
+        self.memory = memory
+        self.sample = sample
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.queued = list(sids)
+        self.running = {}
+        self.done = 0
+        self.failed = 0
+        self.stages = {}
+        self.stage_starts = {}
+        self.stage_durations = {}
+        self.stage_counts = {}
+        self.subject_durations = deque(maxlen=RECENT_DURATIONS)
+        self.started = clock()
+        self.last_event = self.started
+        self.last_sample = None
+        self.cpu_cores = 0.0
+        self.rss = 0
+
+    def subject_started(self, sid):
+        """
+        Count subject <sid> as running, from its first run on.
+        """
+        with self.lock:
+            if sid in self.running:
+                return
+            if sid in self.queued:
+                self.queued.remove(sid)
+            self.running[sid] = self.clock()
+            self.last_event = self.clock()
+
+    def subject_finished(self, sid, returncode):
+        """
+        Count subject <sid> as done, or failed if <returncode> is not 0.
+        """
+        with self.lock:
+            now = self.clock()
+            if sid in self.queued:
+                self.queued.remove(sid)
+            start = self.running.pop(sid, None)
+            if start is not None and returncode == 0:
+                self.subject_durations.append(now - start)
+            self.done += 1
+            if returncode != 0:
+                self.failed += 1
+            self.stages.pop(sid, None)
+            self.last_event = now
+
+    def on_event(self, event):
+        """
+        Progress listener: follow the stages of the log_stream.ProgressEvent <event>.
+        """
+        sid = subject_of(event.tag)
+        with self.lock:
+            self.last_event = event.time
+            if event.event == 'stage_started':
+                self.stages[sid] = event.stage
+                self.stage_starts[(event.tag, event.stage)] = event.time
+            elif event.event == 'stage_finished':
+                start = self.stage_starts.pop((event.tag, event.stage), None)
+                if start is not None:
+                    self.stage_durations.setdefault(
+                        event.stage, deque(maxlen=RECENT_DURATIONS)).append(event.time - start)
+                    self.stage_counts[event.stage] = self.stage_counts.get(event.stage, 0) + 1
+            elif event.event == 'finished':
+                self.stages.pop(sid, None)
+
+    def sample_usage(self):
+        """
+        Sample the CPU and memory use, the CPU use as the cores busy since the
+        previous sample.
+        """
+        if self.sample is None:
+            return
+        now = self.clock()
+        cpu, rss = self.sample()
+        with self.lock:
+            if self.last_sample is not None and now > self.last_sample[0]:
+                # CPU time of processes that exited in between is lost
+                self.cpu_cores = max(0.0, (cpu - self.last_sample[1]) / (now - self.last_sample[0]))
+            self.last_sample = (now, cpu)
+            self.rss = rss
+
+    def projected_completion(self):
+        """
+        Return the projected completion time of the batch, or None until a
+        subject has finished: the subjects left times their mean recent
+        duration, shared among the workers.
+        """
+        with self.lock:
+            if not self.queued and not self.running:
+                return self.last_event
+            if not self.subject_durations:
+                return None
+            mean = sum(self.subject_durations) / len(self.subject_durations)
+            now = self.clock()
+            # a running subject takes the mean duration, an overdue one finishes now
+            left = sum(max(0.0, mean - (now - start)) for start in self.running.values())
+            return now + (len(self.queued) * mean + left) / self.workers
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        completion = self.projected_completion()
+        with self.lock:
+            running = len(self.running)
+            metrics = [
+                ('fastsurfer_subjects', 'gauge', 'Subjects of the batch by state.',
+                 [({'state': 'queued'}, len(self.queued)), ({'state': 'running'}, running),
+                  ({'state': 'done'}, self.done)]),
+                ('fastsurfer_subjects_failed', 'gauge', 'Subjects that finished with an error.',
+                 [(None, self.failed)]),
+                ('fastsurfer_subject_stage', 'gauge', 'Current stage of every running subject.',
+                 [({'subject': sid, 'stage': stage}, 1)
+                  for sid, stage in sorted(self.stages.items())]),
+                ('fastsurfer_stage_duration_seconds', 'gauge',
+                 'Mean duration of the recent runs of every stage.',
+                 [({'stage': stage}, sum(durations) / len(durations))
+                  for stage, durations in sorted(self.stage_durations.items())]),
+                ('fastsurfer_stage_completed_total', 'counter', 'Completed runs of every stage.',
+                 [({'stage': stage}, count) for stage, count in sorted(self.stage_counts.items())]),
+                ('fastsurfer_subject_duration_seconds', 'gauge',
+                 'Mean duration of the recent successful subjects.',
+                 [(None, sum(self.subject_durations) / len(self.subject_durations))]
+                 if self.subject_durations else []),
+                ('fastsurfer_cpu_cores_used', 'gauge', 'Cores busy in the plugin process tree.',
+                 [(None, self.cpu_cores)]),
+                ('fastsurfer_cpu_cores', 'gauge', 'Cores available to the plugin.',
+                 [(None, self.cpus)]),
+                ('fastsurfer_memory_rss_bytes', 'gauge',
+                 'Resident memory of the plugin process tree.', [(None, self.rss)]),
+                ('fastsurfer_memory_bytes', 'gauge', 'Memory available to the plugin.',
+                 [(None, self.memory)]),
+                ('fastsurfer_workers', 'gauge', 'Subjects run concurrently.',
+                 [(None, self.workers)]),
+                ('fastsurfer_start_timestamp_seconds', 'gauge', 'Start of the batch.',
+                 [(None, self.started)]),
+                ('fastsurfer_last_progress_timestamp_seconds', 'gauge',
+                 'Time of the last stage or subject event, to detect stalls.',
+                 [(None, self.last_event)]),
+                ('fastsurfer_projected_completion_timestamp_seconds', 'gauge',
+                 'Projected completion of the batch.',
+                 [(None, completion)] if completion is not None else []),
+            ]
+        lines = []
+        for name, kind, description, samples in metrics:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(format_sample(name, value, labels) for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsPublisher(object):
+    """
+    Sample <metrics> every <interval> seconds and rewrite them to the file
+    <path>, if given, and serve them on http://<address>:<port>/metrics, if
+    <port> is given (0: any free port).
+    """
+    def __init__(self, metrics, path=None, address='127.0.0.1', port=None,
+                 interval=METRICS_INTERVAL):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.write_failed = False
+        self.server = None
+        if port is not None:
+            self.server = ThreadingHTTPServer((address, port), self.handler_class())
+        self.thread = threading.Thread(target=self.publish, daemon=True)
+
+    @property
+    def port(self):
+        return self.server.server_address[1] if self.server is not None else None
+
+    def handler_class(self):
+        metrics = self.metrics
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return MetricsHandler
+
+    def start(self):
+        if self.server is not None:
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.thread.start()
+        return self
+
+    def publish(self):
+        while True:
+            self.metrics.sample_usage()
+            self.write()
+            if self.stopped.wait(self.interval):
+                return
+
+    def write(self):
+        """
+        Atomically rewrite the metrics file. A failure is reported until the
+        next successful write and does not stop the publishing.
+        """
+        if not self.path:
+            return
+        try:
+            with file_util.atomic_open(self.path) as f:
+                f.write(self.metrics.render())
+        except (IOError, OSError) as e:
+            if not self.write_failed:
+                print('cannot write the metrics to %s: %s' % (self.path, e), flush=True)
+            self.write_failed = True
+            return
+        self.write_failed = False
+
+    def stop(self):
+        """
+        Stop sampling and serving, leaving the final metrics in the file.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
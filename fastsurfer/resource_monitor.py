@@ -0,0 +1,228 @@
+#
+# fastsurfer ds ChRIS plugin app -- process tree resource instrumentation
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import os
+import re
+import threading
+import time
+
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# FastSurferCNN (--seg_log) lines announcing the network of each view
+SEG_LOG_MARKERS = [
+    (re.compile(r'\bsagittal\b', re.IGNORECASE), 'seg_sagittal'),
+    (re.compile(r'\baxial\b', re.IGNORECASE), 'seg_axial'),
+    (re.compile(r'\bcoronal\b', re.IGNORECASE), 'seg_coronal'),
+]
+
+# recon-surf.log section headings, e.g. '======= Creating surfaces lh ======='
+RECON_SURF_HEADING = re.compile(r'^\s*=+\s*(.*?)\s*=+\s*$')
+
+
+def read_proc_stat(pid):
+    """
+    Return (ppid, cpu_seconds) of process <pid> from /proc/<pid>/stat.
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        stat = f.read()
+    # the command name may contain spaces and parentheses, skip past it
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / float(CLOCK_TICKS)
+
+
+def read_proc_rss(pid):
+    """
+    Return the resident set size of process <pid> in bytes.
+    """
+    with open('/proc/%d/statm' % pid) as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def read_proc_io(pid):
+    """
+    Return (read_bytes, write_bytes) of process <pid>, (0, 0) if unavailable.
+    """
+    counters = {}
+    try:
+        with open('/proc/%d/io' % pid) as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (IOError, OSError, ValueError):
+        pass
+    return counters.get('read_bytes', 0), counters.get('write_bytes', 0)
+
+
+def process_tree(root_pid):
+    """
+    Return the pids of <root_pid> and all its descendants.
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid = read_proc_stat(int(entry))[0]
+        except (IOError, OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(children.get(pid, []))
+    return tree
+
+
+class LogTail(object):
+    """
+    Follow a log file from its current end, tolerating that it does not exist yet.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.offset = os.path.getsize(path) if os.path.isfile(path) else 0
+        self.partial = ''
+
+    def read_lines(self):
+        """
+        Return the complete lines appended since the last call.
+        """
+        try:
+            with open(self.path, errors='replace') as f:
+                f.seek(self.offset)
+                data = f.read()
+                self.offset = f.tell()
+        except (IOError, OSError):
+            return []
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return lines
+
+
+def stage_from_line(line, kind):
+    """
+    Return the stage started by log <line>, or None. <kind> is 'seg' for the
+    FastSurferCNN log and 'surf' for the recon-surf log.
+    """
+    if kind == 'seg':
+        for pattern, stage in SEG_LOG_MARKERS:
+            if pattern.search(line):
+                return stage
+        return None
+    match = RECON_SURF_HEADING.match(line)
+    if match and match.group(1):
+        return 'surf: %s' % match.group(1)
+    return None
+
+
+class ProcessTreeMonitor(object):
+    """
+    Sample wall time, CPU time, resident memory and I/O bytes of a process and
+    its descendants, splitting the run into stages announced in its log files.
+
+    <logs> is a list of (path, kind) pairs, see stage_from_line().
+    """
+    def __init__(self, pid, logs=(), interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.tails = [(LogTail(path), kind) for path, kind in logs]
+        self.start = time.time()
+        # last seen counters of every process of the tree, kept after it exits
+        self.cpu = {}
+        self.io = {}
+        self.peak_rss = 0
+        self.seen_stages = set()
+        self.stages = []
+        self.open_stage('startup')
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+
+    def totals(self):
+        return (sum(self.cpu.values()),
+                sum(io[0] for io in self.io.values()),
+                sum(io[1] for io in self.io.values()))
+
+    def open_stage(self, name):
+        now = time.time()
+        cpu, read_bytes, write_bytes = self.totals()
+        if self.stages:
+            self.close_stage(now, cpu, read_bytes, write_bytes)
+        self.stages.append({'name': name, 'start': now - self.start, 'peak_rss': 0,
+                            '_cpu': cpu, '_read': read_bytes, '_write': write_bytes})
+
+    def close_stage(self, now, cpu, read_bytes, write_bytes):
+        stage = self.stages[-1]
+        stage['wall'] = now - self.start - stage['start']
+        stage['cpu'] = cpu - stage.pop('_cpu')
+        stage['read_bytes'] = read_bytes - stage.pop('_read')
+        stage['write_bytes'] = write_bytes - stage.pop('_write')
+
+    def sample(self):
+        rss = 0
+        for pid in process_tree(self.pid):
+            try:
+                self.cpu[pid] = read_proc_stat(pid)[1]
+                rss += read_proc_rss(pid)
+                self.io[pid] = read_proc_io(pid)
+            except (IOError, OSError, ValueError, IndexError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss)
+        self.stages[-1]['peak_rss'] = max(self.stages[-1]['peak_rss'], rss)
+        for tail, kind in self.tails:
+            for line in tail.read_lines():
+                stage = stage_from_line(line, kind)
+                if stage is not None and stage not in self.seen_stages:
+                    self.seen_stages.add(stage)
+                    self.open_stage(stage)
+
+    def poll(self):
+        while True:
+            self.sample()
+            if self.stopped.wait(self.interval):
+                return
+
+    def stop(self, rusage=None):
+        """
+        Stop sampling and return the report as a dict. <rusage> is the
+        resource usage of the terminated process tree as returned by
+        os.wait4(); it supersedes the sampled CPU time, which misses processes
+        living shorter than the sampling interval.
+        """
+        self.stopped.set()
+        self.thread.join()
+        now = time.time()
+        cpu, read_bytes, write_bytes = self.totals()
+        self.close_stage(now, cpu, read_bytes, write_bytes)
+        report = {'wall': now - self.start, 'cpu': cpu, 'peak_rss': self.peak_rss,
+                  'read_bytes': read_bytes, 'write_bytes': write_bytes,
+                  'stages': self.stages}
+        if rusage is not None:
+            report['cpu'] = rusage.ru_utime + rusage.ru_stime
+            report['cpu_user'] = rusage.ru_utime
+            report['cpu_system'] = rusage.ru_stime
+            # ru_maxrss is in kilobytes on Linux
+            report['peak_rss_single_process'] = rusage.ru_maxrss * 1024
+        return report
+
+
+def wait_process(process):
+    """
+    Reap the subprocess.Popen <process> with os.wait4() and return its exit
+    code (negative signal number if killed) and resource usage.
+    """
+    pid, status, rusage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    process.returncode = returncode
+    return returncode, rusage
@@ -0,0 +1,126 @@
+#
+# fastsurfer ds ChRIS plugin app -- resource-aware tuning of FastSurfer options
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import math
+import os
+from collections import namedtuple
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# FastSurferCNN conforms every input to a 256^3 1mm volume
+CONFORMED_VOXELS = 256 ** 3
+CONFORMED_SLICE_PIXELS = 256 * 256
+
+# FastSurferCNN keeps a float32 probability volume over its 79 classes, plus
+# a few copies of the image itself
+SEG_CLASSES = 79
+SEG_BASE_BYTES_PER_VOXEL = SEG_CLASSES * 4 + 16
+# activations of one slice in a forward pass: 64 filters x ~12 feature maps
+SEG_BYTES_PER_SLICE_PIXEL = 64 * 12 * 4
+MAX_CPU_BATCH = 16
+
+# a recon-surf process per hemisphere peaks at about this much memory
+SURF_BYTES_PER_HEMISPHERE = 2 * 1024 ** 3
+
+Tuning = namedtuple('Tuning', ['threads', 'parallel', 'batch'])
+
+
+def read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT):
+    """
+    Return the CPU quota of the container in cores (cgroup v2 or v1), or None
+    if unlimited.
+    """
+    cpu_max = read_first_line(os.path.join(root, 'cpu.max'))
+    if cpu_max:
+        quota, period = (cpu_max.split() + ['100000'])[:2]
+        if quota != 'max':
+            return float(quota) / float(period)
+        return None
+    quota = read_first_line(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'))
+    period = read_first_line(os.path.join(root, 'cpu', 'cpu.cfs_period_us'))
+    if quota and period and int(quota) > 0:
+        return float(quota) / float(period)
+    return None
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """
+    Return the memory limit of the container in bytes (cgroup v2 or v1), or
+    None if unlimited.
+    """
+    memory_max = read_first_line(os.path.join(root, 'memory.max'))
+    if memory_max:
+        return None if memory_max == 'max' else int(memory_max)
+    limit = read_first_line(os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+    # cgroup v1 reports "unlimited" as a huge page-aligned number
+    if limit and int(limit) < 2 ** 60:
+        return int(limit)
+    return None
+
+
+def effective_cpus(affinity_cpus, root=CGROUP_ROOT):
+    """
+    Return the number of cores usable by this container: the CPU affinity
+    bounded by the cgroup quota (rounded down, at least 1).
+    """
+    limit = cgroup_cpu_limit(root)
+    if limit is None:
+        return affinity_cpus
+    return max(1, min(affinity_cpus, int(math.floor(limit))))
+
+
+def effective_memory(node_memory, root=CGROUP_ROOT):
+    """
+    Return the memory usable by this container: the node's available memory
+    bounded by the cgroup limit.
+    """
+    limit = cgroup_memory_limit(root)
+    if limit is None:
+        return node_memory
+    if node_memory is None:
+        return limit
+    return min(node_memory, limit)
+
+
+def segmentation_memory(voxels, batch):
+    """
+    Return the estimated peak memory in bytes of FastSurferCNN on CPU for an
+    input of <voxels> voxels and an inference batch of <batch> slices.
+    """
+    voxels = max(voxels, CONFORMED_VOXELS)
+    slice_pixels = max(CONFORMED_SLICE_PIXELS, int(voxels ** (2.0 / 3)))
+    return voxels * SEG_BASE_BYTES_PER_VOXEL + batch * slice_pixels * SEG_BYTES_PER_SLICE_PIXEL
+
+
+def tune(cpus, memory, voxels=CONFORMED_VOXELS):
+    """
+    Return the Tuning (threads, whether to run hemispheres in parallel, CPU
+    inference batch size) for one subject given <cpus> cores and <memory>
+    bytes (None: unknown) and its input volume size.
+    """
+    cpus = max(1, cpus)
+    parallel = cpus >= 2 and (memory is None or memory >= 2 * SURF_BYTES_PER_HEMISPHERE)
+    threads = max(1, cpus // 2) if parallel else cpus
+
+    batch = MAX_CPU_BATCH
+    if memory is not None:
+        while batch > 1 and segmentation_memory(voxels, batch) > memory:
+            batch //= 2
+    return Tuning(threads, parallel, batch)
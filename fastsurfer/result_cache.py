@@ -0,0 +1,211 @@
+#
+# fastsurfer ds ChRIS plugin app -- content-addressed result cache
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from fastsurfer import file_util
+
+
+def tree_size(path):
+    """
+    Return the total size in bytes of the regular files below <path>.
+    """
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            if not os.path.islink(filepath):
+                size += os.path.getsize(filepath)
+    return size
+
+
+def link_tree(src, dst):
+    """
+    Recreate the tree <src> at <dst> with hardlinks, copying files where
+    hardlinks are not possible (e.g. across file systems).
+    """
+    def link_or_copy(s, d):
+        try:
+            os.link(s, d)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copy2(s, d)
+    shutil.copytree(src, dst, symlinks=True, copy_function=link_or_copy)
+
+
+class ResultCache(object):
+    """
+    On-disk cache of finished subject directories keyed by the content of their
+    inputs, with a size cap enforced by least-recently-used eviction.
+
+    Every entry lives in <root>/<key>/; the bookkeeping (sizes, last use and
+    hit/miss counters) is kept in <root>/index.json. Several plugin instances
+    can share <root>: every change re-reads the index under the file lock
+    <root>/index.lock before saving it.
+    """
+    INDEX_NAME = 'index.json'
+    LOCK_NAME = 'index.lock'
+
+    def __init__(self, root, max_bytes=0, digests=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # a file_util.FileDigests, possibly shared with the rest of the plugin
+        self.digests = digests if digests is not None else file_util.FileDigests()
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self.load_index()
+
+    def load_index(self):
+        """
+        Return the persisted index, dropping entries whose directory vanished
+        and adopting entry directories it does not list, e.g. stored by an
+        instance that lost its index update.
+        """
+        index = {'entries': {}, 'hits': 0, 'misses': 0, 'evictions': 0}
+        try:
+            with open(os.path.join(self.root, self.INDEX_NAME)) as f:
+                index.update(json.load(f))
+        except (IOError, OSError, ValueError):
+            pass
+        index['entries'] = {key: entry for key, entry in index['entries'].items()
+                            if os.path.isdir(os.path.join(self.root, key))}
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name not in index['entries'] and not name.endswith('.tmp') and os.path.isdir(path):
+                mtime = os.path.getmtime(path)
+                index['entries'][name] = {'size': tree_size(path), 'created': mtime,
+                                          'last_used': mtime}
+        return index
+
+    @contextmanager
+    def locked_index(self):
+        """
+        Lock the index against this and the other instances on the same root
+        and yield it as currently persisted. It is saved when the block
+        completes.
+        """
+        with self.lock, open(os.path.join(self.root, self.LOCK_NAME), 'a') as lock_file:
+            # released when the lock file is closed
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            self.index = self.load_index()
+            yield self.index
+            self.save_index()
+
+    def save_index(self):
+        """
+        Atomically persist the index.
+        """
+        with file_util.atomic_open(os.path.join(self.root, self.INDEX_NAME)) as f:
+            json.dump(self.index, f, indent=4)
+
+    def key(self, sid, t1, options, weights):
+        """
+        Return the cache key for subject <sid> with the T1 volume <t1> processed
+        with the option dict <options> and the checkpoint files <weights>. The
+        subject ID is part of the key because it is written into the stats
+        headers, logs and scripts/ of the subject directory.
+        """
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(sid).encode())
+        hasher.update(self.digests.digest(t1).encode())
+        hasher.update(json.dumps(options, sort_keys=True).encode())
+        for path in weights:
+            hasher.update(self.digests.digest(path).encode() if os.path.isfile(path)
+                          else path.encode())
+        return hasher.hexdigest()
+
+    def restore(self, key, dest, hardlink=False):
+        """
+        Restore the subject directory cached under <key> to <dest>. Return False
+        on a cache miss.
+        """
+        with self.locked_index() as index:
+            entry = index['entries'].get(key)
+            if entry is None:
+                index['misses'] += 1
+                return False
+            entry['last_used'] = time.time()
+            index['hits'] += 1
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        src = os.path.join(self.root, key)
+        if hardlink:
+            link_tree(src, dest)
+        else:
+            shutil.copytree(src, dest, symlinks=True)
+        return True
+
+    def store(self, key, src):
+        """
+        Add the finished subject directory <src> to the cache under <key>, or
+        register the entry again if it is there already, and evict old entries
+        beyond the size cap.
+        """
+        entry_dir = os.path.join(self.root, key)
+        if not os.path.isdir(entry_dir):
+            tmp_dir = tempfile.mkdtemp(dir=self.root, suffix='.tmp')
+            try:
+                shutil.copytree(src, os.path.join(tmp_dir, 'subject'), symlinks=True)
+                os.rename(os.path.join(tmp_dir, 'subject'), entry_dir)
+            except OSError:
+                if not os.path.isdir(entry_dir):
+                    raise
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        now = time.time()
+        with self.locked_index() as index:
+            entry = index['entries'].setdefault(key, {'size': tree_size(entry_dir),
+                                                      'created': now})
+            entry['last_used'] = now
+            self.evict()
+
+    def evict(self):
+        """
+        Drop least recently used entries until the cache fits in max_bytes.
+        Must be called with the index locked.
+        """
+        if self.max_bytes <= 0:
+            return
+        entries = self.index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]['size']
+            del entries[key]
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            self.index['evictions'] += 1
+
+    def stats(self):
+        """
+        Return a dict summarising the cache content and its hit/miss counters.
+        """
+        with self.locked_index() as index:
+            entries = index['entries']
+            lookups = index['hits'] + index['misses']
+            return {'root': self.root,
+                    'entries': len(entries),
+                    'bytes': sum(entry['size'] for entry in entries.values()),
+                    'max_bytes': self.max_bytes,
+                    'hits': index['hits'],
+                    'misses': index['misses'],
+                    'hit_rate': float(index['hits']) / lookups if lookups else 0.0,
+                    'evictions': index['evictions']}
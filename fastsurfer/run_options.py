@@ -0,0 +1,114 @@
+#
+# fastsurfer ds ChRIS plugin app -- typed run_fastsurfer.sh options
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import shlex
+from collections import namedtuple
+
+
+FLAG = 'flag'
+INT = 'int'
+PATH = 'path'
+STR = 'str'
+
+# <unset> is the plugin argument default meaning "leave it to run_fastsurfer.sh",
+# <limits> the (min, max) of integers
+RunOption = namedtuple('RunOption', ['name', 'kind', 'unset', 'limits'])
+
+# the run_fastsurfer.sh options in the order of its --help
+RUN_OPTIONS = [
+    RunOption('fs_license',       PATH, '', None),
+    RunOption('sid',              STR,  '', None),
+    RunOption('sd',               PATH, '', None),
+    RunOption('t1',               PATH, '', None),
+    RunOption('seg',              PATH, '', None),
+    RunOption('seg_log',          PATH, '', None),
+    RunOption('weights_sag',      PATH, '', None),
+    RunOption('weights_ax',       PATH, '', None),
+    RunOption('weights_cor',      PATH, '', None),
+    RunOption('clean_seg',        FLAG, False, None),
+    RunOption('no_cuda',          FLAG, False, None),
+    RunOption('batch',            INT,  0, (1, None)),
+    RunOption('order',            INT,  -1, (0, 3)),
+    RunOption('seg_only',         FLAG, False, None),
+    RunOption('seg_with_cc_only', FLAG, False, None),
+    RunOption('surf_only',        FLAG, False, None),
+    RunOption('vol_segstats',     FLAG, False, None),
+    RunOption('fstess',           FLAG, False, None),
+    RunOption('fsqsphere',        FLAG, False, None),
+    RunOption('fsaparc',          FLAG, False, None),
+    RunOption('surfreg',          FLAG, False, None),
+    RunOption('parallel',         FLAG, False, None),
+    RunOption('threads',          INT,  0, (1, None)),
+    RunOption('py',               STR,  '', None),
+]
+OPTIONS = {option.name: option for option in RUN_OPTIONS}
+
+# options that cannot be given together; --surf_only --seg_with_cc_only is
+# valid and runs recon-surf on the existing segmentation up to the CC
+EXCLUSIVE = [('seg_only', 'surf_only')]
+
+
+def check(values):
+    """
+    Return the list of errors in the plugin argument values <values> (a dict
+    of at least every run_fastsurfer.sh option): mistyped values, integers
+    out of their limits and mutually exclusive options given together.
+    """
+    errors = []
+    for option in RUN_OPTIONS:
+        value = values[option.name]
+        if option.kind == FLAG and not isinstance(value, bool):
+            errors.append('--%s is a flag' % option.name)
+        elif option.kind == INT and (isinstance(value, bool) or not isinstance(value, int)):
+            errors.append('--%s must be an integer' % option.name)
+        elif option.kind == INT and value != option.unset:
+            low, high = option.limits
+            if value < low or (high is not None and value > high):
+                errors.append('--%s must be %s' % (option.name, 'between %d and %d' % (low, high)
+                                                   if high is not None else 'at least %d' % low))
+        elif option.kind in (PATH, STR) and not isinstance(value, str):
+            errors.append('--%s must be a string' % option.name)
+    for names in EXCLUSIVE:
+        given = [name for name in names if values[name] != OPTIONS[name].unset]
+        if len(given) > 1:
+            errors.append('%s cannot be combined' % ' and '.join('--' + name for name in given))
+    return errors
+
+
+def select(values):
+    """
+    Return a dict of the run_fastsurfer.sh options set in <values>, mapping
+    flags to True, integers to int and paths and strings to str.
+    """
+    return {option.name: values[option.name] for option in RUN_OPTIONS
+            if values.get(option.name, option.unset) != option.unset}
+
+
+def build_argv(command, options):
+    """
+    Return the argv running <command> with the dict of set options <options>,
+    in the canonical order of RUN_OPTIONS.
+    """
+    argv = [command]
+    for option in RUN_OPTIONS:
+        if option.name not in options:
+            continue
+        argv.append('--' + option.name)
+        if option.kind != FLAG:
+            argv.append(str(options[option.name]))
+    return argv
+
+
+def format_argv(argv):
+    """
+    Return <argv> as a shell-quoted command line, for logging.
+    """
+    return ' '.join(shlex.quote(arg) for arg in argv)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# fastsurfer ds ChRIS plugin app -- persistent FastSurferCNN inference worker
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+# run_fastsurfer.sh starts a new Python process per subject that imports
+# PyTorch and unpickles the three view checkpoints before segmenting a single
+# slice. The worker is started once per plugin run with FastSurfer's Python
+# interpreter in the FastSurfer directory:
+#
+#   python seg_worker.py --socket <path> --eval FastSurferCNN/eval.py \
+#       [--weights <ckpt> ...] [--no_cuda] [--mmap]
+#
+# It imports eval.py's dependencies and loads the checkpoints once, then runs
+# eval.py's command line for every job received on the Unix socket <path>,
+# with torch.load() served from memory. Jobs are run one at a time. With
+# --mmap, the checkpoints are served from memory-mapped weight stores (see
+# weight_store.py) shared by all workers on the node.
+#
+# Protocol: one JSON object per line. A request {"argv": [...], "log": path}
+# is answered with {"line": text} for every output line of the job (which is
+# also appended to <log>) and a final {"returncode": n}. {"shutdown": true}
+# stops the worker.
+#
+
+
+import argparse
+import functools
+import json
+import logging
+import os
+import queue
+import runpy
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+START_TIMEOUT = 600.0
+
+
+def memoize_load(module, loaders=None):
+    """
+    Replace <module>.load (i.e. torch.load) by a version that keeps every
+    checkpoint file it loaded in memory, keyed on path, mtime and map_location.
+    Checkpoints whose real path is in the dict <loaders> are loaded by calling
+    the corresponding function instead. Return the dict of loaded checkpoints.
+    """
+    load = module.load
+    loaders = loaders or {}
+    loaded = {}
+
+    def cached_load(f, map_location=None, *args, **kwargs):
+        if not isinstance(f, str) or args or kwargs:
+            return load(f, map_location, *args, **kwargs)
+        path = os.path.realpath(f)
+        key = (path, os.path.getmtime(path), str(map_location))
+        if key not in loaded:
+            if path in loaders:
+                loaded[key] = loaders[path]()
+            else:
+                loaded[key] = load(f, map_location=map_location)
+        return loaded[key]
+
+    module.load = cached_load
+    return loaded
+
+
+class LineWriter(object):
+    """
+    File-like object passing every complete line written to it to <on_line>.
+    """
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.buffer = ''
+
+    def write(self, text):
+        self.buffer += text
+        while '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            self.on_line(line)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            self.on_line(self.buffer)
+            self.buffer = ''
+
+
+def logger_handlers():
+    """
+    Return a snapshot of the handlers of all existing loggers.
+    """
+    loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                       if isinstance(logger, logging.Logger)]
+    return {logger: list(logger.handlers) for logger in loggers}
+
+
+def restore_handlers(snapshot):
+    """
+    Undo the handlers a job added (eval.py adds its handlers at every run).
+    """
+    for logger, handlers in logger_handlers().items():
+        for handler in handlers:
+            if handler not in snapshot.get(logger, ()):
+                logger.removeHandler(handler)
+                handler.close()
+
+
+def run_job(eval_path, argv, on_line):
+    """
+    Run <eval_path> as __main__ with the command line <argv>, passing its
+    output lines to <on_line>. Return its exit code.
+    """
+    writer = LineWriter(on_line)
+    saved_argv = sys.argv
+    handlers = logger_handlers()
+    sys.argv = [eval_path] + list(argv)
+    try:
+        with redirect_stdout(writer), redirect_stderr(writer):
+            try:
+                runpy.run_path(eval_path, run_name='__main__')
+                returncode = 0
+            except SystemExit as e:
+                returncode = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+    finally:
+        sys.argv = saved_argv
+        restore_handlers(handlers)
+        writer.close()
+    return returncode
+
+
+def serve(socket_path, eval_path, weights=(), no_cuda=False, mmap=False):
+    """
+    Load eval.py's dependencies and the checkpoints <weights> (from shared
+    memory-mapped weight stores with <mmap>), then serve jobs on
+    <socket_path> until asked to shut down.
+    """
+    eval_path = os.path.abspath(eval_path)
+    sys.path.insert(0, os.path.dirname(eval_path))
+    start = time.time()
+    restore_load_state_dict = None
+    if weights:
+        import torch
+        loaders = {}
+        if mmap:
+            from fastsurfer import weight_store
+            for path in weights:
+                store = weight_store.prepare(path)
+                print('seg worker: mapping %s from %s' % (path, store), flush=True)
+                loaders[os.path.realpath(path)] = functools.partial(weight_store.load, store)
+            restore_load_state_dict = weight_store.share_loaded_parameters(torch)
+        memoize_load(torch, loaders)
+        device = 'cuda' if not no_cuda and torch.cuda.is_available() else 'cpu'
+        for path in weights:
+            torch.load(path, map_location=torch.device(device))
+    # execute eval.py's imports without running it
+    runpy.run_path(eval_path, run_name='seg_worker_preload')
+    print('seg worker: ready after %.1fs' % (time.time() - start), flush=True)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # clients wait for <socket_path> to appear, so only expose it once listening
+    server.bind(socket_path + '.tmp')
+    server.listen(128)
+    os.rename(socket_path + '.tmp', socket_path)
+    try:
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('rw') as stream:
+                request = json.loads(stream.readline() or '{}')
+                if request.get('shutdown'):
+                    stream.write(json.dumps({'returncode': 0}) + '\n')
+                    return
+
+                with open(request['log'], 'a') as log:
+                    def on_line(line):
+                        log.write(line + '\n')
+                        log.flush()
+                        stream.write(json.dumps({'line': line}) + '\n')
+                        stream.flush()
+                    try:
+                        returncode = run_job(eval_path, request['argv'], on_line)
+                    except (IOError, OSError):
+                        # client went away, the job result is still in the log
+                        continue
+                stream.write(json.dumps({'returncode': returncode}) + '\n')
+    finally:
+        server.close()
+        os.remove(socket_path)
+        if restore_load_state_dict is not None:
+            restore_load_state_dict()
+
+
+class SegWorkerPool(object):
+    """
+    Hand every segment() call to the next idle one of several SegWorkers.
+    """
+    def __init__(self, workers):
+        self.workers = list(workers)
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
+
+    def segment(self, argv, log_path, on_line, on_start=None):
+        """
+        Run eval.py with <argv> in the next idle worker, see SegWorker.segment.
+        <on_start>(pid) is called with the pid of that worker before the job starts.
+        """
+        worker = self.idle.get()
+        try:
+            if on_start is not None:
+                on_start(worker.process.pid)
+            return worker.segment(argv, log_path, on_line)
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+class SegWorker(object):
+    """
+    Client side of a worker process started with <python> in <cwd>, listening
+    on a socket in a private temporary directory. Concurrent segment() calls
+    are queued by the worker.
+    """
+    def __init__(self, python, eval_path, weights=(), no_cuda=False, mmap=False,
+                 log_path=os.devnull, cwd=None, timeout=START_TIMEOUT):
+        self.socket_dir = tempfile.mkdtemp(prefix='seg-worker-')
+        self.socket_path = os.path.join(self.socket_dir, 'socket')
+        cmd = [python, WORKER_SCRIPT, '--socket', self.socket_path, '--eval', eval_path]
+        if weights:
+            cmd += ['--weights'] + list(weights)
+        if no_cuda:
+            cmd.append('--no_cuda')
+        if mmap:
+            cmd.append('--mmap')
+        self.log = open(log_path, 'a')
+        self.process = subprocess.Popen(cmd, cwd=cwd, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while not os.path.exists(self.socket_path):
+            if self.process.poll() is not None:
+                self.close()
+                raise RuntimeError('seg worker exited with %d, see %s'
+                                   % (self.process.returncode, log_path))
+            if time.time() > deadline:
+                self.close()
+                raise RuntimeError('seg worker not ready after %.0fs' % timeout)
+            time.sleep(0.1)
+
+    def request(self, message):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(self.socket_path)
+        stream = connection.makefile('rw')
+        stream.write(json.dumps(message) + '\n')
+        stream.flush()
+        return connection, stream
+
+    def segment(self, argv, log_path, on_line):
+        """
+        Run eval.py with <argv> in the worker, appending its output to
+        <log_path> and passing every line to <on_line>. Return its exit code.
+        """
+        connection, stream = self.request({'argv': list(argv), 'log': log_path})
+        with connection, stream:
+            for line in stream:
+                reply = json.loads(line)
+                if 'returncode' in reply:
+                    return reply['returncode']
+                on_line(reply['line'])
+        raise IOError('seg worker closed the connection')
+
+    def close(self, timeout=30.0):
+        """
+        Stop the worker.
+        """
+        if self.process.poll() is None:
+            try:
+                connection, stream = self.request({'shutdown': True})
+                with connection, stream:
+                    stream.readline()
+                self.process.wait(timeout)
+            except (IOError, OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Persistent FastSurferCNN inference worker')
+    parser.add_argument('--socket', required=True, help='Unix socket to accept jobs on')
+    parser.add_argument('--eval', required=True, help='path of FastSurferCNN/eval.py')
+    parser.add_argument('--weights', nargs='*', default=[], help='checkpoints to preload')
+    parser.add_argument('--no_cuda', action='store_true', help='load the checkpoints to the CPU')
+    parser.add_argument('--mmap', action='store_true',
+                        help='share the checkpoints through memory-mapped weight stores')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    # import the other plugin modules through the fastsurfer package this
+    # script belongs to, not from its own directory
+    sys.path[0] = os.path.dirname(os.path.dirname(WORKER_SCRIPT))
+    args = parse_args(sys.argv[1:])
+    serve(args.socket, args.eval, args.weights, args.no_cuda, args.mmap)
@@ -0,0 +1,208 @@
+#
+# fastsurfer ds ChRIS plugin app -- stage-level checkpoints
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+
+from fastsurfer import file_util
+
+
+# a pipeline stage and the files (relative to the subject directory, or
+# absolute) that exist once the stage is done
+CheckpointStage = namedtuple('CheckpointStage', ['name', 'outputs'])
+
+DEFAULT_SEG = 'mri/aparc.DKTatlas+aseg.deep.mgz'
+
+MANIFEST_NAME = 'scripts/plugin_stages.json'
+
+# outputs untouched for that long while the pipeline is still running are
+# considered complete
+STABLE_SECONDS = 30
+
+POLL_INTERVAL = 30
+
+# coarsest mtime resolution of the file systems subjects are written to (FAT,
+# some network file systems)
+MTIME_RESOLUTION = 2.0
+
+
+def subject_stages(seg=None):
+    """
+    Return the list of CheckpointStage of a FastSurfer run, in pipeline order.
+    <seg> is the --seg location of the deep segmentation, if not the default.
+    """
+    return [
+        CheckpointStage('seg', [seg or DEFAULT_SEG]),
+        CheckpointStage('cc', ['mri/aseg.auto.mgz',
+                               'mri/aparc.DKTatlas+aseg.deep.withCC.mgz']),
+        CheckpointStage('lh', ['surf/lh.white', 'surf/lh.pial', 'surf/lh.thickness']),
+        CheckpointStage('rh', ['surf/rh.white', 'surf/rh.pial', 'surf/rh.thickness']),
+        CheckpointStage('stats', ['stats/aseg.stats',
+                                  'stats/lh.aparc.DKTatlas.mapped.stats',
+                                  'stats/rh.aparc.DKTatlas.mapped.stats']),
+    ]
+
+
+def target_stages(seg_only=False, seg_with_cc_only=False, vol_segstats=False):
+    """
+    Return the names of the stages a run with the given switches produces.
+    """
+    if seg_with_cc_only or (seg_only and vol_segstats):
+        return ['seg', 'cc']
+    if seg_only:
+        return ['seg']
+    return ['seg', 'cc', 'lh', 'rh', 'stats']
+
+
+class StageManifest(object):
+    """
+    Record of the completed stages of one subject, kept in the subject's
+    scripts/ directory together with size, mtime and checksum of every output.
+    """
+    def __init__(self, subject_dir, stages):
+        self.subject_dir = subject_dir
+        self.stages = stages
+        self.path = os.path.join(subject_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.records = self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        dirname = os.path.dirname(self.path)
+        os.makedirs(dirname, exist_ok=True)
+        with file_util.atomic_open(self.path) as f:
+            json.dump(self.records, f, indent=4, sort_keys=True)
+
+    def output_path(self, output):
+        return os.path.join(self.subject_dir, output)
+
+    def is_complete(self, stage, verify=True):
+        """
+        Return True if <stage> is recorded and its outputs still match the
+        record. With <verify>, outputs whose size or mtime changed are
+        re-checksummed instead of being rejected outright.
+        """
+        record = self.records.get(stage.name)
+        if record is None:
+            return False
+        for output in stage.outputs:
+            path = self.output_path(output)
+            entry = record['files'].get(output)
+            if entry is None or not os.path.isfile(path):
+                return False
+            st = os.stat(path)
+            if (st.st_size, st.st_mtime) == (entry['size'], entry['mtime']):
+                continue
+            if not verify or file_util.file_sha256(path) != entry['sha256']:
+                return False
+        return True
+
+    def completed(self):
+        """
+        Return the names of the stages whose outputs match the manifest.
+        """
+        with self.lock:
+            return [stage.name for stage in self.stages if self.is_complete(stage)]
+
+    def first_incomplete(self, targets):
+        """
+        Return the first stage of <targets> (in pipeline order) that is not
+        complete, or None if all of them are.
+        """
+        completed = self.completed()
+        for stage in self.stages:
+            if stage.name in targets and stage.name not in completed:
+                return stage.name
+        return None
+
+    def record(self, finished=False, since=None):
+        """
+        Record every stage whose outputs all exist and are complete: either the
+        pipeline <finished> successfully or the outputs were not modified for
+        STABLE_SECONDS. With <since>, only outputs modified after that time
+        count, so that outputs left by an earlier or failed run are not
+        recorded before the current run rewrites them. Return the names of
+        the newly recorded stages.
+        """
+        now = time.time()
+        recorded = []
+        with self.lock:
+            for stage in self.stages:
+                if self.is_complete(stage, verify=False):
+                    continue
+                paths = [self.output_path(output) for output in stage.outputs]
+                if not all(os.path.isfile(path) for path in paths):
+                    continue
+                stats = [os.stat(path) for path in paths]
+                if since is not None and any(st.st_mtime < since for st in stats):
+                    continue
+                if not finished and any(now - st.st_mtime < STABLE_SECONDS for st in stats):
+                    continue
+                files = {}
+                for output, path, st in zip(stage.outputs, paths, stats):
+                    files[output] = {'size': st.st_size, 'mtime': st.st_mtime,
+                                     'sha256': file_util.file_sha256(path)}
+                self.records[stage.name] = {'finished': now, 'files': files}
+                recorded.append(stage.name)
+            if recorded:
+                self.save()
+        return recorded
+
+
+class StageWatcher(object):
+    """
+    Background thread recording completed stages into a StageManifest while a
+    pipeline is running. Only outputs written after the watcher was entered
+    are recorded.
+    """
+    def __init__(self, manifest, interval=POLL_INTERVAL, on_record=None):
+        self.manifest = manifest
+        self.interval = interval
+        self.on_record = on_record
+        self.started = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+
+    def poll(self):
+        while not self.stopped.wait(self.interval):
+            self.notify(self.manifest.record(since=self.started))
+
+    def notify(self, recorded):
+        if self.on_record is not None:
+            for name in recorded:
+                self.on_record(name)
+
+    def __enter__(self):
+        self.started = time.time() - MTIME_RESOLUTION
+        self.thread.start()
+        return self
+
+    def stop(self, finished):
+        """
+        Stop polling and take a final record; <finished> tells whether the
+        pipeline exited successfully.
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.notify(self.manifest.record(finished, since=self.started))
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if not self.stopped.is_set():
+            self.stop(False)
@@ -0,0 +1,71 @@
+#
+# fastsurfer ds ChRIS plugin app -- pipelined multi-stage scheduling
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import threading
+import time
+import traceback
+from collections import namedtuple
+from queue import Queue
+
+
+# a pipeline stage: <run>(job) returns an exit code, at most <workers> jobs
+# are in the stage at any time
+Stage = namedtuple('Stage', ['name', 'run', 'workers'])
+
+StageOutcome = namedtuple('StageOutcome', ['stage', 'returncode', 'elapsed'])
+
+
+def run_pipeline(jobs, stages):
+    """
+    Push every job through <stages> in order, overlapping the stages across jobs.
+
+    Each stage has its own pool of worker threads fed by a FIFO queue; a job
+    that finishes a stage with exit code 0 is queued for the next stage, so
+    while job N is in a later stage job N+1 already runs in an earlier one. A
+    failed stage drops the job from the pipeline. Return, in job order, the
+    list of StageOutcome of every stage each job went through.
+    """
+    outcomes = [[] for _ in jobs]
+    queues = [Queue() for _ in stages]
+
+    def worker(k):
+        stage = stages[k]
+        while True:
+            i = queues[k].get()
+            if i is None:
+                return
+            start = time.time()
+            try:
+                returncode = stage.run(jobs[i])
+            except Exception:
+                traceback.print_exc()
+                returncode = -1
+            outcomes[i].append(StageOutcome(stage.name, returncode, time.time() - start))
+            if returncode == 0 and k + 1 < len(stages):
+                queues[k + 1].put(i)
+
+    pools = []
+    for k, stage in enumerate(stages):
+        pool = [threading.Thread(target=worker, args=(k,), daemon=True)
+                for _ in range(max(1, stage.workers))]
+        for thread in pool:
+            thread.start()
+        pools.append(pool)
+
+    for i in range(len(jobs)):
+        queues[0].put(i)
+    # a stage can only be shut down once every job has left the stage before it
+    for k, pool in enumerate(pools):
+        for _ in pool:
+            queues[k].put(None)
+        for thread in pool:
+            thread.join()
+    return outcomes
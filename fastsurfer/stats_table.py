@@ -0,0 +1,210 @@
+#
+# fastsurfer ds ChRIS plugin app -- cohort table of the FreeSurfer stats files
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import csv
+import json
+import math
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from fastsurfer import file_util
+
+
+# the per-structure columns of the stats tables that go into the cohort table
+STRUCTURE_COLUMNS = ('Volume_mm3', 'NumVert', 'SurfArea', 'GrayVol', 'ThickAvg', 'ThickStd',
+                     'MeanCurv')
+MAX_PARSE_WORKERS = 16
+
+SUBJECT_COLUMN = 'subject'
+
+
+def parse_stats(path):
+    """
+    Return a dict mapping the measures (<Measure short name>) and the
+    STRUCTURE_COLUMNS of every structure (<StructName>.<column>) of the
+    FreeSurfer stats file <path> to their values. Lines that do not parse
+    are ignored.
+    """
+    values = {}
+    headers = None
+    with open(path, errors='replace') as f:
+        for line in f:
+            if line.startswith('# Measure '):
+                fields = [field.strip() for field in line[len('# Measure '):].split(',')]
+                if len(fields) >= 4:
+                    try:
+                        values[fields[1]] = float(fields[3])
+                    except ValueError:
+                        pass
+            elif line.startswith('# ColHeaders'):
+                headers = line.split()[2:]
+            elif not line.startswith('#') and headers is not None:
+                row = dict(zip(headers, line.split()))
+                if 'StructName' not in row:
+                    continue
+                for column in STRUCTURE_COLUMNS:
+                    try:
+                        values['%s.%s' % (row['StructName'], column)] = float(row[column])
+                    except (KeyError, ValueError):
+                        pass
+    return values
+
+
+def stats_files(subject_dir):
+    """
+    Return a dict mapping the names of the stats files of <subject_dir>
+    without .stats to their (size, mtime).
+    """
+    stats_dir = os.path.join(subject_dir, 'stats')
+    try:
+        names = os.listdir(stats_dir)
+    except OSError:
+        return {}
+    files = {}
+    for name in names:
+        if name.endswith('.stats'):
+            st = os.stat(os.path.join(stats_dir, name))
+            files[name[:-len('.stats')]] = [st.st_size, st.st_mtime]
+    return files
+
+
+def parse_subject(subject_dir, names):
+    """
+    Return the values of the stats files <names> (without .stats) of
+    <subject_dir> as <stats file>.<value> keys.
+    """
+    values = {}
+    for name in names:
+        stats = parse_stats(os.path.join(subject_dir, 'stats', name + '.stats'))
+        values.update(('%s.%s' % (name, key), value) for key, value in stats.items())
+    return values
+
+
+def write_columns(f, subjects, columns, rows):
+    """
+    Write the table of <rows> (dicts of values) of <subjects> to the binary
+    file object <f> as a numpy .npz archive of one array per column: the
+    subject ids as strings and the values as float64 with NaN for missing
+    ones.
+    """
+    arrays = {SUBJECT_COLUMN: numpy.array(subjects, dtype=str)}
+    for column in columns:
+        arrays[column] = numpy.array([row.get(column, math.nan) for row in rows],
+                                     dtype=numpy.float64)
+    numpy.savez(f, **arrays)
+
+
+def read_columns(path, names=None):
+    """
+    Return a dict mapping the columns <names> (default: all) of the .npz
+    table <path> to lists of their values, reading only those columns.
+    """
+    with numpy.load(path) as data:
+        return {name: data[name].tolist() for name in data.files
+                if names is None or name in names}
+
+
+class StatsTable(object):
+    """
+    Cohort table of the stats files of the subjects, one row per subject and
+    one column per <stats file>.<value> (see parse_stats). The parsed values
+    are kept in the JSON file <path> together with the size and mtime of the
+    stats files they come from, so that only new or changed subjects are
+    parsed again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.subjects = {}
+        try:
+            with open(path) as f:
+                self.subjects = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    def changed_files(self, sid, subject_dir):
+        """
+        Return the stats files of subject <sid> (see stats_files), or None if
+        it has none or they are unchanged since they were parsed.
+        """
+        files = stats_files(subject_dir)
+        with self.lock:
+            cached = self.subjects.get(sid)
+        if not files or (cached is not None and cached['files'] == files):
+            return None
+        return files
+
+    def update(self, sid, subject_dir):
+        """
+        Parse the stats files of subject <sid> unless they are unchanged.
+        Return whether they were parsed.
+        """
+        files = self.changed_files(sid, subject_dir)
+        if files is None:
+            return False
+        values = parse_subject(subject_dir, sorted(files))
+        with self.lock:
+            self.subjects[sid] = {'files': files, 'values': values}
+        return True
+
+    def scan(self, subject_dirs, workers=MAX_PARSE_WORKERS):
+        """
+        Update the subjects of <subject_dirs> (a dict mapping subject ids to
+        directories) and return the number of subjects parsed. The parsing is
+        CPU bound, so it is spread over up to <workers> processes.
+        """
+        changed = {}
+        for sid in sorted(subject_dirs):
+            files = self.changed_files(sid, subject_dirs[sid])
+            if files is not None:
+                changed[sid] = files
+        sids = sorted(changed)
+        dirs = [subject_dirs[sid] for sid in sids]
+        names = [sorted(changed[sid]) for sid in sids]
+        workers = min(workers, len(sids), os.cpu_count() or 1)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed = list(executor.map(parse_subject, dirs, names))
+        else:
+            parsed = list(map(parse_subject, dirs, names))
+        with self.lock:
+            for sid, values in zip(sids, parsed):
+                self.subjects[sid] = {'files': changed[sid], 'values': values}
+        return len(sids)
+
+    def save(self, csv_path, columns_path):
+        """
+        Atomically write the table as CSV to <csv_path> and as a numpy .npz
+        archive of columns to <columns_path>, and persist the parsed values.
+        Return the number of subjects and of value columns.
+        """
+        def write_csv(f):
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow([SUBJECT_COLUMN] + columns)
+            for sid, row in zip(subjects, rows):
+                writer.writerow([sid] + [repr(row[column]) if column in row else ''
+                                         for column in columns])
+
+        # under the lock, so that concurrent saves cannot replace a newer table
+        with self.lock:
+            subjects = sorted(self.subjects)
+            rows = [self.subjects[sid]['values'] for sid in subjects]
+            columns = sorted(set(column for row in rows for column in row))
+            with file_util.atomic_open(self.path) as f:
+                json.dump(self.subjects, f, sort_keys=True)
+            with file_util.atomic_open(csv_path) as f:
+                write_csv(f)
+            with file_util.atomic_open(columns_path, 'wb') as f:
+                write_columns(f, subjects, columns, rows)
+        return len(subjects), len(columns)
@@ -0,0 +1,134 @@
+#
+# fastsurfer ds ChRIS plugin app -- multi-subject batch helpers
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import os
+import re
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+# file extensions recognised as T1 volumes, longest first so that
+# '.nii.gz' is stripped as a whole when deriving subject IDs
+T1_EXTENSIONS = ('.nii.gz', '.nii', '.mgz')
+
+# rough per-subject footprint of a full FastSurfer run on CPU
+DEFAULT_MEMORY_PER_SUBJECT = 8 * 1024 ** 3
+
+SubjectJob = namedtuple('SubjectJob', ['sid', 't1'])
+
+SubjectResult = namedtuple('SubjectResult', ['sid', 't1', 'returncode', 'elapsed'])
+
+
+def strip_t1_extension(filename):
+    """
+    Return <filename> without its T1 volume extension.
+    """
+    for ext in T1_EXTENSIONS:
+        if filename.endswith(ext):
+            return filename[:-len(ext)]
+    return filename
+
+
+def subject_id(t1_path, inputdir):
+    """
+    Derive a subject ID from the location of a T1 volume relative to <inputdir>.
+
+    Sub-directories become part of the ID so that volumes with the same file name
+    in different directories (e.g. sub-01/T1.mgz, sub-02/T1.mgz) stay distinct.
+    """
+    relpath = strip_t1_extension(os.path.relpath(t1_path, inputdir))
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', relpath.replace(os.sep, '_')).strip('_')
+
+
+def discover_subjects(inputdir):
+    """
+    Return a list of SubjectJob, one per T1 volume found below <inputdir>, sorted
+    by subject ID.
+    """
+    jobs = {}
+    for dirpath, dirnames, filenames in os.walk(inputdir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith(T1_EXTENSIONS):
+                continue
+            t1 = os.path.abspath(os.path.join(dirpath, filename))
+            sid = subject_id(t1, inputdir)
+            if sid in jobs:
+                raise ValueError('Subject ID %s derived from both %s and %s'
+                                 % (sid, jobs[sid].t1, t1))
+            jobs[sid] = SubjectJob(sid, t1)
+    return [jobs[sid] for sid in sorted(jobs)]
+
+
+def available_cpus():
+    """
+    Return the number of CPUs this process may run on.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """
+    Return the memory currently available on the node in bytes, or None if it
+    cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def worker_count(num_jobs, cpus_per_subject=1, memory_per_subject=DEFAULT_MEMORY_PER_SUBJECT,
+                 max_workers=0, cpus=None, memory=None):
+    """
+    Size the worker pool from the available cores and memory.
+
+    At least one worker is always returned; <max_workers> caps the result when
+    positive.
+    """
+    cpus = available_cpus() if cpus is None else cpus
+    memory = available_memory() if memory is None else memory
+    workers = cpus // max(1, cpus_per_subject)
+    if memory is not None and memory_per_subject:
+        workers = min(workers, memory // memory_per_subject)
+    if max_workers > 0:
+        workers = min(workers, max_workers)
+    return int(max(1, min(workers, num_jobs)))
+
+
+def run_batch(jobs, run_subject, workers):
+    """
+    Run <run_subject>(job) for every job on a pool of <workers> workers.
+
+    Every worker only supervises an external FastSurfer process, so threads are
+    enough to keep <workers> subjects running at once. Return a list of
+    SubjectResult in job order; a job raising an exception gets returncode -1.
+    """
+    def supervise(job):
+        start = time.time()
+        try:
+            returncode = run_subject(job)
+        except Exception:
+            traceback.print_exc()
+            returncode = -1
+        return SubjectResult(job.sid, job.t1, returncode, time.time() - start)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return list(pool.map(supervise, jobs))
@@ -0,0 +1,105 @@
+
+from unittest import TestCase
+
+from fastsurfer import core_pinning
+
+
+class PartitionTests(TestCase):
+    """
+    Test the split of cores between process trees.
+    """
+    def test_proportional_blocks(self):
+        """
+        Test that cores are split into contiguous blocks by demand.
+        """
+        blocks = core_pinning.partition(list(range(16)), [('a', 8), ('b', 4), ('c', 4)])
+        self.assertEqual(blocks, {'a': list(range(8)), 'b': list(range(8, 12)),
+                                  'c': list(range(12, 16))})
+
+    def test_every_core_used_once(self):
+        """
+        Test that uneven demands still use every core exactly once.
+        """
+        blocks = core_pinning.partition(list(range(7)), [('a', 3), ('b', 1), ('c', 1)])
+        self.assertEqual(sorted(core for block in blocks.values() for core in block),
+                         list(range(7)))
+        self.assertTrue(all(blocks.values()))
+
+    def test_more_demands_than_cores(self):
+        """
+        Test that cores are shared round-robin when oversubscribed.
+        """
+        blocks = core_pinning.partition([0, 1], [('a', 1), ('b', 1), ('c', 1)])
+        self.assertEqual(blocks, {'a': [0], 'b': [1], 'c': [0]})
+
+
+class CoreSchedulerTests(TestCase):
+    """
+    Test the core budgeting across running process trees.
+    """
+    def setUp(self):
+        # pid -> (children, command line)
+        self.processes = {}
+        self.affinity = {}
+        self.scheduler = core_pinning.CoreScheduler(
+            list(range(8)), self.process_tree, interval=3600,
+            set_affinity=self.affinity.__setitem__,
+            read_cmdline=lambda pid: self.processes.get(pid, ([], ''))[1])
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def process_tree(self, pid):
+        tree = [pid]
+        for p in tree:
+            tree.extend(self.processes.get(p, ([], ''))[0])
+        return tree
+
+    def start_subject(self, pid, hemispheres):
+        children = []
+        for i, hemi in enumerate(hemispheres):
+            lane = pid * 10 + i
+            self.processes[lane] = ([lane * 10], 'bash /sd/s/scripts/%s.processing.cmdf' % hemi)
+            children.append(lane)
+        self.processes[pid] = (children, 'bash run_fastsurfer.sh')
+
+    def test_hemisphere_cores_move(self):
+        """
+        Test that hemispheres get their own cores and that the cores of a
+        finished hemisphere go to the other subject.
+        """
+        self.start_subject(1, ['lh', 'rh'])
+        self.start_subject(2, ['lh', 'rh'])
+        self.scheduler.register('a', 1, 2)
+        self.scheduler.register('b', 2, 2)
+        self.assertEqual(self.scheduler.allocation(), {'a': [0, 1, 2, 3], 'b': [4, 5, 6, 7]})
+        self.assertEqual(self.affinity[10], [0, 1])
+        self.assertEqual(self.affinity[100], [0, 1])
+        self.assertEqual(self.affinity[11], [2, 3])
+
+        # subject a's rh finishes
+        self.start_subject(1, ['lh'])
+        with self.scheduler.lock:
+            self.scheduler.update()
+        allocation = self.scheduler.allocation()
+        self.assertEqual(len(allocation['a']), 3)
+        self.assertEqual(len(allocation['b']), 5)
+
+        self.scheduler.unregister('a')
+        self.assertEqual(self.scheduler.allocation(), {'b': list(range(8))})
+        self.assertEqual(self.affinity[2], list(range(8)))
+
+    def test_threads_per_process(self):
+        """
+        Test the share of threads of concurrent subjects.
+        """
+        self.assertEqual(self.scheduler.threads_per_process(2), 4)
+        self.assertEqual(self.scheduler.threads_per_process(2, parallel=True), 2)
+        self.assertEqual(self.scheduler.threads_per_process(16, parallel=True), 1)
+
+    def test_thread_env(self):
+        """
+        Test the thread limits passed to child processes.
+        """
+        self.assertEqual(core_pinning.thread_env(3),
+                         {'OMP_NUM_THREADS': '3', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': '3'})
@@ -1,7 +1,54 @@
 
+import json
+import os
+import shutil
+import stat
+import tempfile
 from unittest import TestCase
 from unittest import mock
 from fastsurfer.fastsurfer import Fastsurfer
+from fastsurfer import incremental_run, run_options
+
+
+# stand-in for run_fastsurfer.sh: records its arguments in calls.jsonl next to
+# it, writes the checkpoint files of the stages it runs and fails the subjects
+# listed in $FAKE_FAIL
+FAKE_RUN_FASTSURFER = """#!/usr/bin/env python
+import json
+import os
+import sys
+
+args = {}
+argv = sys.argv[1:]
+while argv:
+    if len(argv) > 1 and not argv[1].startswith('--'):
+        args[argv[0][2:]] = argv[1]
+        argv = argv[2:]
+    else:
+        args[argv[0][2:]] = True
+        argv = argv[1:]
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calls.jsonl'), 'a') as f:
+    f.write(json.dumps(args) + '\\n')
+outputs = []
+if not args.get('surf_only'):
+    print('Evaluating Axial network')
+    outputs += ['mri/orig.mgz', 'mri/aparc.DKTatlas+aseg.deep.mgz']
+if not args.get('seg_only'):
+    print('================= Computing stats =================')
+    outputs += ['mri/aseg.auto.mgz', 'mri/aparc.DKTatlas+aseg.deep.withCC.mgz',
+                'stats/lh.aparc.DKTatlas.mapped.stats', 'stats/rh.aparc.DKTatlas.mapped.stats']
+    for hemi in ('lh', 'rh'):
+        outputs += ['surf/%s.white' % hemi, 'surf/%s.pial' % hemi, 'surf/%s.thickness' % hemi]
+for relpath in outputs:
+    path = os.path.join(args['sd'], args['sid'], relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(relpath)
+if not args.get('seg_only'):
+    with open(os.path.join(args['sd'], args['sid'], 'stats', 'aseg.stats'), 'w') as f:
+        f.write('# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, 1000.0, mm^3\\n')
+sys.exit(1 if args['sid'] in os.environ.get('FAKE_FAIL', '').split(',') else 0)
+"""
 
 
 class FastsurferTests(TestCase):
@@ -11,23 +58,184 @@ class FastsurferTests(TestCase):
     def setUp(self):
         self.app = Fastsurfer()
 
+    def test_adapted_options_valid(self):
+        """
+        Test that the options of resumed and incremental runs pass the checks.
+        """
+        values = {option.name: option.unset for option in run_options.RUN_OPTIONS}
+        requested = {'sid': 'bert', 'seg_only': True, 'vol_segstats': True}
+        manifest = mock.Mock()
+        manifest.first_incomplete.return_value = 'surf'
+        adapted = [self.app.resume_fastsurfer_options(manifest, requested)]
+        for level in ('cc', 'surf', 'full'):
+            adapted.append(self.app.incremental_fastsurfer_options(
+                incremental_run.Plan(level, []), requested))
+        self.assertIn({'sid': 'bert', 'seg_with_cc_only': True, 'surf_only': True,
+                       'vol_segstats': True}, adapted)
+        for fastsurfer_options in adapted:
+            self.assertEqual(run_options.check(dict(values, **fastsurfer_options)), [])
+
+
+class RunTests(TestCase):
+    """
+    Test the runs of the plugin against a fake run_fastsurfer.sh.
+    """
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        fastsurfer_dir = os.path.join(self.tmpdir, 'FastSurfer')
+        os.makedirs(fastsurfer_dir)
+        script = os.path.join(fastsurfer_dir, 'run_fastsurfer.sh')
+        with open(script, 'w') as f:
+            f.write(FAKE_RUN_FASTSURFER)
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR)
+        self.calls_path = os.path.join(fastsurfer_dir, 'calls.jsonl')
+        self.inputdir = os.path.join(self.tmpdir, 'in')
+        os.makedirs(self.inputdir)
+        for sid in ('bert', 'ernie'):
+            with open(os.path.join(self.inputdir, sid + '.nii.gz'), 'w') as f:
+                f.write(sid)
+        with open(os.path.join(self.tmpdir, 'license.txt'), 'w') as f:
+            f.write('license')
+        # the plugin finds FastSurfer in the directory it is run from
+        os.chdir(self.tmpdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def run_plugin(self, outputdir, *args):
+        """
+        Run the plugin from <inputdir> to <outputdir> with <args> and return it.
+        """
+        os.chdir(self.tmpdir)
+        outputdir = os.path.join(self.tmpdir, outputdir)
+        os.makedirs(outputdir, exist_ok=True)
+        app = Fastsurfer()
+        options = app.parse_args([self.inputdir, outputdir, '--fs_license', 'license.txt',
+                                  '--monitor_interval', '0'] + list(args))
+        app.run(options)
+        return app
+
+    def calls(self):
+        """
+        Return the arguments of every run of run_fastsurfer.sh so far.
+        """
+        if not os.path.exists(self.calls_path):
+            return []
+        with open(self.calls_path) as f:
+            return [json.loads(line) for line in f]
+
+    def batch_report(self, outputdir):
+        """
+        Return the batch report the plugin saved to <outputdir>.
+        """
+        with open(os.path.join(self.tmpdir, outputdir, 'fastsurfer_batch.json')) as f:
+            return json.load(f)
+
     def test_run(self):
         """
-        Test the run code.
+        Test that a single subject given by relative paths runs in outputdir.
+        """
+        app = self.run_plugin('out', '--t1', 'in/bert.nii.gz', '--sid', 'bert')
+        self.assertEqual(app.returncode, 0)
+        [call] = self.calls()
+        self.assertEqual(call['t1'], os.path.join(self.inputdir, 'bert.nii.gz'))
+        self.assertEqual(call['fs_license'], os.path.join(self.tmpdir, 'license.txt'))
+        self.assertEqual(call['sd'], os.path.join(self.tmpdir, 'out'))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'out', 'bert', 'stats',
+                                                    'aseg.stats')))
+        self.assertTrue(os.listdir(os.path.join(self.tmpdir, 'out', 'logs')))
+        self.assertEqual(self.batch_report('out')['failed'], [])
+
+    def test_failed_subject(self):
+        """
+        Test that a failed subject fails the batch but not the other subjects.
+        """
+        with mock.patch.dict(os.environ, {'FAKE_FAIL': 'ernie'}):
+            app = self.run_plugin('out', '--multi_subject')
+        self.assertEqual(app.returncode, 1)
+        self.assertEqual(sorted(call['sid'] for call in self.calls()), ['bert', 'ernie'])
+        report = self.batch_report('out')
+        self.assertEqual(report['failed'], ['ernie'])
+        self.assertEqual(sorted(subject['sid'] for subject in report['subjects']),
+                         ['bert', 'ernie'])
+
+    def test_pipeline(self):
+        """
+        Test that the pipelined run segments and then runs recon-surf on every
+        subject.
+        """
+        app = self.run_plugin('out', '--multi_subject', '--pipeline')
+        self.assertEqual(app.returncode, 0)
+        runs = sorted((call['sid'], 'seg_only' in call, 'surf_only' in call)
+                      for call in self.calls())
+        self.assertEqual(runs, [('bert', False, True), ('bert', True, False),
+                                ('ernie', False, True), ('ernie', True, False)])
+        for subject in self.batch_report('out')['subjects']:
+            self.assertEqual([stage['stage'] for stage in subject['stages']], ['seg', 'surf'])
+
+    def test_cache(self):
+        """
+        Test that cached subjects are restored without running FastSurfer and
+        that an unreadable T1 fails only its subject.
         """
-        args = []
-        if self.app.TYPE == 'ds':
-            args.append('inputdir') # you may want to change this inputdir mock
-        args.append('outputdir')  # you may want to change this outputdir mock
+        cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.run_plugin('out1', '--multi_subject', '--cache_dir', cache_dir)
+        self.assertEqual(len(self.calls()), 2)
+        app = self.run_plugin('out2', '--multi_subject', '--cache_dir', cache_dir)
+        self.assertEqual(app.returncode, 0)
+        self.assertEqual(len(self.calls()), 2)
+        self.assertEqual(sorted(self.batch_report('out2')['cached']), ['bert', 'ernie'])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'out2', 'ernie', 'stats',
+                                                    'aseg.stats')))
 
-        # you may want to add more of your custom defined optional arguments to test
-        # your app with
-        # eg.
-        # args.append('--custom-int')
-        # args.append(10)
+        app = self.run_plugin('out3', '--t1', 'in/grover.nii.gz', '--sid', 'grover',
+                              '--cache_dir', cache_dir)
+        self.assertEqual(app.returncode, 1)
+        self.assertEqual(self.batch_report('out3')['failed'], ['grover'])
 
-        options = self.app.parse_args(args)
-        self.app.run(options)
+    def test_staging(self):
+        """
+        Test that subjects run in the scratch directory and are transferred to
+        outputdir.
+        """
+        scratch_dir = os.path.join(self.tmpdir, 'scratch')
+        app = self.run_plugin('out', '--multi_subject', '--scratch_dir', scratch_dir)
+        self.assertEqual(app.returncode, 0)
+        for call in self.calls():
+            self.assertTrue(call['sd'].startswith(scratch_dir + os.sep))
+            self.assertTrue(call['t1'].startswith(scratch_dir + os.sep))
+        for subject in self.batch_report('out')['subjects']:
+            self.assertIn('staging', subject)
+            self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, 'out', subject['sid'],
+                                                        'stats', 'aseg.stats')))
 
-        # write your own assertions
-        self.assertEqual(options.outputdir, 'outputdir')
+    def test_incremental(self):
+        """
+        Test that an incremental run reuses the outputs of unchanged subjects.
+        """
+        self.run_plugin('out', '--multi_subject', '--incremental')
+        self.assertEqual(len(self.calls()), 2)
+        with open(os.path.join(self.inputdir, 'ernie.nii.gz'), 'w') as f:
+            f.write('ernie, again')
+        app = self.run_plugin('out', '--multi_subject', '--incremental')
+        self.assertEqual(app.returncode, 0)
+        self.assertEqual([call['sid'] for call in self.calls()[2:]], ['ernie'])
+
+    def test_outputs(self):
+        """
+        Test the package, the stats table and the metrics written to outputdir.
+        """
+        app = self.run_plugin('out', '--multi_subject', '--package', 'stats', '--stats_table',
+                              '--metrics_file', 'metrics.prom')
+        self.assertEqual(app.returncode, 0)
+        outputdir = os.path.join(self.tmpdir, 'out')
+        with open(os.path.join(outputdir, 'fastsurfer_outputs.index.json')) as f:
+            index = json.load(f)
+        self.assertIn('bert/stats/aseg.stats', json.dumps(index))
+        with open(os.path.join(outputdir, 'fastsurfer_stats.csv')) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines, ['subject,aseg.BrainSegVol', 'bert,1000.0', 'ernie,1000.0'])
+        with open(os.path.join(outputdir, 'metrics.prom')) as f:
+            self.assertIn('fastsurfer_subjects{state="done"} 2', f.read())
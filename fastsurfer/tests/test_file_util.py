@@ -0,0 +1,88 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import file_util
+
+
+class DigestTests(TestCase):
+    """
+    Test the shared file digests.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data')
+        self.data = os.urandom(file_util.HASH_CHUNK_SIZE + 100)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_file_sha256(self):
+        """
+        Test that a file larger than a chunk is hashed whole.
+        """
+        self.assertEqual(file_util.file_sha256(self.path), hashlib.sha256(self.data).hexdigest())
+
+    def test_stream_sha256(self):
+        """
+        Test that only the remaining content of a file object is hashed.
+        """
+        f = io.BytesIO(self.data)
+        f.read(100)
+        self.assertEqual(file_util.stream_sha256(f), hashlib.sha256(self.data[100:]).hexdigest())
+
+    def test_file_digests_memoized(self):
+        """
+        Test that a file is read once until its size or mtime changes.
+        """
+        digests = file_util.FileDigests()
+        digest = digests.digest(self.path)
+        self.assertEqual(digest, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(digests.digest(os.path.relpath(self.path)), digest)
+        self.assertEqual(len(digests.digests), 1)
+        with open(self.path, 'ab') as f:
+            f.write(b'more')
+        self.assertEqual(digests.digest(self.path), hashlib.sha256(self.data + b'more').hexdigest())
+
+
+class AtomicOpenTests(TestCase):
+    """
+    Test the atomic replacement of files.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index.json')
+        with open(self.path, 'w') as f:
+            f.write('old')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replaced(self):
+        """
+        Test that the file is replaced once the block completes.
+        """
+        with file_util.atomic_open(self.path) as f:
+            f.write('new')
+            with open(self.path) as current:
+                self.assertEqual(current.read(), 'old')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.listdir(self.tmpdir), ['index.json'])
+
+    def test_failure(self):
+        """
+        Test that a failing write leaves the file and no temporary file behind.
+        """
+        with self.assertRaises(ValueError):
+            with file_util.atomic_open(self.path) as f:
+                f.write('partial')
+                raise ValueError('failed')
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'old')
+        self.assertEqual(os.listdir(self.tmpdir), ['index.json'])
@@ -0,0 +1,97 @@
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import incremental_run
+
+
+FULL = ['seg', 'cc', 'lh', 'rh', 'stats']
+INPUTS = {'t1': 'a' * 64, 'weights_ax': 'b' * 64}
+
+
+def record(**options):
+    return incremental_run.make_record(options, INPUTS)
+
+
+class PlanTests(TestCase):
+    """
+    Test the decision of what an incremental run has to run again.
+    """
+    def test_first_run(self):
+        """
+        Test that a subject without a record is run entirely.
+        """
+        plan = incremental_run.plan(None, {}, INPUTS, FULL, [])
+        self.assertEqual(plan.level, 'full')
+
+    def test_up_to_date(self):
+        """
+        Test that nothing runs again when the options, inputs and outputs are unchanged.
+        """
+        plan = incremental_run.plan(record(fstess=True), {'fstess': True, 'threads': 4},
+                                    INPUTS, FULL, FULL)
+        self.assertEqual(plan, incremental_run.Plan('none', []))
+
+    def test_changed_inputs(self):
+        """
+        Test that a changed T1 or segmentation option reruns everything.
+        """
+        plan = incremental_run.plan(record(), {}, dict(INPUTS, t1='c' * 64), FULL, FULL)
+        self.assertEqual(plan, incremental_run.Plan('full', ['t1 changed']))
+        plan = incremental_run.plan(record(), {'order': 3}, INPUTS, FULL, FULL)
+        self.assertEqual(plan, incremental_run.Plan('full', ['--order changed']))
+
+    def test_addons(self):
+        """
+        Test that added outputs only rerun recon-surf, or its part up to the CC.
+        """
+        plan = incremental_run.plan(record(), {'surfreg': True}, INPUTS, FULL, FULL)
+        self.assertEqual(plan, incremental_run.Plan('surf', ['--surfreg added']))
+        plan = incremental_run.plan(record(surfreg=True), {}, INPUTS, FULL, FULL)
+        self.assertEqual(plan.level, 'none')
+        plan = incremental_run.plan(record(seg_only=True), {'seg_only': True, 'vol_segstats': True},
+                                    INPUTS, ['seg', 'cc'], ['seg'])
+        self.assertEqual(plan, incremental_run.Plan('cc', ['--vol_segstats added',
+                                                           'cc outputs missing']))
+
+    def test_missing_outputs(self):
+        """
+        Test that the most expensive missing stage decides the level.
+        """
+        plan = incremental_run.plan(record(), {}, INPUTS, FULL, ['seg', 'cc', 'lh'])
+        self.assertEqual(plan.level, 'surf')
+        plan = incremental_run.plan(record(vol_segstats=True), {}, INPUTS, FULL, ['cc', 'lh'])
+        self.assertEqual(plan.level, 'full')
+
+
+class RecordTests(TestCase):
+    """
+    Test the persisted record of the last run.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        """
+        Test that records are saved and only carry the recorded options.
+        """
+        self.assertIsNone(incremental_run.load_record(self.tmpdir))
+        saved = record(fsaparc=True, threads=4)
+        self.assertEqual(saved['options'], {'fsaparc': True})
+        incremental_run.save_record(self.tmpdir, saved)
+        self.assertEqual(incremental_run.load_record(self.tmpdir), saved)
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, incremental_run.RECORD_NAME)))
+
+    def test_merge(self):
+        """
+        Test that a run up to the CC keeps the surface options of the record.
+        """
+        merged = incremental_run.merge_record(record(fsaparc=True), record(vol_segstats=True), 'cc')
+        self.assertEqual(merged['options'], {'fsaparc': True, 'vol_segstats': True})
+        merged = incremental_run.merge_record(record(fsaparc=True), record(), 'full')
+        self.assertEqual(merged['options'], {})
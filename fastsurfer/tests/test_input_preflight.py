@@ -0,0 +1,128 @@
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import input_preflight
+from fastsurfer.volume_header import VolumeHeader
+
+
+RAS = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (0.0, 0.0, 1.0))
+
+
+def header(shape=(256, 256, 256), voxel_size=(1.0, 1.0, 1.0), dtype='uint8', orientation=RAS):
+    return VolumeHeader('mgh', shape, voxel_size, dtype, 284, orientation)
+
+
+class CheckHeaderTests(TestCase):
+    """
+    Test the validation of T1 headers against the FastSurfer input requirements.
+    """
+    def test_conformed(self):
+        """
+        Test that a 1 mm isotropic volume passes, within the tolerance.
+        """
+        self.assertEqual(input_preflight.check_header(header()), [])
+        self.assertEqual(input_preflight.check_header(header(voxel_size=(1.0, 0.99, 1.02))), [])
+
+    def test_voxel_size(self):
+        """
+        Test that anisotropic and non-1 mm voxels are rejected.
+        """
+        problems = input_preflight.check_header(header(voxel_size=(1.0, 1.0, 1.2)))
+        self.assertEqual(problems, ['anisotropic voxels of 1.00x1.00x1.20 mm'])
+        problems = input_preflight.check_header(header(voxel_size=(0.8, 0.8, 0.8)))
+        self.assertEqual(problems, ['0.80 mm voxels, 1 mm is required'])
+
+    def test_shape_and_orientation(self):
+        """
+        Test that multi-frame volumes and unknown or degenerate orientations
+        are rejected.
+        """
+        self.assertEqual(len(input_preflight.check_header(header(shape=(256, 256, 256, 2)))), 1)
+        self.assertEqual(input_preflight.check_header(header(shape=(256, 256, 256, 1))), [])
+        self.assertEqual(len(input_preflight.check_header(header(orientation=None))), 1)
+        flat = ((1.0, 0.0, 0.0), (0.0, 1.0, 0.0), (1.0, 1.0, 0.0))
+        self.assertEqual(input_preflight.check_header(header(orientation=flat)),
+                         ['degenerate orientation'])
+
+
+class InputIndexTests(TestCase):
+    """
+    Test the cached header index of the input volumes.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_path = os.path.join(self.tmpdir, 'index.json')
+        self.described = []
+        self.paths = []
+        for name in ('a.mgz', 'b.mgz'):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'wb') as f:
+                f.write(name.encode())
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def describe(self, path):
+        self.described.append(path)
+        return {'voxels': len(path), 'problems': []}
+
+    def test_cached(self):
+        """
+        Test that entries are persisted and only changed files re-described.
+        """
+        entries = input_preflight.InputIndex(self.index_path, self.describe).scan(self.paths)
+        self.assertEqual(sorted(self.described), self.paths)
+        self.assertEqual(len(entries[self.paths[0]]['sha256']), 64)
+
+        with open(self.paths[1], 'ab') as f:
+            f.write(b'changed')
+        del self.described[:]
+        entries = input_preflight.InputIndex(self.index_path, self.describe).scan(self.paths)
+        self.assertEqual(self.described, [self.paths[1]])
+        self.assertEqual(entries[self.paths[1]]['size'], len(b'b.mgzchanged'))
+
+    def test_missing_file(self):
+        """
+        Test that a missing file is reported as a problem.
+        """
+        missing = os.path.join(self.tmpdir, 'missing.mgz')
+        entries = input_preflight.InputIndex(None, self.describe).scan([missing])
+        self.assertEqual(len(entries[missing]['problems']), 1)
+        self.assertEqual(self.described, [])
+
+
+class PreflightTests(TestCase):
+    """
+    Test the license checks and the scheduling order.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_license(self):
+        """
+        Test that missing and empty license files are rejected.
+        """
+        path = os.path.join(self.tmpdir, 'license.txt')
+        self.assertIn('does not exist', input_preflight.check_license(path))
+        open(path, 'w').close()
+        self.assertIn('empty', input_preflight.check_license(path))
+        with open(path, 'w') as f:
+            f.write('user@example.org\n12345\n')
+        self.assertIsNone(input_preflight.check_license(path))
+        self.assertEqual(input_preflight.find_license({'FREESURFER_HOME': self.tmpdir}), path)
+        self.assertIsNone(input_preflight.find_license({}))
+
+    def test_longest_first(self):
+        """
+        Test that the largest inputs come first, ties in their original order.
+        """
+        jobs = [('a', 1), ('b', 3), ('c', 1), ('d', 2)]
+        self.assertEqual(input_preflight.longest_first(jobs, lambda job: job[1]),
+                         [('b', 3), ('d', 2), ('a', 1), ('c', 1)])
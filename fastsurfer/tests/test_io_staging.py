@@ -0,0 +1,89 @@
+
+import gzip
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import io_staging
+
+
+class StagingTests(TestCase):
+    """
+    Test the node-local staging of inputs and subject directories.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.subject_dir = os.path.join(self.tmpdir, 'work', 'bert')
+        for relpath, content in (('mri/orig.mgz', b'orig'), ('surf/lh.white.preaparc', b'white'),
+                                 ('scripts/recon-surf.log', b'log')):
+            path = os.path.join(self.subject_dir, relpath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+        os.symlink('lh.white.preaparc', os.path.join(self.subject_dir, 'surf', 'lh.white'))
+        self.dest_dir = os.path.join(self.tmpdir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_stage_in_decompresses(self):
+        """
+        Test that compressed T1 volumes are decompressed once, others copied.
+        """
+        t1 = os.path.join(self.tmpdir, 'T1.nii.gz')
+        with gzip.open(t1, 'wb') as f:
+            f.write(b'volume')
+        plain = os.path.join(self.tmpdir, 'T1.mgz')
+        with open(plain, 'wb') as f:
+            f.write(b'not compressed')
+        staging = io_staging.StagingArea(os.path.join(self.tmpdir, 'scratch'))
+        local_t1 = staging.stage_in('bert', t1, self.subject_dir)
+        self.assertEqual(os.path.basename(local_t1), 'T1.nii')
+        with open(local_t1, 'rb') as f:
+            self.assertEqual(f.read(), b'volume')
+        self.assertEqual(staging.stage_in('bert', 'unused'), local_t1)
+        self.assertTrue(os.path.islink(os.path.join(staging.subjects_dir, 'bert', 'surf', 'lh.white')))
+        self.assertEqual(os.path.basename(staging.stage_in('ernie', plain)), 'T1.mgz')
+        staging.cleanup()
+        self.assertFalse(os.path.exists(staging.root))
+
+    def test_stage_out_directory(self):
+        """
+        Test that a transferred directory replaces the previous one and comes
+        with verifiable checksums.
+        """
+        os.makedirs(os.path.join(self.dest_dir, 'bert', 'stale'))
+        report = io_staging.stage_out(self.subject_dir, self.dest_dir)
+        dest = os.path.join(self.dest_dir, 'bert')
+        self.assertEqual(report.destination, dest)
+        self.assertEqual(report.files, 3)
+        self.assertFalse(os.path.exists(os.path.join(dest, 'stale')))
+        self.assertEqual(os.readlink(os.path.join(dest, 'surf', 'lh.white')), 'lh.white.preaparc')
+        checksums = io_staging.read_checksums(os.path.join(dest, io_staging.CHECKSUMS_NAME))
+        self.assertEqual(sorted(checksums), sorted(['mri/orig.mgz', 'surf/lh.white.preaparc',
+                                                    'scripts/recon-surf.log']))
+        io_staging.verify_tree(dest, checksums)
+        self.assertEqual(sorted(os.listdir(self.dest_dir)), ['bert'])
+
+    def test_stage_out_archive(self):
+        """
+        Test that a compressed transfer writes a verified archive of the subject.
+        """
+        report = io_staging.stage_out(self.subject_dir, self.dest_dir, compress=True)
+        self.assertEqual(report.destination, os.path.join(self.dest_dir, 'bert.tar.gz'))
+        with tarfile.open(report.destination) as tar:
+            names = tar.getnames()
+        self.assertIn('bert/mri/orig.mgz', names)
+        self.assertIn('bert/' + io_staging.CHECKSUMS_NAME, names)
+
+    def test_verify_detects_corruption(self):
+        """
+        Test that a modified file fails the verification.
+        """
+        checksums = io_staging.copy_tree(self.subject_dir, os.path.join(self.tmpdir, 'copy'))
+        with open(os.path.join(self.tmpdir, 'copy', 'mri', 'orig.mgz'), 'wb') as f:
+            f.write(b'corrupt')
+        with self.assertRaises(IOError):
+            io_staging.verify_tree(os.path.join(self.tmpdir, 'copy'), checksums)
@@ -0,0 +1,137 @@
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import log_stream
+from fastsurfer.resource_monitor import stage_from_line
+
+
+def classify(line):
+    return stage_from_line(line, 'surf') or stage_from_line(line, 'seg')
+
+
+class ProgressParserTests(TestCase):
+    """
+    Test the progress events derived from FastSurfer output.
+    """
+    def test_events(self):
+        """
+        Test the event sequence of a complete run.
+        """
+        events = []
+        parser = log_stream.ProgressParser('bert', classify, events.append)
+        for line in ['Evaluating Sagittal network', 'some output',
+                     'Evaluating Sagittal network',
+                     '================= Creating surfaces lh =================']:
+            parser.feed(line)
+        parser.finish(0)
+        self.assertEqual([(e.event, e.stage, e.detail) for e in events],
+                         [('started', None, None),
+                          ('stage_started', 'seg_sagittal', None),
+                          ('stage_finished', 'seg_sagittal', None),
+                          ('stage_started', 'surf: Creating surfaces lh', None),
+                          ('hemisphere', 'surf: Creating surfaces lh', 'lh'),
+                          ('stage_finished', 'surf: Creating surfaces lh', None),
+                          ('finished', 'surf: Creating surfaces lh', 0)])
+        self.assertTrue(all(e.tag == 'bert' for e in events))
+
+    def test_failed_stage_not_finished(self):
+        """
+        Test that the stage a run fails in is not reported as finished.
+        """
+        events = []
+        parser = log_stream.ProgressParser('bert', classify, events.append)
+        parser.feed('Evaluating Axial network')
+        parser.finish(1)
+        self.assertEqual([e.event for e in events], ['started', 'stage_started', 'finished'])
+        self.assertEqual(events[-1].detail, 1)
+
+
+class SubjectLogTests(TestCase):
+    """
+    Test the per-subject log files.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_writes_lines_and_events(self):
+        """
+        Test that output lines and events go to separate files named after the tag.
+        """
+        log = log_stream.SubjectLog(self.tmpdir, 'bert:seg')
+        log.write_line('stderr', 'hello')
+        log.write_event(log_stream.ProgressEvent(1.0, 'bert:seg', 'started', None, None))
+        log.close()
+        with open(os.path.join(self.tmpdir, 'bert.seg.log')) as f:
+            self.assertTrue(f.read().rstrip().endswith('stderr hello'))
+        with open(os.path.join(self.tmpdir, 'bert.seg.events.jsonl')) as f:
+            self.assertEqual(json.loads(f.readline())['event'], 'started')
+
+    def test_rotates(self):
+        """
+        Test that the log is rotated at its size limit.
+        """
+        log = log_stream.SubjectLog(self.tmpdir, 'bert', max_bytes=200, backups=2)
+        for i in range(20):
+            log.write_line('stdout', 'line %d' % i)
+        log.close()
+        names = os.listdir(self.tmpdir)
+        self.assertIn('bert.log.1', names)
+        self.assertNotIn('bert.log.3', names)
+
+
+class StreamTests(TestCase):
+    """
+    Test the streaming of subprocess output.
+    """
+    def test_stream_process(self):
+        """
+        Test that the lines of both pipes are passed on in order per pipe.
+        """
+        code = ('import sys\n'
+                'for i in range(100):\n'
+                '    print("out %d" % i, flush=True)\n'
+                '    print("err %d" % i, file=sys.stderr, flush=True)\n')
+        process = subprocess.Popen([sys.executable, '-c', code],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lines = []
+        log_stream.stream_process(process, lambda name, line: lines.append((name, line)))
+        process.wait()
+        self.assertEqual([l for n, l in lines if n == 'stdout'], ['out %d' % i for i in range(100)])
+        self.assertEqual([l for n, l in lines if n == 'stderr'], ['err %d' % i for i in range(100)])
+
+    def test_stream_long_line(self):
+        """
+        Test that a line longer than LINE_LIMIT is passed on in pieces without
+        losing any of it.
+        """
+        size = 2 * log_stream.LINE_LIMIT + 10
+        code = ('import sys\n'
+                'sys.stdout.write("x" * %d + "\\nend")\n' % size)
+        process = subprocess.Popen([sys.executable, '-c', code],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        lines = []
+        log_stream.stream_process(process, lambda name, line: lines.append(line))
+        process.wait()
+        self.assertGreater(len(lines), 2)
+        self.assertEqual(''.join(lines[:-1]), 'x' * size)
+        self.assertEqual(lines[-1], 'end')
+
+    def test_console_progress_only(self):
+        """
+        Test that progress_only suppresses output lines but not events.
+        """
+        stream = io.StringIO()
+        console = log_stream.ConsoleWriter(stream, progress_only=True)
+        console.line('bert', 'noise')
+        console.event(log_stream.ProgressEvent(1.0, 'bert', 'finished', 'seg_axial', 0))
+        self.assertEqual(stream.getvalue(), '[bert] >> finished seg_axial (0)\n')
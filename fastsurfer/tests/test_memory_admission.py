@@ -0,0 +1,127 @@
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from fastsurfer import memory_admission
+
+
+GIB = 1024 ** 3
+
+
+class PeakMemoryModelTests(TestCase):
+    """
+    Test the learned per-stage peak memory model.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'memory.sqlite')
+        self.model = memory_admission.PeakMemoryModel(self.path)
+
+    def tearDown(self):
+        self.model.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_linear_fit(self):
+        """
+        Test that peaks growing with the input size are extrapolated.
+        """
+        for voxels, peak in ((100, 1100), (200, 2100), (300, 3100)):
+            self.model.record('seg', voxels, peak)
+        self.assertEqual(self.model.predict('seg', 400),
+                         int(4100 * memory_admission.SAFETY_FACTOR))
+
+    def test_single_sample(self):
+        """
+        Test that a single sample is scaled up, never down, by the input size.
+        """
+        self.model.record('surf', 100, 1000)
+        self.assertEqual(self.model.predict('surf', 50), int(1000 * memory_admission.SAFETY_FACTOR))
+        self.assertEqual(self.model.predict('surf', 200), int(2000 * memory_admission.SAFETY_FACTOR))
+
+    def test_parts(self):
+        """
+        Test that an unmeasured stage is predicted by its measured parts.
+        """
+        self.assertIsNone(self.model.predict('full', 100))
+        self.model.record('seg', 100, 3000)
+        self.assertIsNone(self.model.predict('full', 100, ('seg', 'surf')))
+        self.model.record('surf', 100, 2000)
+        self.assertEqual(self.model.predict('full', 100, ('seg', 'surf')),
+                         self.model.predict('seg', 100))
+
+    def test_persisted(self):
+        """
+        Test that the samples survive reopening the database.
+        """
+        self.model.record('seg', 100, 1000)
+        self.model.record('seg', 100, 1200)
+        reopened = memory_admission.PeakMemoryModel(self.path)
+        try:
+            self.assertEqual(reopened.stats(), {'seg': 2})
+            self.assertEqual(reopened.predict('seg', 100), self.model.predict('seg', 100))
+        finally:
+            reopened.close()
+
+
+class MemoryGateTests(TestCase):
+    """
+    Test the admission of runs under a memory limit.
+    """
+    def setUp(self):
+        self.gate = memory_admission.MemoryGate(4 * GIB)
+
+    def start(self, tag, predicted, admitted):
+        queued = threading.Event()
+
+        def admit():
+            self.gate.admit(tag, predicted, queued.set)
+            admitted.append(tag)
+
+        thread = threading.Thread(target=admit)
+        thread.start()
+        return thread, queued
+
+    def test_queued_until_released(self):
+        """
+        Test that a run that does not fit waits for a release.
+        """
+        self.gate.admit('a', 3 * GIB)
+        admitted = []
+        thread, queued = self.start('b', 2 * GIB, admitted)
+        self.assertTrue(queued.wait(10))
+        self.assertEqual(admitted, [])
+        self.gate.release('a')
+        thread.join(10)
+        self.assertEqual(admitted, ['b'])
+        self.assertEqual(self.gate.in_use(), 2 * GIB)
+
+    def test_arrival_order(self):
+        """
+        Test that a small run that would fit does not overtake a queued large one.
+        """
+        self.gate.admit('a', 3 * GIB)
+        admitted = []
+        # the small run fits next to 'a' but not next to the large one, so it
+        # can only be admitted after the large one if it does not overtake it
+        large, queued = self.start('large', 3 * GIB + GIB // 2 + 1, admitted)
+        self.assertTrue(queued.wait(10))
+        small, queued = self.start('small', GIB // 2, admitted)
+        self.assertTrue(queued.wait(10))
+        self.assertEqual(admitted, [])
+        self.gate.release('a')
+        large.join(10)
+        self.assertEqual(admitted, ['large'])
+        self.assertTrue(small.is_alive())
+        self.gate.release('large')
+        small.join(10)
+        self.assertEqual(admitted, ['large', 'small'])
+
+    def test_oversized_run_alone(self):
+        """
+        Test that a run predicted above the limit is admitted when alone.
+        """
+        self.gate.admit('huge', 8 * GIB)
+        self.assertEqual(self.gate.in_use(), 8 * GIB)
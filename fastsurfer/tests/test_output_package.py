@@ -0,0 +1,110 @@
+
+import gzip
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import output_package
+
+
+SUBJECT_FILES = {
+    'mri/orig.mgz': gzip.compress(b'orig' * 100),
+    'mri/norm.mgz': gzip.compress(b'norm' * 100),
+    'stats/aseg.stats': b'# aseg stats\n' * 50,
+    'surf/lh.white': b'white' * 200,
+    'label/lh.aparc.DKTatlas.mapped.annot': b'annot' * 20,
+    'scripts/recon-surf.log': b'log\n',
+}
+
+
+class PackageTests(TestCase):
+    """
+    Test the selection and chunked packing of subject outputs.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dest_dir = os.path.join(self.tmpdir, 'out')
+        os.mkdir(self.dest_dir)
+        self.subject_dirs = {}
+        for sid in ('bert', 'ernie'):
+            subject_dir = os.path.join(self.tmpdir, sid)
+            for relpath, data in SUBJECT_FILES.items():
+                path = os.path.join(subject_dir, relpath)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+            self.subject_dirs[sid] = subject_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_profiles(self):
+        """
+        Test that profiles select their files and unknown ones are rejected.
+        """
+        self.assertEqual(output_package.select_files(self.subject_dirs['bert'], ['seg', 'stats']),
+                         ['mri/orig.mgz', 'stats/aseg.stats'])
+        self.assertEqual(len(output_package.select_files(self.subject_dirs['bert'], ['full'])),
+                         len(SUBJECT_FILES))
+        self.assertEqual(output_package.parse_profiles('stats, surfaces'), ['stats', 'surfaces'])
+        self.assertRaises(ValueError, output_package.parse_profiles, 'seg,thickness')
+
+    def test_symlinks(self):
+        """
+        Test that links are packed as the files they point to and dangling
+        ones are left out.
+        """
+        surf_dir = os.path.join(self.subject_dirs['bert'], 'surf')
+        os.symlink('lh.white', os.path.join(surf_dir, 'lh.pial'))
+        os.symlink('lh.pial.T1', os.path.join(surf_dir, 'rh.pial'))
+        self.assertEqual(output_package.select_files(self.subject_dirs['bert'], ['surfaces']),
+                         ['label/lh.aparc.DKTatlas.mapped.annot', 'surf/lh.pial', 'surf/lh.white'])
+        report = output_package.pack(self.subject_dirs, ['surfaces'], self.dest_dir, 'pkg')
+        self.assertEqual(report.files, 5)
+        self.assertEqual(output_package.read_file(os.path.join(self.dest_dir, report.index),
+                                                  'bert/surf/lh.pial'),
+                         SUBJECT_FILES['surf/lh.white'])
+
+    def test_read_file(self):
+        """
+        Test that every packed file reads back from its offset unchanged.
+        """
+        report = output_package.pack(self.subject_dirs, ['full'], self.dest_dir, 'pkg')
+        self.assertEqual(report.files, 2 * len(SUBJECT_FILES))
+        self.assertEqual(report.chunks, 1)
+        index_path = os.path.join(self.dest_dir, report.index)
+        for sid in self.subject_dirs:
+            for relpath, data in SUBJECT_FILES.items():
+                self.assertEqual(output_package.read_file(index_path, sid + '/' + relpath), data)
+        self.assertRaises(KeyError, output_package.read_file, index_path, 'bert/mri/aseg.mgz')
+
+    def test_chunks(self):
+        """
+        Test that archives are split by size, extract with tarfile and that a
+        repacking removes the archives it no longer needs.
+        """
+        report = output_package.pack(self.subject_dirs, ['full'], self.dest_dir, 'pkg',
+                                     chunk_size=100)
+        self.assertGreater(report.chunks, 1)
+        with tarfile.open(os.path.join(self.dest_dir, 'pkg.000.tar')) as tar:
+            names = tar.getnames()
+        self.assertIn('bert/label/lh.aparc.DKTatlas.mapped.annot.gz', names)
+        self.assertIn('bert/mri/norm.mgz', names)
+        index_path = os.path.join(self.dest_dir, report.index)
+        with open(index_path) as f:
+            entries = json.load(f)['files']
+        for name, entry in entries.items():
+            with tarfile.open(os.path.join(self.dest_dir, entry['chunk'])) as tar:
+                self.assertEqual(tar.getmember(entry['member']).offset_data, entry['offset'])
+            self.assertEqual(output_package.read_file(index_path, name),
+                             SUBJECT_FILES[name.split('/', 1)[1]])
+
+        report = output_package.pack(self.subject_dirs, ['stats'], self.dest_dir, 'pkg')
+        self.assertEqual(sorted(os.listdir(self.dest_dir)), ['pkg.000.tar', 'pkg.index.json'])
+        with open(os.path.join(self.dest_dir, 'pkg.index.json')) as f:
+            index = json.load(f)
+        self.assertEqual(sorted(index['files']), ['bert/stats/aseg.stats', 'ernie/stats/aseg.stats'])
+        self.assertEqual(index['files']['bert/stats/aseg.stats']['encoding'], 'gzip')
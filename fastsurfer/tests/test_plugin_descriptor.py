@@ -0,0 +1,71 @@
+
+import io
+import json
+import os
+import shutil
+import tempfile
+from contextlib import redirect_stdout
+from unittest import TestCase
+
+from fastsurfer import plugin_descriptor
+from fastsurfer.fastsurfer import Fastsurfer
+
+
+class PluginDescriptorTests(TestCase):
+    """
+    Test the precomputed plugin descriptor.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Fastsurfer()
+        self.descriptor_path = os.path.join(self.tmpdir, 'descriptor.json')
+        self.source_path = os.path.join(self.tmpdir, 'fastsurfer.py')
+        with open(self.source_path, 'w') as f:
+            f.write('# plugin source\n')
+        plugin_descriptor.generate(self.app, self.descriptor_path, self.source_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def serve(self, argv):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            served = plugin_descriptor.serve(argv, self.descriptor_path, self.source_path)
+        return served, output.getvalue()
+
+    def test_json_matches_app(self):
+        """
+        Test that --json prints the representation of the app.
+        """
+        served, output = self.serve(['--json'])
+        self.assertTrue(served)
+        representation = self.app.get_json_representation()
+        representation['selfpath'] = plugin_descriptor.SELFPATH
+        self.assertEqual(json.loads(output), representation)
+
+    def test_savejson(self):
+        """
+        Test that --savejson writes the representation file named after the app.
+        """
+        served, _ = self.serve(['--savejson', self.tmpdir])
+        self.assertTrue(served)
+        with open(os.path.join(self.tmpdir, 'Fastsurfer.json')) as f:
+            self.assertEqual(json.load(f)['version'], self.app.get_version())
+
+    def test_man_and_version(self):
+        """
+        Test that --man and --version print what the app prints.
+        """
+        self.assertEqual(self.serve(['--man'])[1],
+                         plugin_descriptor.captured_output(self.app.show_man_page))
+        self.assertEqual(self.serve(['--version'])[1], self.app.get_version() + '\n')
+
+    def test_falls_back(self):
+        """
+        Test that other invocations and a stale descriptor are not served.
+        """
+        self.assertFalse(self.serve(['--json', '--meta'])[0])
+        self.assertFalse(self.serve(['--t1', 'T1.mgz', 'in', 'out'])[0])
+        with open(self.source_path, 'a') as f:
+            f.write('# changed\n')
+        self.assertFalse(self.serve(['--json'])[0])
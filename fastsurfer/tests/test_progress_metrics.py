@@ -0,0 +1,132 @@
+
+import io
+import os
+import shutil
+import tempfile
+import time
+from contextlib import redirect_stdout
+from unittest import TestCase
+from urllib.request import urlopen
+
+from fastsurfer import progress_metrics
+from fastsurfer.log_stream import ProgressEvent
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ProgressMetricsTests(TestCase):
+    """
+    Test the progress metrics of a batch.
+    """
+    def setUp(self):
+        self.clock = Clock()
+        self.usage = [(0.0, 0)]
+        self.metrics = progress_metrics.ProgressMetrics(['a', 'b', 'c'], 2, 8, 16 * 1024 ** 3,
+                                                        lambda: self.usage[0], self.clock)
+
+    def test_subject_of(self):
+        """
+        Test that the stage suffix of run tags is removed.
+        """
+        self.assertEqual(progress_metrics.subject_of('bert:seg'), 'bert')
+        self.assertEqual(progress_metrics.subject_of('bert'), 'bert')
+        self.assertEqual(progress_metrics.subject_of('scan:01'), 'scan:01')
+
+    def test_states_and_stages(self):
+        """
+        Test the subject counts, current stages and stage durations.
+        """
+        self.metrics.subject_started('a')
+        self.metrics.on_event(ProgressEvent(1000.0, 'a:seg', 'stage_started', 'seg', None))
+        text = self.metrics.render()
+        self.assertIn('fastsurfer_subjects{state="queued"} 2.0', text)
+        self.assertIn('fastsurfer_subject_stage{stage="seg",subject="a"} 1.0', text)
+        self.assertNotIn('\nfastsurfer_projected_completion_timestamp_seconds ', text)
+
+        self.metrics.on_event(ProgressEvent(1030.0, 'a:seg', 'stage_finished', 'seg', None))
+        self.metrics.on_event(ProgressEvent(1030.0, 'a:seg', 'finished', 'seg', 0))
+        self.clock.now = 1100.0
+        self.metrics.subject_finished('a', 0)
+        self.metrics.subject_finished('b', 1)
+        text = self.metrics.render()
+        self.assertIn('fastsurfer_subjects{state="done"} 2.0', text)
+        self.assertIn('fastsurfer_subjects_failed 1.0', text)
+        self.assertIn('fastsurfer_stage_duration_seconds{stage="seg"} 30.0', text)
+        self.assertIn('fastsurfer_stage_completed_total{stage="seg"} 1.0', text)
+        self.assertNotIn('fastsurfer_subject_stage{', text)
+        # one subject of 100s left for 2 workers
+        self.assertIn('fastsurfer_projected_completion_timestamp_seconds 1150.0', text)
+
+    def test_usage(self):
+        """
+        Test that the CPU use is the rate of CPU time between samples.
+        """
+        self.metrics.sample_usage()
+        self.clock.now += 10
+        self.usage[0] = (40.0, 2 * 1024 ** 3)
+        self.metrics.sample_usage()
+        text = self.metrics.render()
+        self.assertIn('fastsurfer_cpu_cores_used 4.0', text)
+        self.assertIn('fastsurfer_memory_rss_bytes 2147483648.0', text)
+
+    def test_label_escaping(self):
+        """
+        Test that label values are escaped.
+        """
+        self.assertEqual(progress_metrics.format_sample('m', 1, {'stage': 'a "b"\\'}),
+                         'm{stage="a \\"b\\"\\\\"} 1.0')
+
+
+class MetricsPublisherTests(TestCase):
+    """
+    Test the metrics file and endpoint.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_publish(self):
+        """
+        Test that the metrics are written to the file and served over HTTP.
+        """
+        metrics = progress_metrics.ProgressMetrics(['a'], 1, 1, 1024)
+        path = os.path.join(self.tmpdir, 'metrics.prom')
+        publisher = progress_metrics.MetricsPublisher(metrics, path, port=0, interval=60).start()
+        try:
+            with urlopen('http://127.0.0.1:%d/metrics' % publisher.port) as response:
+                body = response.read().decode()
+                self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+            self.assertIn('fastsurfer_subjects{state="queued"} 1.0', body)
+            metrics.subject_finished('a', 0)
+        finally:
+            publisher.stop()
+        with open(path) as f:
+            self.assertIn('fastsurfer_subjects{state="done"} 1.0', f.read())
+
+    def test_write_failure(self):
+        """
+        Test that a failing metrics file write neither stops the publishing
+        nor fails the final write once the file can be written again.
+        """
+        metrics = progress_metrics.ProgressMetrics(['a'], 1, 1, 1024)
+        metrics_dir = os.path.join(self.tmpdir, 'metrics')
+        path = os.path.join(metrics_dir, 'metrics.prom')
+        publisher = progress_metrics.MetricsPublisher(metrics, path, interval=0.01).start()
+        with redirect_stdout(io.StringIO()) as output:
+            time.sleep(0.05)
+            self.assertTrue(publisher.thread.is_alive())
+            os.mkdir(metrics_dir)
+            metrics.subject_finished('a', 0)
+            publisher.stop()
+        self.assertEqual(output.getvalue().count('cannot write the metrics'), 1)
+        with open(path) as f:
+            self.assertIn('fastsurfer_subjects{state="done"} 1.0', f.read())
+        self.assertEqual(os.listdir(metrics_dir), ['metrics.prom'])
@@ -0,0 +1,58 @@
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import resource_monitor
+
+
+class ResourceMonitorTests(TestCase):
+    """
+    Test the process tree resource instrumentation.
+    """
+    def test_stage_from_line(self):
+        """
+        Test the recognition of stage markers in the FastSurfer logs.
+        """
+        self.assertEqual(resource_monitor.stage_from_line('Evaluating Axial network', 'seg'),
+                         'seg_axial')
+        self.assertIsNone(resource_monitor.stage_from_line('Reading volume', 'seg'))
+        self.assertEqual(resource_monitor.stage_from_line('==== Creating surfaces rh ====', 'surf'),
+                         'surf: Creating surfaces rh')
+        self.assertIsNone(resource_monitor.stage_from_line('mri_cc -aseg ...', 'surf'))
+
+    def test_log_tail_returns_only_new_complete_lines(self):
+        """
+        Test that a LogTail skips existing content and holds back partial lines.
+        """
+        with tempfile.NamedTemporaryFile('w', delete=False) as f:
+            f.write('old line\n')
+        try:
+            tail = resource_monitor.LogTail(f.name)
+            with open(f.name, 'a') as log:
+                log.write('first\nsec')
+            self.assertEqual(tail.read_lines(), ['first'])
+            with open(f.name, 'a') as log:
+                log.write('ond\n')
+            self.assertEqual(tail.read_lines(), ['second'])
+        finally:
+            os.remove(f.name)
+
+    def test_monitor_process_tree(self):
+        """
+        Test that the CPU time and memory of a grandchild process are accounted.
+        """
+        child = ('import subprocess, sys; subprocess.call([sys.executable, "-c", '
+                 '"b = bytearray(64 * 1024 * 1024); sum(range(2000000)); '
+                 'import time; time.sleep(0.3)"])')
+        process = subprocess.Popen([sys.executable, '-c', child])
+        monitor = resource_monitor.ProcessTreeMonitor(process.pid, interval=0.05)
+        returncode, rusage = resource_monitor.wait_process(process)
+        report = monitor.stop(rusage)
+
+        self.assertEqual(returncode, 0)
+        self.assertGreater(report['peak_rss'], 64 * 1024 * 1024)
+        self.assertGreater(report['cpu'], 0)
+        self.assertEqual([stage['name'] for stage in report['stages']], ['startup'])
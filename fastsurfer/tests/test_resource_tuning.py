@@ -0,0 +1,65 @@
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import resource_tuning
+
+
+GIB = 1024 ** 3
+
+
+class ResourceTuningTests(TestCase):
+    """
+    Test the resource-aware tuning of --threads, --parallel and --batch.
+    """
+    def setUp(self):
+        self.cgroup = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cgroup)
+
+    def write(self, relpath, content):
+        path = os.path.join(self.cgroup, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content + '\n')
+
+    def test_cgroup_v2_limits(self):
+        """
+        Test reading the CPU quota and memory limit of a cgroup v2 container.
+        """
+        self.write('cpu.max', '400000 100000')
+        self.write('memory.max', str(16 * GIB))
+        self.assertEqual(resource_tuning.effective_cpus(32, self.cgroup), 4)
+        self.assertEqual(resource_tuning.effective_memory(64 * GIB, self.cgroup), 16 * GIB)
+
+        self.write('cpu.max', 'max 100000')
+        self.write('memory.max', 'max')
+        self.assertEqual(resource_tuning.effective_cpus(32, self.cgroup), 32)
+        self.assertEqual(resource_tuning.effective_memory(64 * GIB, self.cgroup), 64 * GIB)
+
+    def test_cgroup_v1_limits(self):
+        """
+        Test reading the CPU quota and memory limit of a cgroup v1 container.
+        """
+        self.write('cpu/cpu.cfs_quota_us', '250000')
+        self.write('cpu/cpu.cfs_period_us', '100000')
+        self.write('memory/memory.limit_in_bytes', str(2 ** 63 - 4096))
+        self.assertEqual(resource_tuning.effective_cpus(8, self.cgroup), 2)
+        self.assertEqual(resource_tuning.effective_memory(64 * GIB, self.cgroup), 64 * GIB)
+
+    def test_tune(self):
+        """
+        Test the choice of threads, parallel hemispheres and batch size.
+        """
+        self.assertEqual(resource_tuning.tune(8, 32 * GIB),
+                         resource_tuning.Tuning(4, True, resource_tuning.MAX_CPU_BATCH))
+        self.assertEqual(resource_tuning.tune(1, 32 * GIB).parallel, False)
+
+        tight = resource_tuning.tune(8, 7 * GIB)
+        self.assertLess(tight.batch, resource_tuning.MAX_CPU_BATCH)
+        self.assertLessEqual(resource_tuning.segmentation_memory(resource_tuning.CONFORMED_VOXELS,
+                                                                 tight.batch), 7 * GIB)
+        self.assertGreaterEqual(resource_tuning.tune(8, GIB).batch, 1)
@@ -0,0 +1,120 @@
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from fastsurfer import result_cache
+
+
+class ResultCacheTests(TestCase):
+    """
+    Test the content-addressed result cache.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = result_cache.ResultCache(os.path.join(self.tmpdir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, relpath, content):
+        path = os.path.join(self.tmpdir, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_key_depends_on_contents_and_options(self):
+        """
+        Test that the key follows the T1 contents and the options, not the path.
+        """
+        t1 = self.write('a/T1.mgz', 'volume')
+        same = self.write('b/T1.mgz', 'volume')
+        other = self.write('c/T1.mgz', 'other volume')
+        weights = [self.write('ckpt.pkl', 'weights')]
+
+        key = self.cache.key('bert', t1, {'order': '1'}, weights)
+        self.assertEqual(key, self.cache.key('bert', same, {'order': '1'}, weights))
+        self.assertNotEqual(key, self.cache.key('bert', other, {'order': '1'}, weights))
+        self.assertNotEqual(key, self.cache.key('bert', t1, {'order': '3'}, weights))
+
+    def test_key_depends_on_sid(self):
+        """
+        Test that the same T1 under another subject ID does not hit the entry
+        of the first subject, whose outputs carry its ID.
+        """
+        t1 = self.write('a/T1.mgz', 'volume')
+        weights = [self.write('ckpt.pkl', 'weights')]
+        subject_dir = self.write('bert/stats/aseg.stats', '# subjectname bert\n')
+        key = self.cache.key('bert', t1, {}, weights)
+        self.cache.store(key, os.path.dirname(os.path.dirname(subject_dir)))
+        other = self.cache.key('ernie', t1, {}, weights)
+        self.assertNotEqual(key, other)
+        self.assertFalse(self.cache.restore(other, os.path.join(self.tmpdir, 'out', 'ernie')))
+        self.assertTrue(self.cache.restore(key, os.path.join(self.tmpdir, 'out', 'bert')))
+
+    def test_store_and_restore(self):
+        """
+        Test that a stored subject directory is restored by copy and by hardlink.
+        """
+        subject = os.path.join(self.tmpdir, 'sd', 'bert')
+        self.write('sd/bert/mri/aseg.mgz', 'seg')
+
+        self.assertFalse(self.cache.restore('k', os.path.join(self.tmpdir, 'copy')))
+        self.cache.store('k', subject)
+
+        for name, hardlink in (('copy', False), ('link', True)):
+            dest = os.path.join(self.tmpdir, name)
+            self.assertTrue(self.cache.restore('k', dest, hardlink))
+            with open(os.path.join(dest, 'mri', 'aseg.mgz')) as f:
+                self.assertEqual(f.read(), 'seg')
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']), (1, 2, 1))
+
+    def test_lru_eviction(self):
+        """
+        Test that the least recently used entry is evicted beyond the size cap.
+        """
+        self.cache.max_bytes = 10
+        for name in ('old', 'new'):
+            self.write('%s/file' % name, 'x' * 6)
+        self.cache.store('old', os.path.join(self.tmpdir, 'old'))
+        time.sleep(0.01)
+        self.cache.store('new', os.path.join(self.tmpdir, 'new'))
+
+        self.assertEqual(list(self.cache.index['entries']), ['new'])
+        self.assertFalse(os.path.exists(os.path.join(self.cache.root, 'old')))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_index_is_persisted(self):
+        """
+        Test that a new cache instance on the same directory sees the entries.
+        """
+        self.write('sd/bert/file', 'data')
+        self.cache.store('k', os.path.join(self.tmpdir, 'sd', 'bert'))
+
+        reopened = result_cache.ResultCache(self.cache.root)
+        self.assertTrue(reopened.restore('k', os.path.join(self.tmpdir, 'restored')))
+
+    def test_shared_root(self):
+        """
+        Test that instances sharing a root keep each other's entries, and
+        that entries missing from the index are adopted again.
+        """
+        self.write('sd/bert/file', 'bert')
+        self.write('sd/ernie/file', 'ernie')
+        other = result_cache.ResultCache(self.cache.root)
+        self.cache.store('K', os.path.join(self.tmpdir, 'sd', 'bert'))
+        other.store('L', os.path.join(self.tmpdir, 'sd', 'ernie'))
+        self.assertTrue(self.cache.restore('L', os.path.join(self.tmpdir, 'l')))
+        self.assertTrue(other.restore('K', os.path.join(self.tmpdir, 'k')))
+        self.assertEqual(sorted(self.cache.index['entries']), ['K', 'L'])
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+        os.remove(os.path.join(self.cache.root, result_cache.ResultCache.INDEX_NAME))
+        reopened = result_cache.ResultCache(self.cache.root)
+        self.assertEqual(sorted(reopened.index['entries']), ['K', 'L'])
+        self.assertEqual(reopened.index['entries']['K']['size'], 4)
@@ -0,0 +1,73 @@
+
+from unittest import TestCase
+
+from fastsurfer import run_options
+
+
+def defaults(**values):
+    """
+    Return the plugin argument values of a run without options, updated by <values>.
+    """
+    result = {option.name: option.unset for option in run_options.RUN_OPTIONS}
+    result.update(values)
+    return result
+
+
+class CheckTests(TestCase):
+    """
+    Test the validation of the run_fastsurfer.sh options.
+    """
+    def test_defaults(self):
+        """
+        Test that the defaults are valid and select nothing.
+        """
+        self.assertEqual(run_options.check(defaults()), [])
+        self.assertEqual(run_options.select(defaults()), {})
+
+    def test_limits(self):
+        """
+        Test that integers out of their limits are rejected.
+        """
+        self.assertEqual(run_options.check(defaults(order=0, batch=1, threads=4)), [])
+        self.assertEqual(run_options.check(defaults(order=4)), ['--order must be between 0 and 3'])
+        self.assertEqual(run_options.check(defaults(threads=-2)), ['--threads must be at least 1'])
+
+    def test_types(self):
+        """
+        Test that mistyped values are rejected.
+        """
+        self.assertEqual(run_options.check(defaults(parallel='1', batch='8')),
+                         ['--batch must be an integer', '--parallel is a flag'])
+
+    def test_exclusive(self):
+        """
+        Test that --seg_only and --surf_only cannot be combined.
+        """
+        self.assertEqual(run_options.check(defaults(seg_only=True, surf_only=True)),
+                         ['--seg_only and --surf_only cannot be combined'])
+        self.assertEqual(run_options.check(defaults(seg_only=True, vol_segstats=True)), [])
+        self.assertEqual(run_options.check(defaults(seg_with_cc_only=True, surf_only=True)), [])
+
+
+class BuildArgvTests(TestCase):
+    """
+    Test the run_fastsurfer.sh argv.
+    """
+    def test_canonical_order(self):
+        """
+        Test that the argv follows the option order, flags without a value.
+        """
+        options = run_options.select(defaults(threads=4, parallel=True, t1='/in/my t1.nii.gz',
+                                              sid='bert', order=0))
+        argv = run_options.build_argv('./run_fastsurfer.sh', options)
+        self.assertEqual(argv, ['./run_fastsurfer.sh', '--sid', 'bert', '--t1', '/in/my t1.nii.gz',
+                                '--order', '0', '--parallel', '--threads', '4'])
+        self.assertEqual(argv, run_options.build_argv('./run_fastsurfer.sh',
+                                                      dict(reversed(list(options.items())))))
+
+    def test_format_argv(self):
+        """
+        Test that the logged command line is quoted.
+        """
+        self.assertEqual(run_options.format_argv(['./run_fastsurfer.sh', '--t1', '/in/my t1.nii']),
+                         "./run_fastsurfer.sh --t1 '/in/my t1.nii'")
@@ -0,0 +1,130 @@
+
+import os
+import shutil
+import sys
+import tempfile
+import types
+from unittest import TestCase
+
+from fastsurfer import seg_worker
+
+
+# stands in for FastSurferCNN/eval.py, adding a log handler at every run as it does
+EVAL_SCRIPT = '''
+import logging
+import sys
+
+if __name__ == "__main__":
+    logger = logging.getLogger("eval")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler(stream=sys.stdout))
+    out_name = sys.argv[sys.argv.index("--out_name") + 1]
+    for view in ("Sagittal", "Axial", "Coronal"):
+        logger.info("Evaluating %s network" % view)
+    with open(out_name, "w") as f:
+        f.write("seg")
+    sys.exit(int(sys.argv[sys.argv.index("--exit") + 1]))
+'''
+
+
+class SegWorkerTests(TestCase):
+    """
+    Test the persistent segmentation worker.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.eval_path = os.path.join(self.tmpdir, 'eval.py')
+        with open(self.eval_path, 'w') as f:
+            f.write(EVAL_SCRIPT)
+        self.worker = seg_worker.SegWorker(sys.executable, self.eval_path,
+                                           log_path=os.path.join(self.tmpdir, 'worker.log'),
+                                           timeout=60)
+
+    def tearDown(self):
+        self.worker.close()
+        shutil.rmtree(self.tmpdir)
+
+    def segment(self, sid, exit_code=0):
+        lines = []
+        out_name = os.path.join(self.tmpdir, sid + '.mgz')
+        log_path = os.path.join(self.tmpdir, sid + '.log')
+        returncode = self.worker.segment(['--out_name', out_name, '--exit', str(exit_code)],
+                                         log_path, lines.append)
+        return returncode, lines, out_name, log_path
+
+    def test_jobs(self):
+        """
+        Test that consecutive jobs stream their output once each and write
+        their outputs and logs.
+        """
+        for sid in ('bert', 'ernie'):
+            returncode, lines, out_name, log_path = self.segment(sid)
+            self.assertEqual(returncode, 0)
+            self.assertEqual(lines, ['Evaluating Sagittal network', 'Evaluating Axial network',
+                                     'Evaluating Coronal network'])
+            self.assertTrue(os.path.isfile(out_name))
+            with open(log_path) as f:
+                self.assertEqual(f.read().splitlines(), lines)
+
+    def test_exit_code(self):
+        """
+        Test that the exit code of a job is returned and the worker survives it.
+        """
+        self.assertEqual(self.segment('bert', 3)[0], 3)
+        self.assertEqual(self.segment('ernie')[0], 0)
+
+    def test_close(self):
+        """
+        Test that closing stops the worker and removes its socket.
+        """
+        self.worker.close()
+        self.assertIsNotNone(self.worker.process.poll())
+        self.assertFalse(os.path.exists(self.worker.socket_dir))
+
+    def test_pool_on_start(self):
+        """
+        Test that the pool reports the pid of the worker running a job.
+        """
+        pool = seg_worker.SegWorkerPool([self.worker])
+        pids = []
+        out_name = os.path.join(self.tmpdir, 'bert.mgz')
+        returncode = pool.segment(['--out_name', out_name, '--exit', '0'],
+                                  os.path.join(self.tmpdir, 'bert.log'), lambda line: None,
+                                  pids.append)
+        self.assertEqual(returncode, 0)
+        self.assertEqual(pids, [self.worker.process.pid])
+
+
+class MemoizeLoadTests(TestCase):
+    """
+    Test the in-memory checkpoint cache.
+    """
+    def test_loads_once(self):
+        """
+        Test that a checkpoint is read once per map_location.
+        """
+        calls = []
+
+        def load(f, map_location=None):
+            calls.append((f, map_location))
+            return object()
+
+        module = types.SimpleNamespace(load=load)
+        loaded = seg_worker.memoize_load(module)
+        path = os.path.abspath(__file__)
+        first = module.load(path, map_location='cpu')
+        self.assertIs(module.load(path, map_location='cpu'), first)
+        self.assertIsNot(module.load(path, map_location='cuda'), first)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(loaded), 2)
+
+    def test_loaders(self):
+        """
+        Test that checkpoints with a loader are not read by the original load.
+        """
+        calls = []
+        module = types.SimpleNamespace(load=lambda f, map_location=None: calls.append(f))
+        path = os.path.abspath(__file__)
+        seg_worker.memoize_load(module, {os.path.realpath(path): lambda: 'mapped'})
+        self.assertEqual(module.load(path, map_location='cpu'), 'mapped')
+        self.assertEqual(calls, [])
@@ -0,0 +1,83 @@
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from fastsurfer import stage_checkpoint
+
+
+class StageCheckpointTests(TestCase):
+    """
+    Test the stage manifest.
+    """
+    def setUp(self):
+        self.subject_dir = tempfile.mkdtemp()
+        self.stages = stage_checkpoint.subject_stages()
+
+    def tearDown(self):
+        shutil.rmtree(self.subject_dir)
+
+    def write_stage(self, name, age=0):
+        stage = [stage for stage in self.stages if stage.name == name][0]
+        for output in stage.outputs:
+            path = os.path.join(self.subject_dir, output)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(name)
+            os.utime(path, (time.time() - age,) * 2)
+
+    def test_target_stages(self):
+        """
+        Test the stages produced by the run_fastsurfer.sh switches.
+        """
+        self.assertEqual(stage_checkpoint.target_stages(seg_only=True), ['seg'])
+        self.assertEqual(stage_checkpoint.target_stages(seg_only=True, vol_segstats=True),
+                         ['seg', 'cc'])
+        self.assertEqual(stage_checkpoint.target_stages(seg_with_cc_only=True), ['seg', 'cc'])
+        self.assertEqual(stage_checkpoint.target_stages()[-1], 'stats')
+
+    def test_record_only_stable_outputs_while_running(self):
+        """
+        Test that recently modified outputs are only recorded once the run
+        finished successfully.
+        """
+        manifest = stage_checkpoint.StageManifest(self.subject_dir, self.stages)
+        self.write_stage('seg', age=2 * stage_checkpoint.STABLE_SECONDS)
+        self.write_stage('cc')
+
+        self.assertEqual(manifest.record(), ['seg'])
+        self.assertEqual(manifest.first_incomplete(['seg', 'cc']), 'cc')
+        self.assertEqual(manifest.record(finished=True), ['cc'])
+        self.assertIsNone(manifest.first_incomplete(['seg', 'cc']))
+
+    def test_watcher_skips_stale_outputs(self):
+        """
+        Test that outputs left by an earlier run are not recorded until the
+        current run rewrites them.
+        """
+        manifest = stage_checkpoint.StageManifest(self.subject_dir, self.stages)
+        self.write_stage('seg', age=2 * stage_checkpoint.STABLE_SECONDS)
+        with stage_checkpoint.StageWatcher(manifest, interval=3600) as watcher:
+            self.write_stage('cc')
+            watcher.stop(False)
+            self.assertEqual(manifest.completed(), [])
+            watcher.stop(True)
+        self.assertEqual(manifest.completed(), ['cc'])
+
+    def test_manifest_survives_restart_and_detects_changes(self):
+        """
+        Test that a reloaded manifest keeps completed stages, and drops a stage
+        whose outputs changed content.
+        """
+        self.write_stage('seg')
+        stage_checkpoint.StageManifest(self.subject_dir, self.stages).record(finished=True)
+
+        manifest = stage_checkpoint.StageManifest(self.subject_dir, self.stages)
+        self.assertEqual(manifest.completed(), ['seg'])
+
+        seg = os.path.join(self.subject_dir, stage_checkpoint.DEFAULT_SEG)
+        with open(seg, 'w') as f:
+            f.write('truncated')
+        self.assertEqual(manifest.completed(), [])
@@ -0,0 +1,69 @@
+
+import threading
+from unittest import TestCase
+
+from fastsurfer import stage_pipeline
+
+
+class StagePipelineTests(TestCase):
+    """
+    Test the pipelined stage executor.
+    """
+    def test_jobs_flow_through_stages_in_order(self):
+        """
+        Test that every job runs every stage, in stage order.
+        """
+        log = []
+        lock = threading.Lock()
+
+        def record(name):
+            def run(job):
+                with lock:
+                    log.append((job, name))
+                return 0
+            return run
+
+        stages = [stage_pipeline.Stage('seg', record('seg'), 1),
+                  stage_pipeline.Stage('surf', record('surf'), 2)]
+        outcomes = stage_pipeline.run_pipeline(['a', 'b', 'c'], stages)
+
+        for job, job_outcomes in zip('abc', outcomes):
+            self.assertEqual([o.stage for o in job_outcomes], ['seg', 'surf'])
+            self.assertLess(log.index((job, 'seg')), log.index((job, 'surf')))
+
+    def test_failed_stage_stops_job(self):
+        """
+        Test that a job failing a stage does not enter the next one.
+        """
+        stages = [stage_pipeline.Stage('seg', lambda job: 1 if job == 'bad' else 0, 1),
+                  stage_pipeline.Stage('surf', lambda job: 0, 1)]
+        outcomes = stage_pipeline.run_pipeline(['good', 'bad'], stages)
+
+        self.assertEqual([(o.stage, o.returncode) for o in outcomes[0]], [('seg', 0), ('surf', 0)])
+        self.assertEqual([(o.stage, o.returncode) for o in outcomes[1]], [('seg', 1)])
+
+    def test_stages_overlap(self):
+        """
+        Test that the next job is segmented while the previous one is still in
+        the surface stage.
+        """
+        surf_a_running = threading.Event()
+        seg_b_done = threading.Event()
+        overlapped = []
+
+        def seg(job):
+            if job == 'b':
+                overlapped.append(surf_a_running.wait(2))
+                seg_b_done.set()
+            return 0
+
+        def surf(job):
+            if job == 'a':
+                surf_a_running.set()
+                seg_b_done.wait(2)
+            return 0
+
+        stages = [stage_pipeline.Stage('seg', seg, 1), stage_pipeline.Stage('surf', surf, 1)]
+        stage_pipeline.run_pipeline(['a', 'b'], stages)
+
+        self.assertEqual(overlapped, [True])
@@ -0,0 +1,123 @@
+
+import math
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest import mock
+
+from fastsurfer import stats_table
+
+
+ASEG_STATS = """# Title Segmentation Statistics
+# Measure BrainSeg, BrainSegVol, Brain Segmentation Volume, 1183461.000000, mm^3
+# Measure EstimatedTotalIntraCranialVol, eTIV, Estimated Total Intracranial Volume, %s, mm^3
+# ColHeaders  Index SegId NVoxels Volume_mm3 StructName normMean normStdDev
+  1   4     6342     6342.4  Left-Lateral-Ventricle   32.1  11.2
+  2  17     4021     4021.0  Left-Hippocampus   75.3  9.8
+"""
+
+APARC_STATS = """# Measure Cortex, MeanThickness, Mean Thickness, 2.51, mm
+# ColHeaders StructName NumVert SurfArea GrayVol ThickAvg ThickStd MeanCurv GausCurv
+caudalanteriorcingulate  1500  1021  2871  2.612 0.623 0.119 0.021
+"""
+
+
+class StatsTestCase(TestCase):
+    """
+    Base class of the tests writing stats files of subjects in a temporary directory.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, sid, name, content):
+        path = os.path.join(self.tmpdir, sid, 'stats', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+
+class ParseStatsTests(StatsTestCase):
+    """
+    Test the parsing of FreeSurfer stats files.
+    """
+    def test_aseg(self):
+        """
+        Test that measures and structure volumes are parsed.
+        """
+        values = stats_table.parse_stats(self.write('bert', 'aseg.stats', ASEG_STATS % '1.5e6'))
+        self.assertEqual(values, {'BrainSegVol': 1183461.0, 'eTIV': 1.5e6,
+                                  'Left-Lateral-Ventricle.Volume_mm3': 6342.4,
+                                  'Left-Hippocampus.Volume_mm3': 4021.0})
+
+    def test_aparc(self):
+        """
+        Test that the thickness columns are parsed and garbage ignored.
+        """
+        values = stats_table.parse_stats(self.write('bert', 'lh.aparc.stats',
+                                                    APARC_STATS + 'garbage\n'))
+        self.assertEqual(values['MeanThickness'], 2.51)
+        self.assertEqual(values['caudalanteriorcingulate.ThickAvg'], 2.612)
+        self.assertNotIn('caudalanteriorcingulate.GausCurv', values)
+
+
+class StatsTableTests(StatsTestCase):
+    """
+    Test the incremental cohort table.
+    """
+    def test_incremental(self):
+        """
+        Test that only new or changed subjects are parsed and that both
+        formats hold the table.
+        """
+        subject_dirs = {}
+        for sid in ('bert', 'ernie'):
+            self.write(sid, 'aseg.stats', ASEG_STATS % '1.5e6')
+            subject_dirs[sid] = os.path.join(self.tmpdir, sid)
+        self.write('bert', 'lh.aparc.stats', APARC_STATS)
+        index_path = os.path.join(self.tmpdir, 'table.json')
+        csv_path = os.path.join(self.tmpdir, 'table.csv')
+        columns_path = os.path.join(self.tmpdir, 'table.npz')
+
+        table = stats_table.StatsTable(index_path)
+        self.assertEqual(table.scan(subject_dirs), 2)
+        self.assertEqual(table.save(csv_path, columns_path), (2, 4 + 7))
+
+        self.write('ernie', 'aseg.stats', ASEG_STATS % '1.6e6')
+        table = stats_table.StatsTable(index_path)
+        self.assertEqual(table.scan(subject_dirs), 1)
+        table.save(csv_path, columns_path)
+
+        columns = stats_table.read_columns(columns_path, ['subject', 'aseg.eTIV',
+                                                          'lh.aparc.MeanThickness'])
+        self.assertEqual(columns['subject'], ['bert', 'ernie'])
+        self.assertEqual(columns['aseg.eTIV'], [1.5e6, 1.6e6])
+        self.assertEqual(columns['lh.aparc.MeanThickness'][0], 2.51)
+        self.assertTrue(math.isnan(columns['lh.aparc.MeanThickness'][1]))
+        with open(csv_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0].split(',')[:2], ['subject', 'aseg.BrainSegVol'])
+        self.assertEqual(lines[2].split(',')[0], 'ernie')
+        self.assertEqual(lines[2].split(',')[-1], '')
+
+    def test_processes(self):
+        """
+        Test that the subjects parsed in worker processes get the same values
+        as those parsed in this one.
+        """
+        subject_dirs = {}
+        for sid in ('bert', 'ernie', 'grover'):
+            self.write(sid, 'aseg.stats', ASEG_STATS % '1.5e6')
+            self.write(sid, 'lh.aparc.stats', APARC_STATS)
+            subject_dirs[sid] = os.path.join(self.tmpdir, sid)
+        serial = stats_table.StatsTable(os.path.join(self.tmpdir, 'serial.json'))
+        self.assertEqual(serial.scan(subject_dirs, workers=1), 3)
+        parallel = stats_table.StatsTable(os.path.join(self.tmpdir, 'parallel.json'))
+        with mock.patch('os.cpu_count', return_value=2):
+            self.assertEqual(parallel.scan(subject_dirs), 3)
+        self.assertEqual(parallel.subjects, serial.subjects)
+        self.assertEqual(parallel.scan(subject_dirs), 0)
@@ -0,0 +1,74 @@
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import subject_batch
+
+
+class SubjectBatchTests(TestCase):
+    """
+    Test the multi-subject batch helpers.
+    """
+    def setUp(self):
+        self.inputdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.inputdir)
+
+    def touch(self, *parts):
+        path = os.path.join(self.inputdir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+        return path
+
+    def test_discover_subjects(self):
+        """
+        Test that every T1 volume becomes a job with a distinct subject ID.
+        """
+        self.touch('sub-01', 'T1.nii.gz')
+        self.touch('sub-02', 'T1.mgz')
+        self.touch('bert.nii')
+        self.touch('notes.txt')
+
+        jobs = subject_batch.discover_subjects(self.inputdir)
+
+        self.assertEqual([job.sid for job in jobs], ['bert', 'sub-01_T1', 'sub-02_T1'])
+        self.assertTrue(all(os.path.isabs(job.t1) for job in jobs))
+
+    def test_discover_subjects_rejects_duplicate_ids(self):
+        """
+        Test that two volumes mapping to the same subject ID are reported.
+        """
+        self.touch('bert.nii')
+        self.touch('bert.mgz')
+
+        with self.assertRaises(ValueError):
+            subject_batch.discover_subjects(self.inputdir)
+
+    def test_worker_count(self):
+        """
+        Test that the pool is bounded by cores, memory, max_workers and jobs.
+        """
+        gib = 1024 ** 3
+        self.assertEqual(subject_batch.worker_count(100, 2, 8 * gib, cpus=32, memory=256 * gib), 16)
+        self.assertEqual(subject_batch.worker_count(100, 2, 8 * gib, cpus=32, memory=40 * gib), 5)
+        self.assertEqual(subject_batch.worker_count(100, 2, 8 * gib, max_workers=3, cpus=32,
+                                                    memory=256 * gib), 3)
+        self.assertEqual(subject_batch.worker_count(2, 1, 8 * gib, cpus=32, memory=256 * gib), 2)
+        self.assertEqual(subject_batch.worker_count(10, 4, 8 * gib, cpus=2, memory=gib), 1)
+
+    def test_run_batch_collects_exit_codes(self):
+        """
+        Test that exit codes are collected in job order, exceptions included.
+        """
+        def run_subject(job):
+            if job.sid == 'c':
+                raise RuntimeError('boom')
+            return {'a': 0, 'b': 3}[job.sid]
+
+        jobs = [subject_batch.SubjectJob(sid, '/in/%s.mgz' % sid) for sid in 'abc']
+        results = subject_batch.run_batch(jobs, run_subject, 2)
+
+        self.assertEqual([(r.sid, r.returncode) for r in results], [('a', 0), ('b', 3), ('c', -1)])
@@ -0,0 +1,120 @@
+
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from fastsurfer import volume_header
+
+
+def nifti1_header(shape, pixdim, datatype=4, endian='<'):
+    """
+    Return a minimal NIfTI-1 header with an identity-like sform.
+    """
+    header = bytearray(volume_header.NIFTI1_HEADER_SIZE)
+    struct.pack_into(endian + 'i', header, 0, volume_header.NIFTI1_HEADER_SIZE)
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into(endian + '8h', header, 40, *dim)
+    struct.pack_into(endian + 'h', header, 70, datatype)
+    struct.pack_into(endian + '8f', header, 76, 1.0, *(list(pixdim) + [1.0] * (7 - len(pixdim))))
+    struct.pack_into(endian + 'f', header, 108, 352.0)
+    struct.pack_into(endian + '2h', header, 252, 0, 1)
+    for row, offset in enumerate((280, 296, 312)):
+        srow = [0.0] * 4
+        srow[row] = pixdim[row]
+        struct.pack_into(endian + '4f', header, offset, *srow)
+    header[344:348] = b'n+1\x00'
+    return bytes(header)
+
+
+def mgh_header(shape, spacing, mgh_type=0):
+    """
+    Return a minimal MGH header with RAS axes.
+    """
+    header = bytearray(volume_header.MGH_HEADER_SIZE)
+    struct.pack_into('>6i', header, 0, 1, shape[0], shape[1], shape[2], 1, mgh_type)
+    struct.pack_into('>h', header, 28, 1)
+    struct.pack_into('>3f', header, 30, *spacing)
+    struct.pack_into('>9f', header, 42, -1, 0, 0, 0, 0, -1, 0, 1, 0)
+    return bytes(header)
+
+
+class VolumeHeaderTests(TestCase):
+    """
+    Test the header-only volume reader.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir, name)
+        opener = gzip.open if name.endswith(('.gz', '.mgz')) else open
+        with opener(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_nifti1(self):
+        """
+        Test reading plain, gzipped and big-endian NIfTI-1 headers.
+        """
+        for name, endian in (('t1.nii', '<'), ('t1.nii.gz', '<'), ('be.nii', '>')):
+            path = self.write(name, nifti1_header((176, 256, 256), (1.0, 1.0, 1.2), 4, endian)
+                              + b'\x00' * 4)
+            header = volume_header.read_header(path)
+            self.assertEqual(header.format, 'nifti1')
+            self.assertEqual(header.shape, (176, 256, 256))
+            self.assertAlmostEqual(header.voxel_size[2], 1.2, places=5)
+            self.assertEqual(header.dtype, 'int16')
+            self.assertEqual(header.data_offset, 352)
+            self.assertEqual(header.orientation[0], (1.0, 0.0, 0.0))
+            self.assertEqual(volume_header.data_size(header), 176 * 256 * 256 * 2)
+
+    def test_mgz(self):
+        """
+        Test reading a gzipped MGH header.
+        """
+        path = self.write('orig.mgz', mgh_header((256, 256, 256), (1.0, 1.0, 1.0)))
+        header = volume_header.read_header(path)
+        self.assertEqual((header.format, header.shape, header.dtype),
+                         ('mgh', (256, 256, 256), 'uint8'))
+        self.assertEqual(volume_header.voxel_count(header), 256 ** 3)
+        self.assertEqual(header.orientation[1], (0.0, 0.0, -1.0))
+
+    def test_truncated_header(self):
+        """
+        Test that a truncated header is reported as a ValueError.
+        """
+        path = self.write('short.nii', nifti1_header((10, 10, 10), (1, 1, 1))[:100])
+        with self.assertRaises(ValueError):
+            volume_header.read_header(path)
+
+    def test_complete(self):
+        """
+        Test that volumes holding all their voxel data pass the completeness check.
+        """
+        data = b'\x00' * (10 * 10 * 10)
+        nifti = nifti1_header((10, 10, 10), (1, 1, 1), 2) + b'\x00' * 4
+        for name, content in (('t1.nii', nifti + data), ('t1.nii.gz', nifti + data),
+                              ('t1.mgz', mgh_header((10, 10, 10), (1, 1, 1)) + data + b'tags')):
+            path = self.write(name, content)
+            self.assertIsNone(volume_header.check_complete(path, volume_header.read_header(path)))
+
+    def test_truncated_data(self):
+        """
+        Test that plain and gzipped volumes cut short are detected from their
+        size and gzip trailer.
+        """
+        data = os.urandom(20 * 20 * 20)
+        for name in ('t1.nii', 't1.nii.gz'):
+            path = self.write(name, nifti1_header((20, 20, 20), (1, 1, 1), 2) + b'\x00' * 4 + data)
+            with open(path, 'rb') as f:
+                content = f.read()
+            with open(path, 'wb') as f:
+                f.write(content[:len(content) // 2])
+            problem = volume_header.check_complete(path, volume_header.read_header(path))
+            self.assertIn('truncated', problem)
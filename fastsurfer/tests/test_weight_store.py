@@ -0,0 +1,159 @@
+
+import array
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import unittest
+from unittest import TestCase
+
+from fastsurfer import file_util
+from fastsurfer import weight_store
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+class WeightStoreTests(TestCase):
+    """
+    Test the memory-mapped weight store format.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'net.weights')
+        self.weight = array.array('f', [float(i) for i in range(12)])
+        self.bias = array.array('f', [0.5, -0.5, 1.5])
+        self.count = struct.pack('<q', 7)
+        weight_store.write_store(self.path, [('conv.weight', '<f4', [3, 4], self.weight),
+                                             ('conv.bias', '<f4', [3], self.bias),
+                                             ('bn.num_batches_tracked', '<i8', [], self.count)],
+                                 {'nested': True, 'fields': {'epoch': 30}})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_header(self):
+        """
+        Test that every tensor is stored aligned at the offset of its header entry.
+        """
+        header = weight_store.read_header(self.path)
+        self.assertEqual(list(header['tensors']), ['conv.weight', 'conv.bias',
+                                                   'bn.num_batches_tracked'])
+        self.assertEqual(header['meta']['fields'], {'epoch': 30})
+        with open(self.path, 'rb') as f:
+            for name, content in (('conv.weight', self.weight.tobytes()),
+                                  ('conv.bias', self.bias.tobytes()),
+                                  ('bn.num_batches_tracked', self.count)):
+                entry = header['tensors'][name]
+                offset = header['data_start'] + entry['offset']
+                self.assertEqual(offset % weight_store.ALIGNMENT, 0)
+                f.seek(offset)
+                self.assertEqual(f.read(entry['size']), content)
+        self.assertEqual(os.listdir(self.tmpdir), ['net.weights'])
+
+    def test_not_a_store(self):
+        """
+        Test that other files are rejected.
+        """
+        other = os.path.join(self.tmpdir, 'other.pkl')
+        with open(other, 'wb') as f:
+            f.write(b'\x80\x02}q\x00.')
+        with self.assertRaises(ValueError):
+            weight_store.read_header(other)
+
+    @unittest.skipIf(numpy is None, 'numpy is not installed')
+    def test_map_arrays(self):
+        """
+        Test that the tensors are mapped read-only with their dtype and shape.
+        """
+        arrays, meta = weight_store.map_arrays(self.path)
+        self.assertTrue(meta['nested'])
+        weight = arrays['conv.weight']
+        self.assertEqual(weight.shape, (3, 4))
+        self.assertEqual(weight[2, 3], 11.0)
+        self.assertEqual(list(arrays['conv.bias']), [0.5, -0.5, 1.5])
+        self.assertEqual(int(arrays['bn.num_batches_tracked']), 7)
+        self.assertFalse(weight.flags.writeable)
+
+    def test_store_path(self):
+        """
+        Test that stores are keyed by content and fall back to another
+        directory next to read-only checkpoints.
+        """
+        ckpt_dir = os.path.join(self.tmpdir, 'ckpts')
+        os.makedirs(ckpt_dir)
+        checkpoint = os.path.join(ckpt_dir, 'Epoch_30_training_state.pkl')
+        with open(checkpoint, 'wb') as f:
+            f.write(b'weights')
+        digest = file_util.file_sha256(checkpoint)
+        path = weight_store.store_path(checkpoint, digest)
+        self.assertEqual(os.path.dirname(path),
+                         os.path.join(ckpt_dir, weight_store.STORE_DIR_NAME))
+        self.assertIn(digest[:16], os.path.basename(path))
+
+        shutil.rmtree(os.path.dirname(path))
+        os.chmod(ckpt_dir, stat.S_IRUSR | stat.S_IXUSR)
+        try:
+            if os.access(ckpt_dir, os.W_OK):
+                self.skipTest('running with permissions that ignore the file mode')
+            fallback = os.path.join(self.tmpdir, 'fallback')
+            self.assertEqual(os.path.dirname(weight_store.store_path(checkpoint, digest, fallback)),
+                             fallback)
+        finally:
+            os.chmod(ckpt_dir, stat.S_IRWXU)
+
+
+@unittest.skipIf(torch is None, 'torch is not installed')
+class TorchRoundTripTests(TestCase):
+    """
+    Test converting a torch checkpoint to a store and loading it back.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmpdir, 'Epoch_30_training_state.pkl')
+        self.path = os.path.join(self.tmpdir, 'net.weights')
+        self.network = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        torch.save({'model_state_dict': self.network.state_dict(), 'epoch': 30,
+                    'optimizer_state_dict': {}}, self.checkpoint)
+        weight_store.convert(self.checkpoint, self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load(self):
+        """
+        Test that the stored state dict equals the checkpoint one, without the
+        optimizer state.
+        """
+        state = weight_store.load(self.path)
+        self.assertEqual(state['epoch'], 30)
+        self.assertNotIn('optimizer_state_dict', state)
+        expected = self.network.state_dict()
+        self.assertEqual(list(state['model_state_dict']), list(expected))
+        for name, tensor in expected.items():
+            self.assertTrue(torch.equal(state['model_state_dict'][name], tensor), name)
+
+    def test_share_loaded_parameters(self):
+        """
+        Test that loaded modules share the mapped tensors, and that the
+        original load_state_dict() is restored.
+        """
+        original = torch.nn.Module.load_state_dict
+        state_dict = weight_store.load(self.path)['model_state_dict']
+        network = torch.nn.Sequential(torch.nn.Linear(4, 3), torch.nn.BatchNorm1d(3))
+        restore = weight_store.share_loaded_parameters(torch)
+        try:
+            network.load_state_dict(state_dict)
+        finally:
+            restore()
+        self.assertIs(torch.nn.Module.load_state_dict, original)
+        self.assertEqual(network[0].weight.data_ptr(), state_dict['0.weight'].data_ptr())
+        self.assertTrue(torch.equal(network[0].weight, self.network[0].weight))
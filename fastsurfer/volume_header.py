@@ -0,0 +1,184 @@
+#
+# fastsurfer ds ChRIS plugin app -- header-only reading of T1 volumes
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+
+
+import gzip
+import os
+import struct
+import zlib
+from collections import namedtuple
+
+
+VolumeHeader = namedtuple('VolumeHeader', ['format', 'shape', 'voxel_size', 'dtype',
+                                           'data_offset', 'orientation'])
+
+NIFTI1_HEADER_SIZE = 348
+MGH_HEADER_SIZE = 284
+# MGH volumes may carry tags (e.g. the command history) after the voxel data
+MAX_TRAILER_SIZE = 1024 ** 2
+
+NIFTI_DTYPES = {2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32', 64: 'float64',
+                256: 'int8', 512: 'uint16', 768: 'uint32'}
+MGH_DTYPES = {0: 'uint8', 1: 'int32', 3: 'float32', 4: 'int16'}
+
+DTYPE_SIZES = {'uint8': 1, 'int8': 1, 'int16': 2, 'uint16': 2, 'int32': 4, 'uint32': 4,
+               'float32': 4, 'float64': 8}
+
+
+def is_gzipped(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_volume(path):
+    """
+    Return a binary file object on the (decompressed) contents of <path>. For
+    gzipped volumes only the bytes actually read are decompressed.
+    """
+    if is_gzipped(path):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_exactly(f, size, path):
+    data = f.read(size)
+    if len(data) < size:
+        raise ValueError('%s: truncated header' % path)
+    return data
+
+
+def parse_nifti1(header, path):
+    """
+    Return the VolumeHeader of a NIfTI-1 header.
+    """
+    endian = '<'
+    if struct.unpack('<i', header[:4])[0] != NIFTI1_HEADER_SIZE:
+        endian = '>'
+        if struct.unpack('>i', header[:4])[0] != NIFTI1_HEADER_SIZE:
+            raise ValueError('%s: not a NIfTI-1 volume' % path)
+    dim = struct.unpack(endian + '8h', header[40:56])
+    datatype = struct.unpack(endian + 'h', header[70:72])[0]
+    pixdim = struct.unpack(endian + '8f', header[76:108])
+    vox_offset = struct.unpack(endian + 'f', header[108:112])[0]
+    qform_code, sform_code = struct.unpack(endian + '2h', header[252:256])
+    ndim = dim[0]
+    if not 1 <= ndim <= 7:
+        raise ValueError('%s: invalid NIfTI dimensions %r' % (path, dim))
+    shape = tuple(dim[1:1 + ndim])
+    if sform_code > 0:
+        rows = [struct.unpack(endian + '4f', header[offset:offset + 16])[:3]
+                for offset in (280, 296, 312)]
+        # columns of the rotation/scaling part are the voxel axes
+        orientation = tuple(tuple(rows[r][c] for r in range(3)) for c in range(3))
+    elif qform_code > 0:
+        orientation = quaternion_axes(struct.unpack(endian + '3f', header[256:268]), pixdim)
+    else:
+        orientation = None
+    return VolumeHeader('nifti1', shape, tuple(abs(p) for p in pixdim[1:4]),
+                        NIFTI_DTYPES.get(datatype, 'unknown(%d)' % datatype),
+                        int(vox_offset) or NIFTI1_HEADER_SIZE, orientation)
+
+
+def quaternion_axes(bcd, pixdim):
+    """
+    Return the voxel axes of a NIfTI qform given by its quaternion (b, c, d)
+    and pixdim.
+    """
+    b, c, d = bcd
+    a = max(0.0, 1.0 - (b * b + c * c + d * d)) ** 0.5
+    qfac = -1.0 if pixdim[0] < 0 else 1.0
+    rotation = ((a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)),
+                (2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)),
+                (2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b))
+    scale = (pixdim[1], pixdim[2], pixdim[3] * qfac)
+    return tuple(tuple(rotation[r][col] * scale[col] for r in range(3)) for col in range(3))
+
+
+def parse_mgh(header, path):
+    """
+    Return the VolumeHeader of an MGH header.
+    """
+    version, width, height, depth, nframes, mgh_type = struct.unpack('>6i', header[:24])
+    if version != 1:
+        raise ValueError('%s: not an MGH volume' % path)
+    good_ras_flag = struct.unpack('>h', header[28:30])[0]
+    spacing = struct.unpack('>3f', header[30:42])
+    mdc = struct.unpack('>9f', header[42:78])
+    shape = (width, height, depth) + ((nframes,) if nframes > 1 else ())
+    orientation = None
+    if good_ras_flag > 0:
+        orientation = tuple(tuple(mdc[3 * axis + r] * spacing[axis] for r in range(3))
+                            for axis in range(3))
+    return VolumeHeader('mgh', shape, spacing, MGH_DTYPES.get(mgh_type, 'unknown(%d)' % mgh_type),
+                        MGH_HEADER_SIZE, orientation)
+
+
+def read_header(path):
+    """
+    Return the VolumeHeader of the NIfTI-1 or MGH volume <path> (optionally
+    gzipped) without reading its voxel data.
+    """
+    try:
+        with open_volume(path) as f:
+            header = read_exactly(f, 4, path)
+            if struct.unpack('>i', header)[0] == 1:
+                return parse_mgh(header + read_exactly(f, MGH_HEADER_SIZE - 4, path), path)
+            return parse_nifti1(header + read_exactly(f, NIFTI1_HEADER_SIZE - 4, path), path)
+    except (EOFError, zlib.error) as e:
+        raise ValueError('%s: corrupt gzip stream (%s)' % (path, e))
+
+
+def voxel_count(header):
+    """
+    Return the number of voxels of the first frame of a volume.
+    """
+    count = 1
+    for size in header.shape[:3]:
+        count *= size
+    return count
+
+
+def data_size(header):
+    """
+    Return the expected size in bytes of all voxel data of a volume.
+    """
+    count = 1
+    for size in header.shape:
+        count *= size
+    return count * DTYPE_SIZES.get(header.dtype, 0)
+
+
+def stored_size(path):
+    """
+    Return the size in bytes of the contents of <path>: for gzipped files the
+    uncompressed size modulo 2**32 recorded in the gzip trailer, which is
+    read without decompressing anything.
+    """
+    if not is_gzipped(path):
+        return os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def check_complete(path, header):
+    """
+    Return why <path> cannot hold all the voxel data announced by its
+    <header>, or None. A truncated gzip stream ends in arbitrary bytes
+    instead of its trailer, so the size it records is almost surely off.
+    """
+    expected = header.data_offset + data_size(header)
+    size = stored_size(path)
+    if not is_gzipped(path):
+        if size < expected:
+            return 'truncated: %d of %d bytes' % (size, expected)
+    elif expected < 2 ** 32 and not expected <= size <= expected + MAX_TRAILER_SIZE:
+        return 'truncated or corrupt gzip stream: %d bytes recorded, %d expected' % (size, expected)
+    return None
@@ -0,0 +1,213 @@
+#
+# fastsurfer ds ChRIS plugin app -- memory-mapped network weight store
+#
+# (c) 2016-2019 Fetal-Neonatal Neuroimaging & Developmental Science Center
+#                   Boston Children's Hospital
+#
+#              http://childrenshospital.org/FNNDSC/
+#                        dev@babyMRI.org
+#
+# A FastSurferCNN checkpoint is a pickled training state: the network weights
+# plus optimizer state, unpickled into private memory by every process that
+# loads it. A weight store holds only the network weights, as raw tensors
+# behind a JSON index, so that processes can map it read-only and share one
+# physical copy through the page cache:
+#
+#   MAGIC | header length (uint64 LE) | JSON header | padding | tensor data
+#
+# The header maps every tensor name to its numpy dtype, shape and offset
+# relative to the 64 byte aligned start of the data. Stores are written next
+# to their checkpoint as .weight_store/<name>.<sha256 prefix>.weights, so a
+# changed checkpoint gets a new store.
+#
+# The conversion and mapping need numpy (and torch), so they are only called
+# in FastSurfer's Python environment, e.g. by seg_worker.py.
+#
+
+
+import json
+import os
+import struct
+import tempfile
+import warnings
+from collections import OrderedDict
+
+from fastsurfer import file_util
+
+
+MAGIC = b'FSWSTORE'
+ALIGNMENT = 64
+STORE_DIR_NAME = '.weight_store'
+
+# marks the tensors of a store, see share_parameters()
+MAPPED_ATTRIBUTE = '_weight_store_mapped'
+
+
+def store_path(checkpoint, digest, fallback_dir=None):
+    """
+    Return the path of the weight store of <checkpoint>, next to it if its
+    directory is writable, else in <fallback_dir> (a directory in the system
+    temporary directory by default).
+    """
+    name = '%s.%s.weights' % (os.path.basename(checkpoint), digest[:16])
+    store_dir = os.path.join(os.path.dirname(os.path.abspath(checkpoint)), STORE_DIR_NAME)
+    try:
+        os.makedirs(store_dir, exist_ok=True)
+        if os.access(store_dir, os.W_OK):
+            return os.path.join(store_dir, name)
+    except OSError:
+        pass
+    fallback_dir = fallback_dir or os.path.join(tempfile.gettempdir(), 'fastsurfer-weight-store')
+    os.makedirs(fallback_dir, exist_ok=True)
+    return os.path.join(fallback_dir, name)
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_store(path, tensors, meta=None):
+    """
+    Atomically write the store <path> of <tensors>, a list of (name, numpy
+    dtype string, shape, buffer) tuples, along with the JSON serialisable
+    dict <meta>.
+    """
+    index = OrderedDict()
+    offset = 0
+    for name, dtype, shape, buffer in tensors:
+        size = memoryview(buffer).nbytes
+        index[name] = {'dtype': dtype, 'shape': list(shape), 'offset': offset, 'size': size}
+        offset = align(offset + size)
+    header = json.dumps({'tensors': index, 'meta': meta or {}}).encode()
+    data_start = align(len(MAGIC) + 8 + len(header))
+
+    with file_util.atomic_open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, dtype, shape, buffer in tensors:
+            f.seek(data_start + index[name]['offset'])
+            f.write(memoryview(buffer).cast('B'))
+        f.truncate(data_start + offset)
+
+
+def read_header(path):
+    """
+    Return the header dict of the store <path>, with the absolute offset of
+    its tensor data as 'data_start'. Raise ValueError if it is not a store.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        length = f.read(8)
+        if magic != MAGIC or len(length) != 8:
+            raise ValueError('%s is not a weight store' % path)
+        header_length = struct.unpack('<Q', length)[0]
+        header = f.read(header_length)
+    if len(header) != header_length:
+        raise ValueError('%s is truncated' % path)
+    header = json.loads(header.decode())
+    header['data_start'] = align(len(MAGIC) + 8 + header_length)
+    return header
+
+
+def map_arrays(path):
+    """
+    Return an OrderedDict of read-only numpy memmaps of the tensors of the
+    store <path>, and its meta dict.
+    """
+    import numpy
+    header = read_header(path)
+    arrays = OrderedDict()
+    for name, entry in header['tensors'].items():
+        shape = tuple(entry['shape'])
+        if entry['size'] == 0:
+            arrays[name] = numpy.zeros(shape, dtype=entry['dtype'])
+            continue
+        arrays[name] = numpy.memmap(path, dtype=entry['dtype'], mode='r', shape=shape,
+                                    offset=header['data_start'] + entry['offset'])
+    return arrays, header['meta']
+
+
+def convert(checkpoint, path):
+    """
+    Write the network weights of the torch <checkpoint> (a training state with
+    a 'model_state_dict', or a bare state dict) to the store <path>.
+    """
+    import torch
+    state = torch.load(checkpoint, map_location='cpu')
+    nested = isinstance(state, dict) and 'model_state_dict' in state
+    state_dict = state['model_state_dict'] if nested else state
+    meta = {'nested': nested}
+    if nested:
+        meta['fields'] = {key: value for key, value in state.items()
+                          if isinstance(value, (bool, int, float, str))}
+    tensors = []
+    for name, tensor in state_dict.items():
+        array = tensor.detach().cpu().contiguous().numpy().reshape(-1)
+        tensors.append((name, array.dtype.str, list(tensor.shape), array))
+    write_store(path, tensors, meta)
+
+
+def prepare(checkpoint):
+    """
+    Return the weight store of <checkpoint>, converting it on first use.
+    """
+    path = store_path(checkpoint, file_util.file_sha256(checkpoint))
+    if not os.path.exists(path):
+        convert(checkpoint, path)
+    return path
+
+
+def load(path):
+    """
+    Return the checkpoint stored in <path> with the tensors of its state dict
+    mapped read-only, as torch.load() would return it.
+    """
+    import torch
+    arrays, meta = map_arrays(path)
+    state_dict = OrderedDict()
+    with warnings.catch_warnings():
+        # the tensors are never written, see share_parameters()
+        warnings.simplefilter('ignore', UserWarning)
+        for name, array in arrays.items():
+            tensor = torch.from_numpy(array)
+            setattr(tensor, MAPPED_ATTRIBUTE, True)
+            state_dict[name] = tensor
+    if not meta.get('nested'):
+        return state_dict
+    return dict(meta.get('fields', {}), model_state_dict=state_dict)
+
+
+def share_parameters(module, state_dict):
+    """
+    Point the CPU parameters and buffers of <module> loaded from <state_dict>
+    at the mapped tensors of a store instead of private copies. Only valid for
+    inference, which never writes them. Return the number of bytes shared.
+    """
+    shared = 0
+    for name, tensor in module.state_dict(keep_vars=True).items():
+        mapped = state_dict.get(name)
+        if (mapped is not None and getattr(mapped, MAPPED_ATTRIBUTE, False)
+                and tensor.device.type == 'cpu' and tensor.dtype == mapped.dtype
+                and tensor.shape == mapped.shape):
+            tensor.data = mapped
+            shared += mapped.numel() * mapped.element_size()
+    return shared
+
+
+def share_loaded_parameters(torch):
+    """
+    Make torch.nn.Module.load_state_dict() share the mapped tensors of weight
+    stores instead of copying them, for every module of the process. Return a
+    function restoring the original load_state_dict().
+    """
+    load_state_dict = torch.nn.Module.load_state_dict
+
+    def sharing_load_state_dict(self, state_dict, *args, **kwargs):
+        result = load_state_dict(self, state_dict, *args, **kwargs)
+        share_parameters(self, state_dict)
+        return result
+
+    def restore():
+        torch.nn.Module.load_state_dict = load_state_dict
+
+    torch.nn.Module.load_state_dict = sharing_load_state_dict
+    return restore
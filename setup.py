@@ -28,7 +28,7 @@ setup(
       author_email     =   'sandip.samal@childrens.harvard.edu',
       url              =   'https://deep-mi.org/research/fastsurfer/',
       packages         =   ['fastsurfer'],
-      install_requires =   ['chrisapp', 'pudb'],
+      install_requires =   ['chrisapp', 'pudb', 'numpy'],
       test_suite       =   'nose.collector',
       tests_require    =   ['nose'],
       scripts          =   ['fastsurfer/fastsurfer.py'],